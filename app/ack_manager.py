@@ -0,0 +1,236 @@
+import time
+import logging
+import threading
+
+# Get the logger set up
+logger = logging.getLogger(__name__)
+
+# Flush the pending acknowledgements once this many are collected...
+MAX_ACK_BATCH_SIZE = 500
+# ...or once the oldest of them waited this many seconds.
+MAX_ACK_DELAY_SECONDS = 1.0
+# The ack deadline (in seconds) requested for messages that are still being enriched.
+ACK_DEADLINE_SECONDS = 60
+
+
+class AckManager:
+    """
+    This class collects the ack ids of processed messages and acknowledges them to pub/sub in bulk,
+    one RPC per batch instead of one per message. It also keeps extending the ack deadline of the messages
+    that are still being enriched, so they are not redelivered while the work is in progress,
+    but are redelivered if the process crashes before acknowledging them.
+    """
+    def __init__(self, subscriber, subscription_name: str, max_batch_size: int = MAX_ACK_BATCH_SIZE,
+                 max_delay: float = MAX_ACK_DELAY_SECONDS, ack_deadline: int = ACK_DEADLINE_SECONDS,
+                 background: bool = True, timer=time.monotonic):
+        """
+        This method initializes the AckManager.
+
+        Parameters:
+        subscriber (pubsub_v1.SubscriberClient): the client to send the RPCs with.
+        subscription_name (str)
+        max_batch_size (int): flush when this many acknowledgements are pending.
+        max_delay (float): flush when the oldest pending acknowledgement waited this many seconds.
+        ack_deadline (int): seconds requested each time the deadline of an in-flight message is extended.
+        background (bool): run a thread that flushes on time and extends deadlines,
+        False to leave it to the caller to call flush_due.
+        timer (callable): monotonic clock source, replaceable in tests.
+
+        Returns:
+        None
+        """
+        self.subscriber = subscriber
+        self.subscription_name = subscription_name
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.ack_deadline = ack_deadline
+        self.background = background
+        self.timer = timer
+
+        self.ack_rpcs = 0
+        self.modify_deadline_rpcs = 0
+        self.failed_rpcs = 0
+        self.acked = 0
+
+        self._pending = []
+        self._oldest_pending_at = None
+        # ack id -> when its deadline was last extended, None if it was not extended yet
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self.background and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="ack-manager", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        # Tick often enough to honour both the flush delay and the deadline extension
+        tick = min(self.max_delay, self.ack_deadline / 4)
+        while not self._stop_event.wait(tick):
+            self.flush_due()
+
+    def track(self, ack_id: str):
+        """
+        This method registers a message that is being enriched, its deadline is extended until it is acked.
+
+        Parameters:
+        ack_id (str)
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._in_flight[ack_id] = None
+        self._ensure_started()
+
+    def ack(self, ack_id: str):
+        """
+        This method queues the acknowledgement of a message, and flushes if the batch is full.
+
+        Parameters:
+        ack_id (str)
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._in_flight.pop(ack_id, None)
+            self._pending.append(ack_id)
+            if self._oldest_pending_at is None:
+                self._oldest_pending_at = self.timer()
+            full = len(self._pending) >= self.max_batch_size
+        if full:
+            self.flush()
+        else:
+            self._ensure_started()
+
+    def nack(self, ack_ids: list):
+        """
+        This method gives messages back to pub/sub right away (an ack deadline of 0), so they are redelivered,
+        e.g. when their reports could not be saved.
+
+        Parameters:
+        ack_ids (list)
+
+        Returns:
+        None
+        """
+        with self._lock:
+            for ack_id in ack_ids:
+                self._in_flight.pop(ack_id, None)
+        for start in range(0, len(ack_ids), self.max_batch_size):
+            batch = ack_ids[start:start + self.max_batch_size]
+            try:
+                self.subscriber.modify_ack_deadline(request={
+                    "subscription": self.subscription_name,
+                    "ack_ids": batch,
+                    "ack_deadline_seconds": 0
+                })
+            # If not successful, the messages are redelivered anyway once their deadline expires
+            except Exception as e:
+                with self._lock:
+                    self.failed_rpcs += 1
+                logger.error(f"failed to nack {len(batch)} message(s): {e}")
+            with self._lock:
+                self.modify_deadline_rpcs += 1
+
+    def flush(self):
+        """
+        This method acknowledges all the pending ack ids, in as few RPCs as the batch size allows.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._oldest_pending_at = None
+        for start in range(0, len(pending), self.max_batch_size):
+            ack_ids = pending[start:start + self.max_batch_size]
+            try:
+                self.subscriber.acknowledge(request={
+                    "subscription": self.subscription_name,
+                    "ack_ids": ack_ids
+                })
+                with self._lock:
+                    self.acked += len(ack_ids)
+            # If not successful, then logs an error message, the messages will be redelivered
+            except Exception as e:
+                with self._lock:
+                    self.failed_rpcs += 1
+                logger.error(f"failed to acknowledge {len(ack_ids)} message(s): {e}")
+            with self._lock:
+                self.ack_rpcs += 1
+
+    def extend_deadlines(self):
+        """
+        This method extends, in bulk, the deadline of every in-flight message whose deadline is half over.
+
+        Returns:
+        None
+        """
+        now = self.timer()
+        with self._lock:
+            due = [ack_id for ack_id, extended_at in self._in_flight.items()
+                   if extended_at is None or now - extended_at >= self.ack_deadline / 2]
+            for ack_id in due:
+                self._in_flight[ack_id] = now
+        for start in range(0, len(due), self.max_batch_size):
+            ack_ids = due[start:start + self.max_batch_size]
+            try:
+                self.subscriber.modify_ack_deadline(request={
+                    "subscription": self.subscription_name,
+                    "ack_ids": ack_ids,
+                    "ack_deadline_seconds": self.ack_deadline
+                })
+            except Exception as e:
+                with self._lock:
+                    self.failed_rpcs += 1
+                logger.error(f"failed to extend the ack deadline of {len(ack_ids)} message(s): {e}")
+            with self._lock:
+                self.modify_deadline_rpcs += 1
+
+    def flush_due(self):
+        """
+        This method flushes the pending acknowledgements if the oldest waited long enough,
+        and extends the deadlines that are due.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            due = self._oldest_pending_at is not None and self.timer() - self._oldest_pending_at >= self.max_delay
+        if due:
+            self.flush()
+        self.extend_deadlines()
+
+    def stats(self) -> dict:
+        """
+        This method returns the RPC counters.
+
+        Returns:
+        dict with the number of ack RPCs, acked messages, deadline RPCs, failed RPCs, and messages pending or in flight
+        """
+        with self._lock:
+            return {
+                "ack_rpcs": self.ack_rpcs,
+                "acked_messages": self.acked,
+                "modify_deadline_rpcs": self.modify_deadline_rpcs,
+                "failed_rpcs": self.failed_rpcs,
+                "pending": len(self._pending),
+                "in_flight": len(self._in_flight),
+            }
+
+    def close(self):
+        """
+        This method stops the background thread and flushes what is still pending.
+
+        Returns:
+        None
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
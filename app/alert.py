@@ -1,25 +1,121 @@
 # Import uuid for generating unique string to alert id
-import uuid 
+import uuid
+
+# Where the verdict of an IoC came from
+SOURCE_LOCAL = "local"
+SOURCE_CACHE = "cache"
+SOURCE_REMOTE = "remote"
+# The IoC was not looked up, its alert was decided without it (see PriorityScheduler)
+SOURCE_SKIPPED = "skipped"
+
+
+class IocRecord:
+    """
+    This class is the result of the analysis of one IoC: its value and type, whether it is malicious,
+    where the verdict came from, when it was resolved and, for a VirusTotal verdict, the engine counts
+    of the report (see scoring.STAT_FIELDS). An IoC that appears in several alerts of
+    a batch is resolved once, and its record is shared by all of them.
+    """
+    __slots__ = ("value", "ioc_type", "is_malicious", "source", "resolved_at", "stats", "failed")
+
+    def __init__(self, value:str, ioc_type:str, is_malicious:bool, source:str, resolved_at:float, stats:tuple=None,
+                 failed:bool=False):
+        """
+        This method initilize the record.
+
+        Parameters:
+        value (str): the IoC.
+        ioc_type (str): the type of the IoC (see ioc_classifier), None if unknown.
+        is_malicious (bool)
+        source (str): SOURCE_LOCAL, SOURCE_CACHE, SOURCE_REMOTE or SOURCE_SKIPPED.
+        resolved_at (float): unix time the verdict was resolved.
+        stats (tuple): malicious, suspicious, harmless and undetected engine counts, None if the verdict has none.
+        failed (bool): the VirusTotal lookup failed, the IoC was not checked (it is not known to be clean).
+
+        Returns:
+        None
+        """
+        self.value = value
+        self.ioc_type = ioc_type
+        self.is_malicious = is_malicious
+        self.source = source
+        self.resolved_at = resolved_at
+        self.stats = stats
+        self.failed = failed
+
+    def to_report_entry(self) -> dict:
+        """
+        This method returns the entry of the IoC in the report, with "Failed": true when its lookup failed
+        and "Skipped": true when it was not looked up, in both cases IsMalicious false does not mean it is clean.
+        """
+        entry = {"IoCs": self.value, "IsMalicious": self.is_malicious, "Source": self.source}
+        if self.failed:
+            entry["Failed"] = True
+        if self.source == SOURCE_SKIPPED:
+            entry["Skipped"] = True
+        return entry
+
 
 class Alert:
     """
     This Alert class has an initialization method for alert with id, ioc
-    and severirty attributes by receiving list of Ioc's in the argument and assign 
-    them to the alert Iocs when creating the object 
+    and severirty attributes by receiving list of Ioc's in the argument and assign
+    them to the alert Iocs when creating the object
     """
-    def __init__(self,ioc:list):
+    # Alerts are buffered by the thousands while VirusTotal is slow, slots keep each of them small
+    __slots__ = ("id", "severity", "ioc", "ack_id", "_ioc_types", "records", "priority")
+
+    def __init__(self,ioc:list,ack_id:str=None,ioc_types=None,priority:int=0):
         """
         This method initilize the alert object with unique string id,
         severity = None and assign the ioc list to alert.ioc
 
         Parameters:
         ioc (list): list of iocs
+        ack_id (str): ack id of the pub/sub message the alert came from, None if it has none
+        ioc_types (list or dict): the type of every ioc (see ioc_classifier), as a list in the order of ioc
+        or a dict of ioc -> type, None if they were not classified yet
+        priority (int): alerts with a higher priority are enriched first
 
         Returns:
         None
         """
         # Creats unique id for each alert
-        self.id = str(uuid.uuid4()) 
+        self.id = str(uuid.uuid4())
         self.severity = None
         self.ioc = ioc
-        
\ No newline at end of file
+        self.ack_id = ack_id
+        self.priority = priority
+        if isinstance(ioc_types, dict):
+            ioc_types = [ioc_types.get(value) for value in ioc]
+        self._ioc_types = tuple(ioc_types) if ioc_types else None
+        # The IocRecord of every ioc, in the order of ioc, set when the alert is analyzed
+        self.records = None
+
+    @property
+    def ioc_types(self) -> dict:
+        """
+        The type of every classified ioc, as a dict of ioc -> type.
+        """
+        if self._ioc_types is None:
+            return {}
+        return dict(zip(self.ioc, self._ioc_types))
+
+    def ioc_type(self, index:int) -> str:
+        """
+        This method returns the type of the ioc at the given index, None if it was not classified.
+        """
+        return self._ioc_types[index] if self._ioc_types is not None else None
+
+    def to_report(self) -> dict:
+        """
+        This method serializes the analyzed alert to its report.
+
+        Returns:
+        dict: report containing alert ID, severity score, and IoC analysis.
+        """
+        return {
+            "AlertId":self.id,
+            "Severity":self.severity,
+            "IoCs":[record.to_report_entry() for record in (self.records or ())]
+            }
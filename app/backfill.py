@@ -0,0 +1,311 @@
+import os
+import gzip
+import re
+import json
+import logging
+import argparse
+from app.alert import Alert
+from app.message_parser import MessageParser
+from app.report_sink import JsonFileSink, JsonLinesSink, SQLiteSink
+from app.metrics import DISABLED_METRICS
+from app.config import load_env, load_config
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values of the command line options.
+DEFAULT_OUTPUT_DIRECTORY = "app/output/backfill"
+DEFAULT_BATCH_SIZE = 100
+CHECKPOINT_FILE_NAME = "backfill_checkpoint.json"
+
+SINKS = ("jsonl", "sqlite", "json")
+
+# Names of the report files, like the ones JsonFileSink and JsonLinesSink write
+REPORT_FILE_PATTERN = re.compile(r"report_.*\.json")
+REPORTS_FILE_PATTERN = re.compile(r"reports_.*\.jsonl(\.gz|\.zst)?")
+# Other files that are not IoC messages: checkpoints, sqlite databases and their journals, partial writes
+NOT_MESSAGES_SUFFIXES = (".json", ".jsonl", ".jsonl.gz", ".jsonl.zst", ".db", ".db-wal", ".db-shm", ".db-journal", ".tmp")
+
+
+def list_sources(paths: list, exclude_directory: str = None) -> list:
+    """
+    This function lists the files to replay, in the order they are replayed: every file given,
+    and every file under the directories given, sorted by path.
+
+    Parameters:
+    paths (list): files and directories.
+    exclude_directory (str): directory whose files are skipped, e.g. where the backfill writes.
+
+    Returns:
+    sorted list of file paths
+    """
+    exclude_directory = os.path.abspath(exclude_directory) + os.sep if exclude_directory else None
+    sources = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, file_names in os.walk(path):
+                sources.update(os.path.join(directory, file_name) for file_name in file_names)
+        elif os.path.isfile(path):
+            sources.add(path)
+        else:
+            logger.warning(f"skipping {path}, it does not exist")
+    if exclude_directory:
+        sources = {source for source in sources if not os.path.abspath(source).startswith(exclude_directory)}
+    return sorted(sources)
+
+
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        import zstandard
+        return zstandard.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def read_records(path: str):
+    """
+    This function streams the records of a source file, one at a time, without reading the whole file:
+    - report_*.json: one report, the alert keeps its AlertId.
+    - reports_*.jsonl (optionally .gz or .zst): one report per line, like the ones JsonLinesSink writes.
+    - other json, jsonl, sqlite and .tmp files (e.g. backfill_checkpoint.json): skipped, nothing is yielded.
+    - any other file: IoC messages, one IoC per line, messages separated by a blank line.
+
+    Parameters:
+    path (str)
+
+    Returns:
+    generator of (alert id or None, list of IoCs)
+    """
+    name = os.path.basename(path)
+    if REPORT_FILE_PATTERN.fullmatch(name):
+        with open(path, encoding="utf-8") as file:
+            report = json.load(file)
+        yield report.get("AlertId"), [entry["IoCs"] for entry in report.get("IoCs", [])]
+        return
+    is_reports_file = REPORTS_FILE_PATTERN.fullmatch(name) is not None
+    if not is_reports_file and name.endswith(NOT_MESSAGES_SUFFIXES):
+        logger.warning(f"skipping {path}, it is neither a report file nor IoC messages")
+        return
+    with _open_text(path) as file:
+        if is_reports_file:
+            for line in file:
+                if line.strip():
+                    report = json.loads(line)
+                    yield report.get("AlertId"), [entry["IoCs"] for entry in report.get("IoCs", [])]
+            return
+        message = []
+        for line in file:
+            line = line.strip()
+            if line:
+                message.append(line)
+            elif message:
+                yield None, message
+                message = []
+        if message:
+            yield None, message
+
+
+def alert_from_iocs(iocs: list, alert_id: str = None, message_parser: MessageParser = None):
+    """
+    This function builds the alert of a replayed record through the message parser of the ingestion, so it gets
+    the same IoCs as live: malformed IoCs are dropped, repeated ones deduplicated and the MESSAGE_MAX_* caps apply.
+    A record bigger than the max bytes of the parser gives an alert without IoCs, all of them counted as dropped.
+
+    Parameters:
+    iocs (list): the IoCs of the record.
+    alert_id (str): the id of the alert in the report it came from, None for a new id.
+    message_parser (MessageParser): None for a parser without caps.
+
+    Returns:
+    (Alert, number of malformed IoCs dropped)
+    """
+    message_parser = message_parser if message_parser is not None else MessageParser()
+    rejected = []
+    values = []
+    ioc_types = []
+    try:
+        data = "\n".join(iocs).encode("utf-8")
+        for ioc, ioc_type in message_parser.iter_iocs(data, on_rejected=rejected.append):
+            values.append(ioc)
+            ioc_types.append(ioc_type)
+    except ValueError as e:
+        logger.error(f"Failed to parse the record of alert {alert_id}, it is replayed without IoCs: {e}")
+        rejected, values, ioc_types = list(iocs), [], []
+    alert = Alert(values, ioc_types=ioc_types)
+    if alert_id:
+        alert.id = alert_id
+    return alert, len(rejected)
+
+
+class Checkpoint:
+    """
+    This class keeps the position of a backfill in a small json file: the source being replayed and how many
+    of its records have their reports written. Sources are replayed in sorted order, so every source before it is done.
+    The file is replaced atomically, a crash leaves the previous checkpoint.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.source = None
+        self.offset = 0
+        self.alerts = 0
+        if os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as file:
+                    state = json.load(file)
+                self.source = state["source"]
+                self.offset = state["offset"]
+                self.alerts = state.get("alerts", 0)
+                logger.info(f"resuming the backfill at record {self.offset} of {self.source}")
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Failed to read the checkpoint {path}, starting over: {e}")
+
+    def save(self, source: str, offset: int, alerts: int):
+        """
+        This method records that every record up to offset (excluded) of the source was replayed.
+        """
+        self.source, self.offset, self.alerts = source, offset, alerts
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump({"source": source, "offset": offset, "alerts": alerts}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+
+
+def iter_alerts(sources: list, checkpoint: Checkpoint, stats: dict, message_parser: MessageParser = None):
+    """
+    This function streams the alerts of the sources that are after the checkpoint.
+
+    Parameters:
+    sources (list): sorted file paths.
+    checkpoint (Checkpoint)
+    stats (dict): the rejected IoCs, empty records and unreadable sources are counted in it.
+    message_parser (MessageParser): parses the IoCs of every record, None for a parser without caps.
+
+    Returns:
+    generator of (source, offset, Alert)
+    """
+    # The checkpoint moves while the alerts are consumed, resume from where it was at the start
+    resume_source, resume_offset = checkpoint.source, checkpoint.offset
+    for source in sources:
+        if resume_source is not None and source < resume_source:
+            continue
+        try:
+            for offset, (alert_id, iocs) in enumerate(read_records(source)):
+                if source == resume_source and offset < resume_offset:
+                    continue
+                alert, rejected = alert_from_iocs(iocs, alert_id, message_parser)
+                stats["rejected_iocs"] += rejected
+                if not alert.ioc:
+                    stats["empty_records"] += 1
+                yield source, offset, alert
+        except Exception as e:
+            # A corrupt file does not stop the backfill, whatever it yielded before the error is replayed
+            logger.error(f"Failed to read {source}, skipping the rest of it: {e}")
+            stats["failed_sources"] += 1
+
+
+def iter_batches(alerts, batch_size: int):
+    """
+    This function groups a stream of alerts in lists of up to batch_size.
+    """
+    batch = []
+    for item in alerts:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_backfill(sources: list, enrichment_service, checkpoint: Checkpoint, batch_size: int = DEFAULT_BATCH_SIZE,
+                 stop_event=None, message_parser: MessageParser = None) -> dict:
+    """
+    This function re-enriches the alerts of the sources batch by batch, only a batch is in memory at a time.
+    After every batch its reports are flushed durably to the report sink of the enrichment service and only
+    then the checkpoint moves past it, so an interrupted backfill resumes after the last batch written
+    (a batch may be written twice, never lost). A batch whose reports cannot be written stops the backfill before it.
+
+    Parameters:
+    sources (list): sorted file paths.
+    enrichment_service (EnrichmentService): with a report sink.
+    checkpoint (Checkpoint)
+    batch_size (int): alerts enriched together.
+    stop_event (threading.Event): set to stop after the current batch, None to run to the end.
+    message_parser (MessageParser): parses the IoCs of every record, None for a parser without caps.
+
+    Returns:
+    dict of the backfill stats
+    """
+    stats = {"alerts": 0, "batches": 0, "rejected_iocs": 0, "empty_records": 0, "failed_sources": 0, "failed_batches": 0}
+    for batch in iter_batches(iter_alerts(sources, checkpoint, stats, message_parser), batch_size):
+        enrichment_service.analyze_alerts([alert for _, _, alert in batch],
+                                          on_report=lambda report: enrichment_service.save_report_to_file(report=report))
+        enrichment_service.flush_reports(durable=True)
+        unsaved_alert_ids = enrichment_service.take_unsaved_alert_ids()
+        if unsaved_alert_ids:
+            # Stop before the checkpoint moves, the batch is replayed when the backfill runs again
+            logger.error(f"{len(unsaved_alert_ids)} report(s) of the batch could not be saved, stopping the backfill")
+            stats["failed_batches"] += 1
+            break
+        source, offset, _ = batch[-1]
+        stats["alerts"] += len(batch)
+        stats["batches"] += 1
+        checkpoint.save(source, offset + 1, checkpoint.alerts + len(batch))
+        logger.info(f"{checkpoint.alerts} alert(s) replayed, up to record {offset} of {source}")
+        if stop_event is not None and stop_event.is_set():
+            break
+    return stats
+
+
+def build_sink(kind: str, directory: str, batch_size: int = DEFAULT_BATCH_SIZE):
+    """
+    This function creates the report sink the backfill writes to, it is flushed after every batch.
+    """
+    if kind == "jsonl":
+        return JsonLinesSink(directory=directory, flush_every=batch_size)
+    if kind == "sqlite":
+        return SQLiteSink(db_path=os.path.join(directory, "reports.db"), flush_every=batch_size)
+    if kind == "json":
+        return JsonFileSink(directory=directory, flush_every=batch_size)
+    raise ValueError(f"unknown sink {kind}, use {', '.join(SINKS)}")
+
+
+def main(argv: list = None):
+    # build_enrichment_service imports the services, only when the backfill runs
+    from app.main import build_enrichment_service, close_enrichment_service
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Re-enrich archived IoC messages or reports without Pub/Sub")
+    parser.add_argument("paths", nargs="+", help="files or directories of IoC messages, report_*.json or reports_*.jsonl files")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIRECTORY, help="directory the new reports are written to")
+    parser.add_argument("--sink", choices=SINKS, default="jsonl")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=None, help="parallel VirusTotal lookups, ENRICHMENT_MAX_WORKERS by default")
+    parser.add_argument("--checkpoint", default=None, help=f"checkpoint file, {CHECKPOINT_FILE_NAME} in the output directory by default")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and replay everything")
+    args = parser.parse_args(argv)
+
+    load_env()
+    checkpoint_path = args.checkpoint or os.path.join(args.output, CHECKPOINT_FILE_NAME)
+    sink = build_sink(args.sink, args.output, batch_size=args.batch_size)
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = Checkpoint(checkpoint_path)
+    sources = list_sources(args.paths, exclude_directory=args.output)
+    logger.info(f"{len(sources)} file(s) to replay")
+    enrichment_service = build_enrichment_service(load_config(), DISABLED_METRICS, report_sink=sink, max_workers=args.workers)
+    try:
+        stats = run_backfill(sources, enrichment_service, checkpoint, batch_size=args.batch_size,
+                             message_parser=MessageParser.from_env())
+        logger.info(f"backfill done: {stats}")
+    except KeyboardInterrupt:
+        logger.info(f"backfill interrupted, run it again to resume at record {checkpoint.offset} of {checkpoint.source}")
+    finally:
+        close_enrichment_service(enrichment_service)
+
+
+if __name__ == "__main__":
+    main()
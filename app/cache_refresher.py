@@ -0,0 +1,302 @@
+import os
+import time
+import logging
+import threading
+from app.alert import SOURCE_REMOTE
+from app.metrics import DISABLED_METRICS
+from app.ioc_classifier import classify_ioc
+from app.report_index import read_saved_reports, file_time
+from app.verdict_cache import VERDICT_MALICIOUS, VERDICT_CLEAN, VERDICT_FAILED
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_REFRESH_AHEAD_SECONDS = 600.0
+DEFAULT_REFRESH_INTERVAL_SECONDS = 30.0
+DEFAULT_TOP_N = 50
+DEFAULT_MIN_HITS = 2.0
+DEFAULT_RESERVE = 1
+DEFAULT_HALF_LIFE_SECONDS = 60 * 60
+DEFAULT_MAX_TRACKED = 10000
+
+# Where a verdict served warm came from
+ORIGIN_REFRESH = "refresh"
+ORIGIN_STARTUP = "startup"
+
+
+class CacheRefresher:
+    """
+    This class keeps the verdicts of the hot IoCs in the verdict cache fresh, so the alerts that contain them
+    do not wait for VirusTotal. It counts how often every IoC is looked up (counts decay with half_life, so an IoC
+    that stopped showing up cools down), and every interval re-queries the hottest IoCs whose verdicts expire
+    within refresh_ahead seconds. A refresh is only sent when the rate limiter has spare budget: no live lookup
+    is waiting and every quota keeps reserve requests, so it never delays a live alert.
+
+    It can also warm the cache at startup from the reports of a previous run. A live lookup answered by the cache
+    only thanks to a refresh or the warm start is counted as served warm.
+    """
+    def __init__(self, enrichment_service, refresh_ahead: float = DEFAULT_REFRESH_AHEAD_SECONDS,
+                 interval: float = DEFAULT_REFRESH_INTERVAL_SECONDS, top_n: int = DEFAULT_TOP_N,
+                 min_hits: float = DEFAULT_MIN_HITS, reserve: int = DEFAULT_RESERVE,
+                 half_life: float = DEFAULT_HALF_LIFE_SECONDS, max_tracked: int = DEFAULT_MAX_TRACKED,
+                 warm_directory: str = None, metrics=None, timer=time.time):
+        """
+        This method initializes the CacheRefresher.
+
+        Parameters:
+        enrichment_service (EnrichmentService): with a verdict cache, its VirusTotal client and rate limiter are used.
+        refresh_ahead (float): seconds before a verdict expires from which it is refreshed, 0 to only warm the cache.
+        interval (float): seconds between two refresh rounds.
+        top_n (int): most IoCs refreshed in a round.
+        min_hits (float): an IoC is refreshed only if its decayed lookup count reaches this.
+        reserve (int): requests of every quota left to the live lookups.
+        half_life (float): seconds after which a lookup counts half.
+        max_tracked (int): most IoCs counted, the coldest are forgotten beyond it.
+        warm_directory (str): output directory of a previous run to warm the cache from at startup, None to start cold.
+        metrics (MetricsRegistry): registry of the pipeline metrics, None for no metrics.
+        timer (callable): returns the current unix time, replaceable in tests.
+
+        Returns:
+        None
+        """
+        self.enrichment_service = enrichment_service
+        self.verdict_cache = enrichment_service.verdict_cache
+        self.refresh_ahead = refresh_ahead
+        self.interval = interval
+        self.top_n = top_n
+        self.min_hits = min_hits
+        self.reserve = reserve
+        self.half_life = half_life
+        self.max_tracked = max_tracked
+        self.warm_directory = warm_directory
+        self.timer = timer
+        # IoC -> [decayed count, time of the count, type of the IoC]
+        self._counts = {}
+        # IoC -> (origin, time its verdict would have expired without it), until a live lookup is served by it
+        self._warm = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        metrics = metrics if metrics is not None else DISABLED_METRICS
+        self.refreshes = metrics.counter("cache_refreshes_total", "Verdicts refreshed ahead of their expiry, by outcome", ("outcome",))
+        self.warm_hits = metrics.counter("cache_warm_hits_total",
+                                         "Live lookups served by a verdict that was refreshed or warmed at startup", ("origin",))
+        self.warmed = metrics.counter("cache_warmed_total", "Verdicts loaded into the cache at startup from saved reports")
+        self.stats_counts = {"refreshed": 0, "failed": 0, "warmed": 0, ORIGIN_REFRESH: 0, ORIGIN_STARTUP: 0}
+
+    @classmethod
+    def from_env(cls, enrichment_service, metrics=None):
+        """
+        This method creates the CacheRefresher from the CACHE_REFRESH_* and CACHE_WARM_DIRECTORY settings of the .env file.
+
+        Parameters:
+        enrichment_service (EnrichmentService)
+        metrics (MetricsRegistry)
+
+        Returns:
+        a CacheRefresher, or None when CACHE_REFRESH_AHEAD is 0 and CACHE_WARM_DIRECTORY is not set,
+        or when the service has no verdict cache
+        """
+        refresh_ahead = float(os.getenv("CACHE_REFRESH_AHEAD") or 0)
+        warm_directory = os.getenv("CACHE_WARM_DIRECTORY") or None
+        if (refresh_ahead <= 0 and warm_directory is None) or enrichment_service.verdict_cache is None:
+            return None
+        return cls(
+            enrichment_service,
+            refresh_ahead=refresh_ahead,
+            interval=float(os.getenv("CACHE_REFRESH_INTERVAL", DEFAULT_REFRESH_INTERVAL_SECONDS)),
+            top_n=int(os.getenv("CACHE_REFRESH_TOP_N", DEFAULT_TOP_N)),
+            min_hits=float(os.getenv("CACHE_REFRESH_MIN_HITS", DEFAULT_MIN_HITS)),
+            reserve=int(os.getenv("CACHE_REFRESH_RESERVE", DEFAULT_RESERVE)),
+            warm_directory=warm_directory,
+            metrics=metrics,
+        )
+
+    def _decayed(self, count: list, now: float) -> float:
+        return count[0] * 0.5 ** ((now - count[1]) / self.half_life)
+
+    def record_access(self, ioc: str, ioc_type: str = None, hit: bool = False):
+        """
+        This method counts a live lookup of the IoC in the verdict cache.
+
+        Parameters:
+        ioc (str)
+        ioc_type (str): the type of the IoC, None to classify it when it is refreshed.
+        hit (bool): the cache had the verdict.
+
+        Returns:
+        None
+        """
+        now = self.timer()
+        with self._lock:
+            count = self._counts.get(ioc)
+            if count is None:
+                self._counts[ioc] = [1.0, now, ioc_type]
+                if len(self._counts) > self.max_tracked:
+                    self._forget_coldest(now)
+            else:
+                count[0] = self._decayed(count, now) + 1
+                count[1] = now
+                count[2] = count[2] or ioc_type
+            warm = self._warm.pop(ioc, None) if hit else None
+        if warm is not None:
+            origin, stale_at = warm
+            # Without the refresh the verdict would have expired by now, the lookup would have gone to VirusTotal
+            if now >= stale_at:
+                self.warm_hits.labels(origin).inc()
+                self.stats_counts[origin] += 1
+
+    def _forget_coldest(self, now: float):
+        ranked = sorted(self._counts, key=lambda ioc: self._decayed(self._counts[ioc], now))
+        for ioc in ranked[:len(ranked) // 2]:
+            del self._counts[ioc]
+
+    def candidates(self) -> list:
+        """
+        This method returns the IoCs to refresh in this round, the hottest first.
+
+        Returns:
+        list of (IoC, type of the IoC)
+        """
+        now = self.timer()
+        with self._lock:
+            hot = [(self._decayed(count, now), ioc, count[2]) for ioc, count in self._counts.items()]
+        hot = sorted((item for item in hot if item[0] >= self.min_hits), reverse=True)
+        candidates = []
+        for _, ioc, ioc_type in hot:
+            entry = self.verdict_cache.peek(ioc)
+            # Failed verdicts expire soon by design, the next live lookup retries them
+            if entry is None or entry.verdict == VERDICT_FAILED or entry.expires_at - now > self.refresh_ahead:
+                continue
+            candidates.append((ioc, ioc_type))
+            if len(candidates) >= self.top_n:
+                break
+        return candidates
+
+    def refresh_once(self) -> int:
+        """
+        This method runs one refresh round, it stops as soon as there is no spare budget. Every refresh takes its
+        budget with RateLimiter.try_acquire and is sent once, without retries.
+
+        Returns:
+        number of verdicts refreshed
+        """
+        refreshed = 0
+        rate_limiter = self.enrichment_service.rate_limiter
+        for ioc, ioc_type in self.candidates():
+            if self._stop_event.is_set():
+                break
+            # Take the budget now, a refresh never waits in the rate limiter queue ahead of live lookups
+            if rate_limiter is not None and not rate_limiter.try_acquire(reserve=self.reserve):
+                break
+            entry = self.verdict_cache.peek(ioc)
+            json_response = self.enrichment_service.query_virustotal(ioc=ioc, ioc_type=ioc_type or classify_ioc(ioc),
+                                                                     background=rate_limiter is not None)
+            # A failed refresh leaves the current verdict until it expires
+            if not json_response:
+                self.refreshes.labels("failed").inc()
+                self.stats_counts["failed"] += 1
+                continue
+            is_malicious = self.enrichment_service.is_ioc_malicious_from_response(json_response=json_response)
+            self.verdict_cache.set(ioc, VERDICT_MALICIOUS if is_malicious else VERDICT_CLEAN)
+            with self._lock:
+                if entry is not None and ioc not in self._warm:
+                    self._warm[ioc] = (ORIGIN_REFRESH, entry.expires_at)
+            self.refreshes.labels("refreshed").inc()
+            self.stats_counts["refreshed"] += 1
+            refreshed += 1
+        return refreshed
+
+    def warm_from_reports(self, directory: str, max_files: int = None) -> int:
+        """
+        This method loads the VirusTotal verdicts of the reports saved in a directory into the verdict cache,
+        the newest reports first. A verdict gets the time its report was saved, so it expires as if it had been cached
+        then, and verdicts already cached are kept. Entries without a Source (reports of older versions) are not loaded.
+
+        Parameters:
+        directory (str): the output directory of a previous run.
+        max_files (int): most report files read, None for all.
+
+        Returns:
+        number of verdicts loaded
+        """
+        if not os.path.isdir(directory):
+            return 0
+        paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+        paths = sorted((path for path in paths if os.path.isfile(path)), key=file_time, reverse=True)[:max_files]
+        warmed = 0
+        for path in paths:
+            try:
+                for report, resolved_at in read_saved_reports(path):
+                    for entry in report.get("IoCs", []):
+                        # Only verdicts VirusTotal gave, the local lists answer without it anyway,
+                        # and a failed lookup is looked up again instead of being taken as clean.
+                        # Reports older than the Source field cannot tell a failed lookup from a clean one, they are skipped
+                        if entry.get("Source") != SOURCE_REMOTE or entry.get("Failed"):
+                            continue
+                        if self.verdict_cache.peek(entry["IoCs"]) is not None:
+                            continue
+                        verdict = VERDICT_MALICIOUS if entry.get("IsMalicious") else VERDICT_CLEAN
+                        self.verdict_cache.set(entry["IoCs"], verdict, resolved_at=resolved_at)
+                        if self.verdict_cache.peek(entry["IoCs"]) is None:
+                            continue
+                        with self._lock:
+                            self._warm[entry["IoCs"]] = (ORIGIN_STARTUP, 0.0)
+                        warmed += 1
+            except (OSError, ValueError, KeyError) as e:
+                logger.error(f"Failed to warm the cache from {path}: {e}")
+        self.warmed.inc(warmed)
+        self.stats_counts["warmed"] += warmed
+        logger.info(f"{warmed} verdict(s) warmed from the reports of {directory}")
+        return warmed
+
+    def start(self):
+        """
+        This method warms the cache from warm_directory if it is set, and starts the refresh rounds
+        in a background thread if refresh_ahead is set.
+
+        Returns:
+        the CacheRefresher
+        """
+        if self.warm_directory:
+            self.warm_from_reports(self.warm_directory)
+        if self.refresh_ahead <= 0:
+            return self
+        self._thread = threading.Thread(target=self._run, name="cache-refresher", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.refresh_once()
+            except Exception as e:
+                logger.error(f"cache refresh round failed: {e}")
+
+    def stats(self) -> dict:
+        """
+        This method returns the refresher counters.
+
+        Returns:
+        dict with the verdicts refreshed, failed refreshes, verdicts warmed at startup,
+        live lookups served warm by origin, and the number of IoCs tracked
+        """
+        with self._lock:
+            tracked = len(self._counts)
+        return {
+            "refreshed": self.stats_counts["refreshed"],
+            "failed": self.stats_counts["failed"],
+            "warmed": self.stats_counts["warmed"],
+            "served_warm": {ORIGIN_REFRESH: self.stats_counts[ORIGIN_REFRESH], ORIGIN_STARTUP: self.stats_counts[ORIGIN_STARTUP]},
+            "tracked": tracked,
+        }
+
+    def stop(self):
+        """
+        This method stops the refresh rounds.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,97 @@
+import os
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+from app.ingestion_service import MAX_OUTSTANDING_MESSAGES, MAX_OUTSTANDING_BYTES
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+INGESTION_MODES = ("pull", "streaming")
+
+
+def _optional_int(value: str) -> int:
+    return int(value) if value else None
+
+
+@dataclass(frozen=True)
+class Config:
+    """
+    This class holds the settings of the entry points (main.py and the supervisor), read from the
+    environment once. The components that have their own settings (VerdictCache, RateLimiter, SpoolQueue...)
+    keep reading them in their from_env methods, after load_env filled the environment.
+    """
+    subscription_name: str = None
+    service_account_path: str = None
+    ack_after_report: bool = False
+    ingestion_mode: str = "pull"
+    enrichment_max_workers: int = 1
+    virustotal_bulk_size: int = 0
+    early_emit_severity: int = None
+    spool_batch_size: int = 10
+    streaming_batch_size: int = 10
+    streaming_work_queue_size: int = 100
+    streaming_max_outstanding_messages: int = MAX_OUTSTANDING_MESSAGES
+    streaming_max_outstanding_bytes: int = MAX_OUTSTANDING_BYTES
+    worker_processes: int = None
+
+    def __post_init__(self):
+        if self.ingestion_mode not in INGESTION_MODES:
+            raise ValueError(f"unknown INGESTION_MODE {self.ingestion_mode}, use {', '.join(INGESTION_MODES)}")
+
+    @classmethod
+    def from_env(cls):
+        """
+        This method reads the settings from the environment variables.
+
+        Returns:
+        Config
+
+        Raises:
+        ValueError if a setting has an invalid value
+        """
+        return cls(
+            subscription_name=os.getenv("SUBSCRIPTION_NAME"),
+            service_account_path=os.getenv("SERVICE_ACCOUNT"),
+            ack_after_report=os.getenv("ACK_AFTER_REPORT", "false").lower() == "true",
+            ingestion_mode=os.getenv("INGESTION_MODE", "pull").lower(),
+            enrichment_max_workers=int(os.getenv("ENRICHMENT_MAX_WORKERS", 1)),
+            virustotal_bulk_size=int(os.getenv("VIRUSTOTAL_BULK_SIZE", 0)),
+            early_emit_severity=_optional_int(os.getenv("EARLY_EMIT_SEVERITY")),
+            spool_batch_size=int(os.getenv("SPOOL_BATCH_SIZE", 10)),
+            streaming_batch_size=int(os.getenv("STREAMING_BATCH_SIZE", 10)),
+            streaming_work_queue_size=int(os.getenv("STREAMING_WORK_QUEUE_SIZE", 100)),
+            streaming_max_outstanding_messages=int(os.getenv("STREAMING_MAX_OUTSTANDING_MESSAGES", MAX_OUTSTANDING_MESSAGES)),
+            streaming_max_outstanding_bytes=int(os.getenv("STREAMING_MAX_OUTSTANDING_BYTES", MAX_OUTSTANDING_BYTES)),
+            worker_processes=_optional_int(os.getenv("WORKER_PROCESSES")),
+        )
+
+    @property
+    def streaming(self) -> bool:
+        return self.ingestion_mode == "streaming"
+
+
+@lru_cache(maxsize=None)
+def load_env() -> bool:
+    """
+    This function loads the .env file into the environment, once per process.
+    Variables already set in the environment are not overridden.
+
+    Returns:
+    True if a .env file was found and loaded
+    """
+    from dotenv import load_dotenv
+    return load_dotenv()
+
+
+@lru_cache(maxsize=None)
+def load_config() -> Config:
+    """
+    This function loads the .env file and reads the Config, once per process. load_config.cache_clear()
+    reads it again.
+
+    Returns:
+    Config
+    """
+    load_env()
+    return Config.from_env()
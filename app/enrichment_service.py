@@ -1,17 +1,26 @@
-from app.alert import Alert
+from app.alert import Alert,IocRecord,SOURCE_LOCAL,SOURCE_CACHE,SOURCE_REMOTE,SOURCE_SKIPPED
 import os
-import requests
-from dotenv import load_dotenv
+import time
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
 from app.utils import get_current_time,ensure_output_directory
+from app.verdict_cache import VERDICT_MALICIOUS,VERDICT_CLEAN,VERDICT_FAILED
+from app.virustotal_client import VirusTotalClient
+from app.request_coalescer import RequestCoalescer
+from app.ioc_classifier import classify_ioc,virustotal_path,virustotal_search_term,ioc_match_keys,virustotal_object_keys,VIRUSTOTAL_SEARCH_PATH
+from app.metrics import DISABLED_METRICS,SEVERITY_BUCKETS
+from app.scoring import AlertScore,BinaryPolicy,analysis_stats
+from app.priority_scheduler import PriorityScheduler
+from app.config import load_env
 import logging
 
 
 # Get the logger setup.
 logger= logging.getLogger(__name__)
 
-# Get context from .env file
-load_dotenv() 
+# A search refused with these statuses will be refused again (e.g. an API key without the premium plan)
+BULK_REFUSED_STATUS_CODES = (401,403)
 
 class EnrichmentService:
     """
@@ -21,41 +30,149 @@ class EnrichmentService:
     full report by the results, and lastly save the report to a .json file
     with execution time as part of the file name.
     """
-    def __init__(self):
+    def __init__(self,verdict_cache=None,max_workers:int=1,rate_limiter=None,virustotal_client=None,report_sink=None,
+                 local_index=None,metrics=None,bulk_size:int=0,scoring_policy=None,early_emit_severity:int=None,
+                 priority_scheduler=None,report_index=None):
         """
         This method initilizes the EnrichmentService by
-        setting the headers, and setting its base urlt
+        creating its VirusTotal client
+
+        Parameters:
+        verdict_cache (VerdictCache): optional cache of verdicts in front of VirusTotal,
+        None to query VirusTotal for every IoC.
+        max_workers (int): how many VirusTotal lookups analyze_alerts runs in parallel, 1 runs them one by one.
+        rate_limiter (RateLimiter): optional limiter that keeps the lookups inside the VirusTotal quotas.
+        virustotal_client (VirusTotalClient): the client to query VirusTotal with,
+        None to create one from the .env file with a connection for every worker.
+        report_sink (ReportSink): optional sink that buffers the reports and writes them in groups,
+        None to save every report to its own json file right away.
+        local_index (LocalIndex): optional blocklist/allowlist consulted before VirusTotal,
+        None to resolve every IoC remotely.
+        metrics (MetricsRegistry): registry of the pipeline metrics, None for no metrics.
+        bulk_size (int): how many IoCs analyze_alerts looks up in one VirusTotal search request,
+        0 or 1 to look up every IoC on its own.
+        scoring_policy (ScoringPolicy): how the severity of an alert is calculated from its IoCs,
+        None for the percentage of malicious IoCs.
+        early_emit_severity (int): analyze_alerts saves a partial report of an alert as soon as its severity
+        reaches this value while some of its lookups are still running, None to only save complete reports.
+        priority_scheduler (PriorityScheduler): the order of the lookups of a batch and when an alert stops its lookups,
+        None to look up every IoC, alerts with more IoCs first.
+        report_index (ReportIndex): optional index of the saved reports by IoC, severity and time, updated as they are saved.
         """
-        self.headers = {"x-apikey":os.getenv("VIRUSTOTAL_API_KEY")}
-        self.base_url = "https://www.virustotal.com/api/v3/ip_addresses/"
+        self.verdict_cache = verdict_cache
+        self.max_workers = max(1,max_workers)
+        self.rate_limiter = rate_limiter
+        if virustotal_client is None:
+            # Get the VirusTotal settings from the .env file
+            load_env()
+            virustotal_client = VirusTotalClient.from_env(pool_size=self.max_workers,rate_limiter=rate_limiter)
+        self.virustotal_client = virustotal_client
+        # Concurrent lookups of the same IoC share one VirusTotal call
+        self.coalescer = RequestCoalescer()
+        self.last_batch_stats = {}
+        self.alerts_analyzed = 0
+        # Number of malformed IoCs that were not sent to VirusTotal
+        self.rejected_iocs = 0
+        self.report_sink = report_sink
+        self.report_index = report_index
+        # AlertIds of the reports that could not be saved, see take_unsaved_alert_ids
+        self._unsaved_alert_ids = set()
+        self._unsaved_lock = threading.Lock()
+        # Set by main when the hot IoCs are refreshed ahead of their expiry, see CacheRefresher
+        self.cache_refresher = None
+        self.local_index = local_index
+        self.metrics = metrics if metrics is not None else DISABLED_METRICS
+        self.lookup_seconds = self.metrics.histogram("virustotal_lookup_seconds",
+                                                     "Duration of a VirusTotal lookup, retries and rate limit waits included")
+        self.verdicts = self.metrics.counter("ioc_verdicts_total", "IoC verdicts by where they came from", ("source",))
+        self.severity = self.metrics.histogram("alert_severity", "Severity of the analyzed alerts", buckets=SEVERITY_BUCKETS)
+        self.report_write_seconds = self.metrics.histogram("report_write_seconds", "Time to save (or buffer) a report")
+        self.report_flush_seconds = self.metrics.histogram("report_flush_seconds", "Time to flush the buffered reports")
+        self.bulk_size = bulk_size
+        # Set when VirusTotal refuses the bulk searches, the IoCs are looked up on their own from then on
+        self.bulk_refused = False
+        self.scoring_policy = scoring_policy if scoring_policy is not None else BinaryPolicy()
+        self.early_emit_severity = early_emit_severity
+        self.priority_scheduler = priority_scheduler if priority_scheduler is not None else PriorityScheduler()
+        self.skipped_lookups = self.metrics.counter("lookups_skipped_total", "Lookups skipped because their alerts were decided")
+        self.early_reports = self.metrics.counter("early_reports_total", "Partial reports saved before all the lookups of their alert finished")
+        self.bulk_iocs = self.metrics.counter("virustotal_bulk_iocs_total",
+                                              "IoCs sent in bulk lookups, by whether the bulk answer had them", ("outcome",))
         logger.info("EnrichmentService initialized successfully\n")
 
-    def query_virustotal(self,ioc:str)->dict:
+    def query_virustotal(self,ioc:str,ioc_type:str=None,background:bool=False)->dict:
         """
         This method query VirusTotal API for the given IoC and return the full JSON response.
+        The IoC is sent to the endpoint of its type (ip address, domain, url or file hash).
 
         Parameters:
         ioc (str)
+        ioc_type (str): the type of the IoC, None to classify it here.
+        background (bool): the caller already took the budget of the request, it is sent once without waiting
+        for the rate limiter (see VirusTotalClient.get_json).
 
         Returns:
         a json repsonse dictionary from querying VirusTotal
         """
-        # Add the specific ioc to the base url
-        url = self.base_url + ioc 
+        if ioc_type is None:
+            ioc_type = classify_ioc(ioc)
+        # A malformed IoC would be a guaranteed failure, do not spend quota on it
+        if ioc_type is None:
+            self.rejected_iocs += 1
+            logger.error(f"Not querying VirusTotal for malformed IoC {ioc!r}")
+            return {}
 
-        # Try query the VirusTotal api, if successful then return the response,json()
+        # Try query the VirusTotal api, if successful then return the json response.
+        # The client retries server errors and connection errors by itself.
         try:
-            response = requests.get(url,headers=self.headers)
-
-            # Raise error if bad response status code
-            response.raise_for_status() 
-            return response.json()
+            with self.lookup_seconds.time():
+                if background:
+                    return self.virustotal_client.get_json(virustotal_path(ioc,ioc_type),background=True)
+                return self.virustotal_client.get_json(virustotal_path(ioc,ioc_type))
         
         # If query is not successful, logs an error message, and return an empty dict
         except Exception as e:
             logger.error(f"Failed to query VirusTotal for {ioc} becasue of: {e}")
             return {}
         
+    def query_virustotal_bulk(self,iocs:list,ioc_types:dict)->dict:
+        """
+        This method looks up several IoCs with one VirusTotal search request and maps the found objects back to the IoCs.
+
+        Parameters:
+        iocs (list): well-formed IoCs.
+        ioc_types (dict): the type of every IoC.
+
+        Returns:
+        dict of IoC -> json response in the form of a single lookup, for the IoCs the search found.
+        None if the search request failed. The client already retried the transient failures (server errors,
+        connection errors and 429), a 401 or 403 turns the bulk lookups off for good, see bulk_refused.
+        """
+        keys = {}
+        for ioc in iocs:
+            for key in ioc_match_keys(ioc,ioc_types[ioc]):
+                keys.setdefault(key,ioc)
+        query = " OR ".join(virustotal_search_term(ioc,ioc_types[ioc]) for ioc in iocs)
+        try:
+            with self.lookup_seconds.time():
+                json_response = self.virustotal_client.get_json(VIRUSTOTAL_SEARCH_PATH,params={"query":query,"limit":len(iocs)})
+        except Exception as e:
+            status_code = getattr(getattr(e,"response",None),"status_code",None)
+            if status_code in BULK_REFUSED_STATUS_CODES:
+                self.bulk_refused = True
+                logger.warning(f"VirusTotal refused the bulk lookup with HTTP {status_code}, looking up every IoC on its own from now on")
+            else:
+                logger.error(f"Failed to look up {len(iocs)} IoCs in bulk because of: {e}")
+            return None
+
+        responses = {}
+        for virustotal_object in json_response.get("data") or []:
+            for key in virustotal_object_keys(virustotal_object):
+                ioc = keys.get(key)
+                if ioc is not None:
+                    responses.setdefault(ioc,{"data":virustotal_object})
+        return responses
+
     def is_ioc_malicious_from_response (self,json_response:dict) ->bool:
         """
         This method takes the response from the api call and determine
@@ -79,7 +196,129 @@ class EnrichmentService:
         except Exception as e:
             logger.error(f"failed to determine if malicious or not: {e}")
             return False
+
+    def get_ioc_verdict(self,ioc:str,ioc_type:str=None,use_cache:bool=True)->bool:
+        """
+        This method returns whether the IoC is malicious, using the verdict cache
+        when there is one and querying VirusTotal only on a cache miss.
+
+        Parameters:
+        ioc (str)
+        ioc_type (str): the type of the IoC, None to classify it when it is queried.
+        use_cache (bool): look in the verdict cache first, False when the caller already did.
+
+        Returns:
+        True if ioc is malicious, False otherwise
+        """
+        return self.get_ioc_record(ioc=ioc,ioc_type=ioc_type,use_cache=use_cache).is_malicious
+
+    def get_ioc_record(self,ioc:str,ioc_type:str=None,use_cache:bool=True)->IocRecord:
+        """
+        This method resolves the IoC like get_ioc_verdict, and returns its record
+        with the engine counts of the VirusTotal report when it was looked up.
+
+        Parameters:
+        ioc (str)
+        ioc_type (str): the type of the IoC, None to classify it when it is queried.
+        use_cache (bool): look in the verdict cache first, False when the caller already did.
+
+        Returns:
+        the IocRecord of the IoC
+        """
+        if use_cache and self.verdict_cache is not None:
+            verdict = self._cached_verdict(ioc,ioc_type)
+            if verdict is not None:
+                self.verdicts.labels(SOURCE_CACHE).inc()
+                return IocRecord(ioc,ioc_type,verdict == VERDICT_MALICIOUS,SOURCE_CACHE,time.time(),failed=verdict == VERDICT_FAILED)
+
+        # If the same IoC is already being looked up, wait for that lookup instead of sending another
+        return self.coalescer.run(ioc,lambda: self._lookup_ioc_record(ioc,ioc_type))
+
+    def resolve_ioc(self,ioc:str,ioc_type:str=None)->IocRecord:
+        """
+        This method resolves the IoC without a VirusTotal lookup if it can:
+        from the local lists when they know the IoC, then from the verdict cache.
+
+        Parameters:
+        ioc (str)
+        ioc_type (str): the type of the IoC, None to classify it when needed.
+
+        Returns:
+        the IocRecord of the IoC, or None if it has to be looked up in VirusTotal
+        """
+        if self.local_index is not None:
+            verdict = self.local_index.lookup(ioc,ioc_type)
+            if verdict is not None:
+                self.verdicts.labels(SOURCE_LOCAL).inc()
+                return IocRecord(ioc,ioc_type,verdict == VERDICT_MALICIOUS,SOURCE_LOCAL,time.time())
+        if self.verdict_cache is not None:
+            verdict = self._cached_verdict(ioc,ioc_type)
+            if verdict is not None:
+                self.verdicts.labels(SOURCE_CACHE).inc()
+                return IocRecord(ioc,ioc_type,verdict == VERDICT_MALICIOUS,SOURCE_CACHE,time.time(),failed=verdict == VERDICT_FAILED)
+        return None
+
+    def _cached_verdict(self,ioc:str,ioc_type:str=None)->str:
+        """
+        This method returns the cached verdict of the IoC, None on a miss, and counts the lookup for the cache refresher.
+        """
+        verdict = self.verdict_cache.get(ioc)
+        if self.cache_refresher is not None:
+            self.cache_refresher.record_access(ioc,ioc_type,hit=verdict is not None)
+        return verdict
+
+    def _remote_record(self,ioc:str,ioc_type:str=None)->IocRecord:
+        """
+        This method looks the IoC up in VirusTotal (the cache was already checked) and returns its record.
+        """
+        return self.get_ioc_record(ioc=ioc,ioc_type=ioc_type,use_cache=False)
+
+    def _lookup_ioc_record(self,ioc:str,ioc_type:str=None)->IocRecord:
+        """
+        This method queries VirusTotal for the IoC, caches the verdict and returns the record.
+        """
+        json_response = self.query_virustotal(ioc=ioc,ioc_type=ioc_type)
+        self.verdicts.labels(SOURCE_REMOTE).inc()
+        is_malicious = self.is_ioc_malicious_from_response(json_response=json_response)
+
+        if self.verdict_cache is not None:
+            # An empty response means the query failed, cache it shortly so it is retried soon
+            if not json_response:
+                verdict = VERDICT_FAILED
+            else:
+                verdict = VERDICT_MALICIOUS if is_malicious else VERDICT_CLEAN
+            self.verdict_cache.set(ioc,verdict)
+        return IocRecord(ioc,ioc_type,is_malicious,SOURCE_REMOTE,time.time(),analysis_stats(json_response),failed=not json_response)
         
+    def _bulk_records(self,iocs:list,ioc_types:dict)->dict:
+        """
+        This method looks the IoCs up in bulks of bulk_size and caches their verdicts.
+        The IoCs that are malformed, or that a bulk did not answer for, are left for single lookups.
+
+        Returns:
+        dict of IoC -> IocRecord, for the IoCs resolved in bulk
+        """
+        well_formed = [ioc for ioc in iocs if ioc_types[ioc] is not None]
+        records = {}
+        for start in range(0,len(well_formed),self.bulk_size):
+            chunk = well_formed[start:start+self.bulk_size]
+            if self.bulk_refused:
+                self.bulk_iocs.labels("fallback").inc(len(well_formed) - start)
+                break
+            responses = self.query_virustotal_bulk(chunk,ioc_types)
+            if responses is None:
+                self.bulk_iocs.labels("fallback").inc(len(chunk))
+                continue
+            self.bulk_iocs.labels("resolved").inc(len(responses))
+            self.bulk_iocs.labels("fallback").inc(len(chunk) - len(responses))
+            for ioc,json_response in responses.items():
+                is_malicious = self.is_ioc_malicious_from_response(json_response=json_response)
+                self.verdicts.labels(SOURCE_REMOTE).inc()
+                if self.verdict_cache is not None:
+                    self.verdict_cache.set(ioc,VERDICT_MALICIOUS if is_malicious else VERDICT_CLEAN)
+                records[ioc] = IocRecord(ioc,ioc_types[ioc],is_malicious,SOURCE_REMOTE,time.time(),analysis_stats(json_response))
+        return records
+
     def analyze_response(self,alert:Alert)->dict:
         """
         This method analyze each Ioc in the alert using VirusTotal and calculate severity.
@@ -90,30 +329,210 @@ class EnrichmentService:
         Returns:
         dict: report containing alert ID, severity score, and IoC analysis.
         """
-        malicious_counter = 0
-        results = []
-        for ioc in alert.ioc:
-            # Get response for the current IoC
-            json_response = self.query_virustotal(ioc=ioc) 
-            is_malicious = self.is_ioc_malicious_from_response(json_response=json_response)
-            results.append({
-                "IoCs":ioc,
-                "IsMalicious":is_malicious
-                })
-            if is_malicious:
-                # Increase the malicious iocs counts.
-                malicious_counter += 1 
-
-        # Calculate severity as a percentage of malicious IoCs
-        severity = int((malicious_counter/len(alert.ioc)) * 100) if alert.ioc else 0
+        # Resolve each IoC one after another, an IoC that repeats in the alert is resolved once
+        records_by_ioc = {}
+        for index,ioc in enumerate(alert.ioc):
+            if ioc not in records_by_ioc:
+                ioc_type = alert.ioc_type(index)
+                records_by_ioc[ioc] = self.resolve_ioc(ioc,ioc_type) or self._remote_record(ioc,ioc_type)
+        return self.build_report(alert=alert,records=[records_by_ioc[ioc] for ioc in alert.ioc])
+
+    def analyze_alerts(self,alerts:list,on_report=None)->list:
+        """
+        This method analyze a whole batch of alerts. With a bulk_size the IoCs of the whole batch are
+        first looked up in bulks, and the lookups of the IoCs left
+        run in parallel on a bounded thread pool of max_workers threads, the reports are
+        the same as the ones analyze_response creates. An IoC that appears several times
+        in the batch is looked up once, and the number of saved lookups is kept in last_batch_stats.
+        The lookups run in the order of the priority scheduler, and the IoCs of alerts it decided are skipped.
+
+        Parameters:
+        alerts (list): list of Alert objects.
+        on_report (callable): called with the report of every alert as soon as the alert is done,
+        None to only return the reports.
+
+        Returns:
+        list of reports, in the same order as the alerts.
+        """
+        # Every IoC is resolved once for the whole batch, and its record is shared by all the alerts that contain it
+        occurrences = 0
+        ioc_types = {}
+        for alert in alerts:
+            occurrences += len(alert.ioc)
+            for index,ioc in enumerate(alert.ioc):
+                if ioc not in ioc_types:
+                    ioc_types[ioc] = alert.ioc_type(index)
+        coalesced_before = self.coalescer.stats()["coalesced"]
+
+        # The IoCs the local lists or the cache know are resolved right away, only the others go to VirusTotal
+        records_by_ioc = {}
+        remote_iocs = []
+        resolved_locally = 0
+        for ioc,ioc_type in ioc_types.items():
+            record = self.resolve_ioc(ioc,ioc_type)
+            if record is None:
+                remote_iocs.append(ioc)
+            else:
+                records_by_ioc[ioc] = record
+                resolved_locally += record.source == SOURCE_LOCAL
+
+        # Look the rest up in bulk when it saves requests, whatever the bulks miss is looked up on its own
+        resolved_in_bulk = 0
+        if self.bulk_size > 1 and not self.bulk_refused and len(remote_iocs) > 1:
+            bulk_records = self._bulk_records(remote_iocs,ioc_types)
+            records_by_ioc.update(bulk_records)
+            remote_iocs = [ioc for ioc in remote_iocs if ioc not in bulk_records]
+            resolved_in_bulk = len(bulk_records)
+
+        # Every alert keeps a running score, updated as the verdicts of its IoCs arrive
+        scores,pending_scores = self._start_scores(alerts,records_by_ioc)
+        reports_by_score = {}
+        for score in scores:
+            self._alert_progress(score,reports_by_score,on_report)
+        lookups = self.priority_scheduler.order_lookups(scores,pending_scores)
+        skipped_lookups = self._run_lookups(lookups,ioc_types,records_by_ioc,pending_scores,reports_by_score,on_report)
+        reports = [reports_by_score[id(score)] for score in scores]
+
+        # Lookups saved by the batch deduplication plus the ones that joined an in-flight call
+        coalesced = self.coalescer.stats()["coalesced"] - coalesced_before
+        self.last_batch_stats = {
+            "iocs":occurrences,
+            "unique_iocs":len(ioc_types),
+            "saved_calls":occurrences - len(ioc_types) + coalesced,
+            "resolved_locally":resolved_locally,
+            "resolved_in_bulk":resolved_in_bulk,
+            "skipped_lookups":skipped_lookups,
+            }
+        return reports
+
+    def _start_scores(self,alerts:list,records_by_ioc:dict)->tuple:
+        """
+        This method starts the running score of every alert from the IoCs already resolved.
+
+        Returns:
+        (list of the AlertScore of every alert, dict of IoC -> AlertScores waiting for its verdict)
+        """
+        scores = []
+        pending_scores = {}
+        for alert in alerts:
+            score = AlertScore(alert,self.scoring_policy)
+            # An IoC repeated in the alert is added once, at all its positions
+            for ioc in dict.fromkeys(alert.ioc):
+                record = records_by_ioc.get(ioc)
+                if record is not None:
+                    score.add(record)
+                else:
+                    pending_scores.setdefault(ioc,[]).append(score)
+            scores.append(score)
+        return scores,pending_scores
+
+    def _run_lookups(self,lookups:list,ioc_types:dict,records_by_ioc:dict,pending_scores:dict,reports_by_score:dict,on_report)->int:
+        """
+        This method looks the IoCs up in the given order, up to max_workers at a time. The next IoC is picked
+        only when a lookup finishes, so an IoC whose alerts were all decided meanwhile is skipped.
+
+        Returns:
+        the number of skipped lookups
+        """
+        lookups = iter(lookups)
+        skipped = 0
+
+        def next_lookup():
+            nonlocal skipped
+            for ioc in lookups:
+                if all(score.complete for score in pending_scores[ioc]):
+                    skipped += 1
+                    self.skipped_lookups.inc()
+                    continue
+                return ioc
+            return None
+
+        def verdict_arrived(ioc,record):
+            records_by_ioc[ioc] = record
+            for score in pending_scores.pop(ioc):
+                score.add(record)
+                self._alert_progress(score,reports_by_score,on_report)
+
+        if self.max_workers == 1:
+            ioc = next_lookup()
+            while ioc is not None:
+                verdict_arrived(ioc,self._remote_record(ioc,ioc_types[ioc]))
+                ioc = next_lookup()
+            return skipped
+
+        with ThreadPoolExecutor(max_workers=self.max_workers,thread_name_prefix="enrichment") as executor:
+            running = {}
+            while True:
+                # Keep every worker busy, in priority order
+                while len(running) < self.max_workers:
+                    ioc = next_lookup()
+                    if ioc is None:
+                        break
+                    running[executor.submit(self._remote_record,ioc,ioc_types[ioc])] = ioc
+                if not running:
+                    return skipped
+                # Take the verdicts in the order they finish, not the slowest first
+                done,_ = wait(running,return_when=FIRST_COMPLETED)
+                for future in done:
+                    verdict_arrived(running.pop(future),future.result())
+
+    def _alert_progress(self,score:AlertScore,reports_by_score:dict,on_report):
+        """
+        This method acts on the running score of an alert after its IoCs were (partly) resolved:
+        a decided alert takes the IoCs it still waits for as skipped, a complete alert gets its report
+        (handed to on_report right away), and an incomplete one may get an early partial report.
+        """
+        if self.priority_scheduler.is_decided(score):
+            now = time.time()
+            for index,record in enumerate(score.records):
+                if record is None:
+                    score.add(IocRecord(score.alert.ioc[index],score.alert.ioc_type(index),False,SOURCE_SKIPPED,now))
+        if score.complete:
+            if id(score) not in reports_by_score:
+                report = self.build_report(alert=score.alert,records=score.records)
+                reports_by_score[id(score)] = report
+                if on_report is not None:
+                    on_report(report)
+        elif self.early_emit_severity is not None:
+            self._emit_early_report(score)
+
+    def _emit_early_report(self,score:AlertScore):
+        """
+        This method saves the partial report of the alert the first time its severity reaches early_emit_severity
+        while some of its IoCs are still being looked up.
+        """
+        if score.emitted or score.severity < self.early_emit_severity:
+            return
+        score.emitted = True
+        self.save_report_to_file(report=score.to_partial_report())
+        # The point of a partial report is to be seen before the batch ends
+        self.flush_reports()
+        self.early_reports.inc()
+        logger.info(f"alert {score.alert.id} reached severity {score.severity} with {score.resolved}/{len(score.records)} IoCs resolved, partial report saved")
+
+    def build_report(self,alert:Alert,records:list)->dict:
+        """
+        This method calculate the severity of the alert from the records of its IoCs and build the report.
+
+        Parameters:
+        alert (Alert): Alert object with a list of Iocs.
+        records (list): IocRecord of every IoC in alert.ioc, in the same order.
+
+        Returns:
+        dict: report containing alert ID, severity score, and IoC analysis.
+        """
+        # Calculate severity with the scoring policy, by default the percentage of malicious IoCs
+        score = AlertScore(alert,self.scoring_policy)
+        for record in records:
+            score.add(record)
+        severity = score.severity
         # Beside updating the severity in the report, also updating the alert.
         alert.severity = severity 
-        report={
-            "AlertId":alert.id,
-            "Severity":severity,
-            "IoCs":results
-            }
-        return report
+        alert.records = records
+        self.alerts_analyzed += 1
+        self.severity.observe(severity)
+        # The report is serialized straight from the records
+        return alert.to_report()
     
     def save_report_to_file(self,report:dict):
         """
@@ -126,6 +545,16 @@ class EnrichmentService:
         Returns:
         None
         """
+        with self.report_write_seconds.time():
+            self._save_report(report)
+
+    def _save_report(self,report:dict):
+        # With a sink the report is buffered and written together with other reports
+        if self.report_sink is not None:
+            self.report_sink.write(report)
+            self._index_report(report)
+            return
+
         #Get the current time
         timestamp = get_current_time() 
 
@@ -144,9 +573,48 @@ class EnrichmentService:
             logger.info(f"report saved to {name_of_file}")
         except Exception as e:
             logger.error(f"Failed to save report to file: {e}")
+            with self._unsaved_lock:
+                self._unsaved_alert_ids.add(report.get("AlertId"))
+            return
+        self._index_report(report,location=name_of_file)
 
+    def _index_report(self,report:dict,location:str=None):
+        if self.report_index is None:
+            return
+        # The report is saved already, a failure of the index must not lose it
+        try:
+            self.report_index.add(report,location=location)
+        except Exception as e:
+            logger.error(f"Failed to index report {report.get('AlertId')}: {e}")
 
+    def flush_reports(self,durable:bool=False):
+        """
+        This method writes the reports still buffered in the report sink, if there is one.
 
+        Parameters:
+        durable (bool): also fsync the written reports.
 
+        Returns:
+        None
+        """
+        if self.report_sink is not None:
+            with self.report_flush_seconds.time():
+                self.report_sink.flush(durable=durable)
+            failed = self.report_sink.take_failed()
+            if failed:
+                with self._unsaved_lock:
+                    self._unsaved_alert_ids.update(failed)
+        if self.report_index is not None:
+            self.report_index.flush()
+
+    def take_unsaved_alert_ids(self)->set:
+        """
+        This method returns the ids of the alerts whose reports could not be saved since the last call
+        (call it after flush_reports), their messages must not be acknowledged so they are processed again.
 
-        
\ No newline at end of file
+        Returns:
+        set of alert ids
+        """
+        with self._unsaved_lock:
+            unsaved, self._unsaved_alert_ids = self._unsaved_alert_ids, set()
+        return unsaved
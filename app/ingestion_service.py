@@ -1,85 +1,166 @@
 from app.alert import Alert
-from google.cloud import pubsub_v1
+from app.ack_manager import AckManager
+from app.message_parser import MessageParser
+from app.metrics import DISABLED_METRICS, SIZE_BUCKETS
 import os
+import queue
 import logging
-from google.api_core.exceptions import DeadlineExceeded
+import importlib
+import threading
+from collections.abc import Mapping
 
 # Number of messages to pull at once. There is a trade off here: using big numbers might
 # Cause the crash of many messages becusae of 1 bad message, and using smaller numbers makes more calls to the API.
 MAX_MESSAGES = 10 
 
+# Flow control of the streaming pull: the most messages (and bytes) leased by the subscriber
+# and not acknowledged yet. Beyond it the subscriber stops delivering until messages are acked.
+MAX_OUTSTANDING_MESSAGES = 100
+MAX_OUTSTANDING_BYTES = 10 * 1024 * 1024
+# Seconds a streaming callback waits for room in the spool (or the work queue) before it checks
+# whether the streaming pull is being stopped.
+CALLBACK_POLL_SECONDS = 0.5
+
+# Message attribute with the priority of the alert, see PriorityScheduler
+PRIORITY_ATTRIBUTE = "priority"
+
 # Get the logger set up 
 logger = logging.getLogger(__name__)
 
 
+def _pubsub_v1():
+    """
+    This function imports the Pub/Sub client library on first use instead of at import time,
+    it is the slowest import of the application (grpc and protobuf come with it).
+
+    Returns:
+    the google.cloud.pubsub_v1 module
+    """
+    return importlib.import_module("google.cloud.pubsub_v1")
+
+
+def __getattr__(name: str):
+    # Keep app.ingestion_service.pubsub_v1 available, e.g. to patch the client in tests
+    if name == "pubsub_v1":
+        return _pubsub_v1()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def message_priority(message) -> int:
+    """
+    This function returns the priority of the alert from the attributes of its pub/sub message.
+
+    Parameters:
+    message: the pub/sub message (a PubsubMessage, or a streaming pull Message).
+
+    Returns:
+    the value of the priority attribute, 0 if the message has none or it is not a number
+    """
+    attributes = getattr(message, "attributes", None)
+    if not isinstance(attributes, Mapping):
+        return 0
+    try:
+        return int(attributes.get(PRIORITY_ATTRIBUTE, 0))
+    except (TypeError, ValueError):
+        logger.warning(f"ignoring the invalid priority attribute {attributes.get(PRIORITY_ATTRIBUTE)!r}")
+        return 0
+
+
 class IngestionService:
     """
     This class is the service to authenticate with GCP using the service account key path,
     and  pull messages containing lists of IoCs from Pub/Sub transform them into predefined Alert objects, 
     and acknowledge the pub/sub when messages received.
     """
-    def __init__(self, subscription_name:str, service_account_path:str):
+    def __init__(self, subscription_name:str, service_account_path:str, ack_after_report:bool=False, subscriber=None,
+                 metrics=None, spool=None, message_parser=None):
         """
         This method initializes the IngestionService by configuring authentication with GCP,
-        setting the subscription name, and creating a Pub/Sub subscriber client.
+        setting the subscription name, and preparing the Pub/Sub subscriber client (created on first use).
+
+        Parameters:
+        subscription_name (str)
+        service_account_path (str)
+        ack_after_report (bool): acknowledge a message only after the report of its alert is saved
+        (see acknowledge_alerts), so a crash mid-enrichment lets pub/sub redeliver it.
+        False acknowledges the messages as soon as they are transformed to alerts.
+        subscriber: the subscriber client to use (e.g. a fake one for benchmarks), None to create a Pub/Sub subscriber client.
+        metrics (MetricsRegistry): registry of the pipeline metrics, None for no metrics.
+        spool (SpoolQueue): durable queue the messages are written to before they are acknowledged,
+        None to hand them to enrichment directly.
+        message_parser (MessageParser): how the message data is turned into IoCs, None for no size or IoC caps.
         """
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = service_account_path
         self.subscription_name = subscription_name 
 
-        # Create a pub/sub subscriber client 
-        self.subscriber = pubsub_v1.SubscriberClient() 
+        # The pub/sub subscriber client is created on first use, see the subscriber property
+        self._subscriber = subscriber
+        self.streaming_pull_future = None
+        # Set by stop_streaming, the callbacks waiting for room give their messages back to pub/sub
+        self._streaming_stopped = threading.Event()
+        self.ack_after_report = ack_after_report
+        self.spool = spool
+        self.message_parser = message_parser if message_parser is not None else MessageParser(metrics=metrics)
+        # Number of malformed IoCs dropped before enrichment
+        self.rejected_iocs = 0
+        metrics = metrics if metrics is not None else DISABLED_METRICS
+        self.pull_seconds = metrics.histogram("pull_seconds", "Duration of the Pub/Sub pull RPCs")
+        self.pull_size = metrics.histogram("pull_size_messages", "Messages returned by a Pub/Sub pull", buckets=SIZE_BUCKETS)
+        self.decode_seconds = metrics.histogram("message_decode_seconds", "Time to decode and classify a message")
+        self.malformed_messages = metrics.counter("malformed_messages_total", "Messages that could not become alerts")
+        self.rejected_iocs_counter = metrics.counter("rejected_iocs_total", "Malformed IoCs dropped at ingestion")
+        # Acknowledgements are batched, one RPC for many messages
+        self.ack_manager = AckManager(subscriber=subscriber, subscription_name=subscription_name)
 
         logger.info("IngestiontService initialized successfully")
 
+    @property
+    def subscriber(self):
+        """
+        The subscriber client, a Pub/Sub subscriber client is created the first time it is needed.
+        """
+        if self._subscriber is None:
+            self.subscriber = _pubsub_v1().SubscriberClient()
+        return self._subscriber
+
+    @subscriber.setter
+    def subscriber(self, subscriber):
+        self._subscriber = subscriber
+        # The acknowledgements are sent with the same client
+        self.ack_manager.subscriber = subscriber
 
-    def pull_messages(self,timeout: float=10.0) -> list:
+
+    def pull_messages(self,timeout: float=10.0,max_messages: int=None) -> list:
         """
         This method pull messages using the subscriber, and return the messages list
         Parameters: 
-       
+        timeout (float): seconds to wait for the pull response.
+        max_messages (int): most messages to pull, MAX_MESSAGES if not given.
 
         Returns:
         list of received messages
         """
         # Try pull, if successful then return the meesages.
         try:
-            response = self.subscriber.pull(
-                request={"subscription":self.subscription_name,"max_messages":MAX_MESSAGES},
-                timeout=timeout
-                )
+            with self.pull_seconds.time():
+                response = self.subscriber.pull(
+                    request={"subscription":self.subscription_name,"max_messages":max_messages or MAX_MESSAGES},
+                    timeout=timeout
+                    )
+            self.pull_size.observe(len(response.received_messages))
             return response.received_messages
         
-        except DeadlineExceeded:
-            logger.info("Deadline Exceeded.")
-            return []
-        # If pull failed, logs an error message, and return an empty list to avoid crash the app
         except Exception as e:
+            # Imported here, like the client library, so importing the service stays cheap
+            from google.api_core.exceptions import DeadlineExceeded
+            if isinstance(e, DeadlineExceeded):
+                logger.info("Deadline Exceeded.")
+                return []
+            # If pull failed, logs an error message, and return an empty list to avoid crash the app
             logger.error(f"failed to pull messages: {e}")
             return []
         
     
-    def acknowledge_message_received(self,received_message:str):
-        """
-        This method gets a message in its argument and acknowledges 
-        the pub/sub that the message has received.
-
-        Parameters:
-        received_message(str): the message received from transform_messages_to_alerts
-
-        Returns:
-        None
-        """
-        # Try acknowledge
-        try:
-            self.subscriber.acknowledge(request=
-            {"subscription":self.subscription_name,
-             "ack_ids":[received_message.ack_id]
-             })
-        # If not successful, then logs an error message
-        except Exception as e:
-            logger.error(f"failed to acknowledge message: {e}")
-
-    
     def transform_messages_to_alerts(self, received_messages:list) ->list:
         """
         This method gets the received messages list in its argument, 
@@ -95,27 +176,196 @@ class IngestionService:
         alerts = []
         for received_message in received_messages:
             try:
-                # Decode the data to make it strings and not bytes
-                data = received_message.message.data.decode("utf-8") 
-
-                # Split iocs by blank line as the assignment says.
-                ioc = data.strip().split("\n") 
-                # Transform the message data to an alert object with the ioc list passed in the argument
-                alert = Alert(ioc) 
+                # Transform the message data to an alert object
+                alert = self.message_data_to_alert(received_message.message.data)
+                alert.ack_id = received_message.ack_id
+                alert.priority = message_priority(received_message.message)
                 alerts.append(alert) 
-                # Acknowledge pub/sub that the message has received. 
-                self.acknowledge_message_received(received_message=received_message)
-
             # Account for malformed messages that cannot be processed to Alert objects
             except Exception as e:
-                logger.error("Failed to transromed message to an Alert:{e}")
-            # Even for the malformed message, acknowledge pub/sub that the message has received. 
-            finally:
-                self.acknowledge_message_received(received_message=received_message)
-            
+                logger.error(f"Failed to transromed message to an Alert:{e}")
+                self.malformed_messages.inc()
+                # Acknowledge the malformed message, pub/sub redelivering it will not fix it
+                self.ack_manager.ack(received_message.ack_id)
+                continue
+
+            if self.ack_after_report:
+                # Keep the message leased until its report is saved
+                self.ack_manager.track(received_message.ack_id)
+            else:
+                # Acknowledge pub/sub that the message has received. 
+                self.ack_manager.ack(received_message.ack_id)
+
+        # Send the acknowledgements of the whole pull in one RPC
+        self.ack_manager.flush()
         return alerts      
 
-        
+    def spool_messages(self, received_messages:list) -> int:
+        """
+        This method writes the data of the received messages to the spool, and acknowledges them
+        once they are durable. If the spool cannot be written the messages are not acknowledged,
+        and pub/sub redelivers them.
 
+        Parameters:
+        received_messages (list): the list of received messages from pulling the messages
 
+        Returns:
+        number of messages spooled
+        """
+        if not received_messages:
+            return 0
+        try:
+            self.spool.put_many([received_message.message.data for received_message in received_messages])
+        except Exception as e:
+            logger.error(f"Failed to spool {len(received_messages)} message(s), leaving them to pub/sub: {e}")
+            return 0
+        for received_message in received_messages:
+            self.ack_manager.ack(received_message.ack_id)
+        self.ack_manager.flush()
+        return len(received_messages)
+
+    def acknowledge_alerts(self, alerts:list, unsaved_alert_ids:set=None):
+        """
+        This method acknowledges the messages of alerts whose reports were saved, and gives the messages
+        of the alerts whose reports could not be saved back to pub/sub so they are redelivered.
+        It only does something when the service acknowledges after the report is saved.
+
+        Parameters:
+        alerts (list): list of Alert objects.
+        unsaved_alert_ids (set): ids of the alerts whose reports could not be saved
+        (see EnrichmentService.take_unsaved_alert_ids), None if all were saved.
+
+        Returns:
+        None
+        """
+        if not self.ack_after_report:
+            return
+        unsaved_alert_ids = unsaved_alert_ids or set()
+        nacks = []
+        for alert in alerts:
+            if alert.ack_id is None:
+                continue
+            if alert.id in unsaved_alert_ids:
+                nacks.append(alert.ack_id)
+            else:
+                self.ack_manager.ack(alert.ack_id)
+        self.ack_manager.flush()
+        if nacks:
+            logger.error(f"{len(nacks)} report(s) could not be saved, their messages are left to pub/sub")
+            self.ack_manager.nack(nacks)
+
+    def message_data_to_alert(self, data:bytes) -> Alert:
+        """
+        This method transforms the data of a single message to an Alert object.
+        Every IoC is classified once here, malformed IoCs are dropped (and counted in rejected_iocs)
+        so they never cost a VirusTotal lookup, and IoCs repeated in the message are kept once.
+
+        Parameters:
+        data (bytes): the message data, IoCs separated by new lines.
+
+        Returns:
+        Alert
+
+        Raises:
+        UnicodeDecodeError if the data is not valid utf-8
+        ValueError if the data is bigger than the message size cap
+        """
+        with self.decode_seconds.time():
+            return self._message_data_to_alert(data)
+
+    def _message_data_to_alert(self, data:bytes) -> Alert:
+        ioc = []
+        ioc_types = []
+        # The IoCs are parsed line by line from the raw bytes, see MessageParser
+        for value, ioc_type in self.message_parser.iter_iocs(data, on_rejected=self._reject_ioc):
+            ioc.append(value)
+            ioc_types.append(ioc_type)
+        return Alert(ioc, ioc_types=ioc_types)
+
+    def _reject_ioc(self, value:str):
+        self.rejected_iocs += 1
+        self.rejected_iocs_counter.inc()
+        logger.warning(f"rejected malformed IoC: {value!r}")
 
+    def start_streaming(self, work_queue, max_outstanding_messages:int=MAX_OUTSTANDING_MESSAGES,
+                        max_outstanding_bytes:int=MAX_OUTSTANDING_BYTES):
+        """
+        This method starts a streaming pull on the subscription. The subscriber delivers messages
+        continuously on its own threads, each message is transformed to an Alert and put on the
+        work queue together with the message, which the consumer acknowledges after saving the report.
+        When the work queue is full the callbacks wait, and the flow control stops new deliveries.
+        With a spool the messages are written to the spool instead, and acknowledged once they are durable.
+        A callback still waiting for room when the streaming pull is stopped nacks its message.
+
+        Parameters:
+        work_queue (queue.Queue): bounded queue of (alert, message) tuples, not used with a spool.
+        max_outstanding_messages (int): most messages leased and not acknowledged at once.
+        max_outstanding_bytes (int): most bytes leased and not acknowledged at once.
+
+        Returns:
+        the StreamingPullFuture of the subscription
+        """
+        flow_control = _pubsub_v1().types.FlowControl(
+            max_messages=max_outstanding_messages,
+            max_bytes=max_outstanding_bytes
+            )
+
+        self._streaming_stopped.clear()
+
+        def callback(message):
+            if self.spool is not None:
+                # A full spool holds the callback, and the flow control stops new deliveries
+                while not self.spool.wait_for_room(timeout=CALLBACK_POLL_SECONDS):
+                    if self._streaming_stopped.is_set():
+                        message.nack()
+                        return
+                # Acknowledge the message only once it is durable in the spool
+                self.spool.put(message.data, on_spooled=message.ack, on_failed=message.nack)
+                return
+            try:
+                alert = self.message_data_to_alert(message.data)
+                alert.ack_id = message.ack_id
+                alert.priority = message_priority(message)
+            # Malformed messages cannot become alerts, acknowledge them so they are not redelivered forever
+            except Exception as e:
+                logger.error(f"Failed to transform message to an Alert: {e}")
+                self.malformed_messages.inc()
+                message.ack()
+                return
+            while True:
+                try:
+                    work_queue.put((alert, message), timeout=CALLBACK_POLL_SECONDS)
+                    return
+                except queue.Full:
+                    if self._streaming_stopped.is_set():
+                        message.nack()
+                        return
+
+        self.streaming_pull_future = self.subscriber.subscribe(
+            self.subscription_name,
+            callback=callback,
+            flow_control=flow_control
+            )
+        logger.info(f"streaming pull started on {self.subscription_name}")
+        return self.streaming_pull_future
+
+    def stop_streaming(self, timeout:float=10.0):
+        """
+        This method stops the streaming pull and waits for the subscriber to shut down.
+
+        Parameters:
+        timeout (float): seconds to wait for the shutdown.
+
+        Returns:
+        None
+        """
+        if self.streaming_pull_future is None:
+            return
+        self._streaming_stopped.set()
+        self.streaming_pull_future.cancel()
+        try:
+            self.streaming_pull_future.result(timeout=timeout)
+        except Exception as e:
+            # A cancelled future may raise on result, this is part of a normal shutdown
+            logger.info(f"streaming pull stopped: {e}")
+        self.streaming_pull_future = None
@@ -0,0 +1,151 @@
+import re
+import base64
+import hashlib
+import ipaddress
+
+# The IoC types the classifier detects
+IOC_TYPE_IPV4 = "ipv4"
+IOC_TYPE_IPV6 = "ipv6"
+IOC_TYPE_DOMAIN = "domain"
+IOC_TYPE_URL = "url"
+IOC_TYPE_MD5 = "md5"
+IOC_TYPE_SHA1 = "sha1"
+IOC_TYPE_SHA256 = "sha256"
+
+# Patterns are compiled once, at import
+_HASH_PATTERN = re.compile(r"[0-9a-fA-F]+")
+_HASH_TYPES_BY_LENGTH = {32: IOC_TYPE_MD5, 40: IOC_TYPE_SHA1, 64: IOC_TYPE_SHA256}
+_URL_PATTERN = re.compile(r"[a-zA-Z][a-zA-Z0-9+.-]*://[^\s/?#]+[^\s]*")
+_DOMAIN_PATTERN = re.compile(
+    r"(?=.{1,253}$)(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z][a-zA-Z0-9-]{0,61}[a-zA-Z0-9]"
+)
+
+# The VirusTotal v3 endpoint of every IoC type
+_ENDPOINTS = {
+    IOC_TYPE_IPV4: "ip_addresses/",
+    IOC_TYPE_IPV6: "ip_addresses/",
+    IOC_TYPE_DOMAIN: "domains/",
+    IOC_TYPE_URL: "urls/",
+    IOC_TYPE_MD5: "files/",
+    IOC_TYPE_SHA1: "files/",
+    IOC_TYPE_SHA256: "files/",
+}
+
+# The VirusTotal search that accepts several IoCs in one request (needs a premium API key)
+VIRUSTOTAL_SEARCH_PATH = "intelligence/search"
+_HASH_TYPES = (IOC_TYPE_MD5, IOC_TYPE_SHA1, IOC_TYPE_SHA256)
+
+
+def classify_ioc(ioc: str) -> str:
+    """
+    This function detects the type of the IoC.
+
+    Parameters:
+    ioc (str): the IoC, without surrounding whitespace.
+
+    Returns:
+    one of the IOC_TYPE_* values, or None if the IoC is malformed
+    """
+    if not ioc:
+        return None
+    length = len(ioc)
+    if length in _HASH_TYPES_BY_LENGTH and _HASH_PATTERN.fullmatch(ioc):
+        return _HASH_TYPES_BY_LENGTH[length]
+    if "://" in ioc:
+        return IOC_TYPE_URL if _URL_PATTERN.fullmatch(ioc) else None
+    # Only strings made of digits, dots and (for IPv6) hex digits and colons can be addresses
+    if ":" in ioc or ioc[0].isdigit():
+        try:
+            address = ipaddress.ip_address(ioc)
+        except ValueError:
+            address = None
+        if address is not None:
+            return IOC_TYPE_IPV4 if address.version == 4 else IOC_TYPE_IPV6
+        if ":" in ioc:
+            return None
+    if _DOMAIN_PATTERN.fullmatch(ioc):
+        return IOC_TYPE_DOMAIN
+    return None
+
+
+def virustotal_path(ioc: str, ioc_type: str) -> str:
+    """
+    This function returns the VirusTotal API path of the IoC report.
+
+    Parameters:
+    ioc (str)
+    ioc_type (str): one of the IOC_TYPE_* values.
+
+    Returns:
+    the path under the API root, e.g. "domains/example.com"
+    """
+    if ioc_type == IOC_TYPE_URL:
+        # VirusTotal identifies a URL by its unpadded url-safe base64
+        return _ENDPOINTS[ioc_type] + base64.urlsafe_b64encode(ioc.encode()).decode().rstrip("=")
+    if ioc_type in _HASH_TYPES:
+        return _ENDPOINTS[ioc_type] + ioc.lower()
+    return _ENDPOINTS[ioc_type] + ioc
+
+
+def virustotal_search_term(ioc: str, ioc_type: str) -> str:
+    """
+    This function returns the term of the IoC in a VirusTotal search query.
+
+    Parameters:
+    ioc (str)
+    ioc_type (str): one of the IOC_TYPE_* values.
+
+    Returns:
+    the search term, e.g. 'url:"http://example.com/a"'
+    """
+    if ioc_type == IOC_TYPE_URL:
+        return 'url:"' + ioc.replace("\\", "\\\\").replace('"', '\\"') + '"'
+    if ioc_type in _HASH_TYPES:
+        return ioc.lower()
+    return ioc
+
+
+def ioc_match_keys(ioc: str, ioc_type: str) -> tuple:
+    """
+    This function returns the keys a VirusTotal object of the IoC can be recognized by in search results,
+    see virustotal_object_keys.
+
+    Parameters:
+    ioc (str)
+    ioc_type (str): one of the IOC_TYPE_* values.
+
+    Returns:
+    tuple of keys
+    """
+    if ioc_type == IOC_TYPE_URL:
+        # A URL object has the URL as an attribute and the sha256 of the URL as its id
+        return (ioc, hashlib.sha256(ioc.encode()).hexdigest())
+    if ioc_type == IOC_TYPE_IPV6:
+        return (str(ipaddress.ip_address(ioc)),)
+    return (ioc.lower(),)
+
+
+def virustotal_object_keys(virustotal_object: dict) -> list:
+    """
+    This function returns the keys of an object of a VirusTotal search result: its id, the hashes of a file
+    and the URL of a url, in the same form as ioc_match_keys.
+
+    Parameters:
+    virustotal_object (dict): one item of the "data" list of the search response.
+
+    Returns:
+    list of keys
+    """
+    attributes = virustotal_object.get("attributes") or {}
+    object_type = virustotal_object.get("type")
+    object_id = str(virustotal_object.get("id", ""))
+    if object_type == "file":
+        return [str(attributes[name]).lower() for name in ("md5", "sha1", "sha256") if attributes.get(name)] + [object_id.lower()]
+    if object_type == "url":
+        return [attributes["url"], object_id] if attributes.get("url") else [object_id]
+    if object_type == "ip_address" and ":" in object_id:
+        try:
+            return [str(ipaddress.ip_address(object_id))]
+        except ValueError:
+            return [object_id]
+    return [object_id.lower()]
@@ -0,0 +1,252 @@
+import os
+import time
+import bisect
+import logging
+import ipaddress
+import threading
+from app.verdict_cache import VERDICT_MALICIOUS, VERDICT_CLEAN
+from app.ioc_classifier import (
+    classify_ioc, IOC_TYPE_IPV4, IOC_TYPE_IPV6, IOC_TYPE_DOMAIN, IOC_TYPE_URL
+)
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_RELOAD_INTERVAL_SECONDS = 30.0
+
+# Ranges that are never routed on the internet, VirusTotal has nothing to say about them.
+RESERVED_NETWORKS = (
+    "0.0.0.0/8", "10.0.0.0/8", "100.64.0.0/10", "127.0.0.0/8", "169.254.0.0/16", "172.16.0.0/12",
+    "192.0.0.0/24", "192.0.2.0/24", "192.168.0.0/16", "198.18.0.0/15", "198.51.100.0/24",
+    "203.0.113.0/24", "224.0.0.0/4", "240.0.0.0/4",
+    "::/128", "::1/128", "fc00::/7", "fe80::/10", "ff00::/8", "2001:db8::/32",
+)
+
+
+class IntervalIndex:
+    """
+    This class answers whether an address falls in one of a set of CIDR ranges.
+    The ranges are merged into sorted, non-overlapping [start, end] intervals of integers,
+    so a lookup is one binary search however many ranges there are.
+    """
+    def __init__(self, networks=()):
+        intervals = sorted((int(network.network_address), int(network.broadcast_address)) for network in networks)
+        merged = []
+        for start, end in intervals:
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self._starts = [start for start, _ in merged]
+        self._ends = [end for _, end in merged]
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __contains__(self, address: int) -> bool:
+        position = bisect.bisect_right(self._starts, address) - 1
+        return position >= 0 and address <= self._ends[position]
+
+
+class _Entries:
+    """
+    The parsed content of one list file: CIDR ranges per IP version, and a set of the other IoCs.
+    """
+    def __init__(self, networks_v4=(), networks_v6=(), values=()):
+        self.networks_v4 = IntervalIndex(networks_v4)
+        self.networks_v6 = IntervalIndex(networks_v6)
+        self.values = frozenset(values)
+
+    def __len__(self) -> int:
+        return len(self.networks_v4) + len(self.networks_v6) + len(self.values)
+
+    def matches(self, ioc: str, ioc_type: str, address=None) -> bool:
+        if address is not None:
+            networks = self.networks_v4 if address.version == 4 else self.networks_v6
+            return int(address) in networks
+        if ioc_type == IOC_TYPE_DOMAIN:
+            # A listed domain covers its subdomains as well
+            labels = ioc.lower().split(".")
+            return any(".".join(labels[position:]) in self.values for position in range(len(labels) - 1))
+        if ioc_type == IOC_TYPE_URL:
+            return ioc in self.values
+        return ioc.lower() in self.values
+
+
+def load_entries(path: str) -> _Entries:
+    """
+    This function parses a list file: one IP address, CIDR range, domain, url or file hash per line,
+    blank lines and lines starting with # are ignored.
+
+    Parameters:
+    path (str): path of the list file.
+
+    Returns:
+    the parsed entries
+    """
+    networks_v4, networks_v6, values = [], [], []
+    with open(path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            entry = line.split("#", 1)[0].strip()
+            if not entry:
+                continue
+            if "/" in entry and "://" not in entry:
+                try:
+                    network = ipaddress.ip_network(entry, strict=False)
+                except ValueError:
+                    logger.warning(f"{path}:{line_number}: invalid CIDR range {entry!r} ignored")
+                    continue
+                (networks_v4 if network.version == 4 else networks_v6).append(network)
+                continue
+            ioc_type = classify_ioc(entry)
+            if ioc_type in (IOC_TYPE_IPV4, IOC_TYPE_IPV6):
+                network = ipaddress.ip_network(entry)
+                (networks_v4 if network.version == 4 else networks_v6).append(network)
+            elif ioc_type == IOC_TYPE_URL:
+                values.append(entry)
+            elif ioc_type is not None:
+                values.append(entry.lower())
+            else:
+                logger.warning(f"{path}:{line_number}: invalid entry {entry!r} ignored")
+    return _Entries(networks_v4, networks_v6, values)
+
+
+class LocalIndex:
+    """
+    This class resolves IoCs from local lists, without a VirusTotal lookup:
+    a blocklist of known bad IoCs, an allowlist of known good IoCs, and (optionally) the
+    private and reserved IP ranges, that are treated as clean.
+    The blocklist wins over the allowlist. The list files are reloaded when they change on disk,
+    checked at most every reload_interval seconds, so they can be edited while the pipeline runs.
+    """
+    def __init__(self, blocklist_path: str = None, allowlist_path: str = None, reserved_clean: bool = True,
+                 reload_interval: float = DEFAULT_RELOAD_INTERVAL_SECONDS, timer=time.monotonic):
+        """
+        This method initializes the LocalIndex and loads the list files.
+
+        Parameters:
+        blocklist_path (str): file of IoCs that are malicious, None for no blocklist.
+        allowlist_path (str): file of IoCs that are clean, None for no allowlist.
+        reserved_clean (bool): resolve private and reserved IP addresses as clean.
+        reload_interval (float): least seconds between two checks of the list files for changes.
+        timer (callable): returns the current time in seconds.
+
+        Returns:
+        None
+        """
+        self.blocklist_path = blocklist_path
+        self.allowlist_path = allowlist_path
+        self.reload_interval = reload_interval
+        self.timer = timer
+        self.reloads = 0
+        self.hits = 0
+        self.misses = 0
+        networks = [ipaddress.ip_network(network) for network in RESERVED_NETWORKS] if reserved_clean else []
+        self._reserved = _Entries([n for n in networks if n.version == 4], [n for n in networks if n.version == 6])
+        self._blocklist = _Entries()
+        self._allowlist = _Entries()
+        self._mtimes = {}
+        self._checked_at = None
+        self._reload_lock = threading.Lock()
+        self.reload_if_changed(force=True)
+
+    @classmethod
+    def from_env(cls):
+        """
+        This method creates the LocalIndex from the LOCAL_* settings of the .env file.
+        """
+        return cls(
+            blocklist_path=os.getenv("LOCAL_BLOCKLIST_PATH") or None,
+            allowlist_path=os.getenv("LOCAL_ALLOWLIST_PATH") or None,
+            reserved_clean=os.getenv("LOCAL_RESERVED_CLEAN", "true").lower() == "true",
+            reload_interval=float(os.getenv("LOCAL_LISTS_RELOAD_INTERVAL", DEFAULT_RELOAD_INTERVAL_SECONDS))
+        )
+
+    def _modification_time(self, path: str):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def reload_if_changed(self, force: bool = False) -> bool:
+        """
+        This method reloads the list files whose modification time changed since they were loaded.
+        A file that cannot be read keeps its previous entries.
+
+        Parameters:
+        force (bool): load the files even if they did not change.
+
+        Returns:
+        True if a list was reloaded, False otherwise
+        """
+        with self._reload_lock:
+            self._checked_at = self.timer()
+            reloaded = False
+            for name, path in (("_blocklist", self.blocklist_path), ("_allowlist", self.allowlist_path)):
+                if path is None:
+                    continue
+                mtime = self._modification_time(path)
+                if mtime is None:
+                    if force:
+                        logger.error(f"local list {path} not found")
+                    continue
+                if not force and mtime == self._mtimes.get(path):
+                    continue
+                try:
+                    entries = load_entries(path)
+                except Exception as e:
+                    logger.error(f"Failed to load local list {path}: {e}")
+                    continue
+                # Readers keep using the old entries until this assignment, they never see a half loaded list
+                setattr(self, name, entries)
+                self._mtimes[path] = mtime
+                reloaded = True
+                logger.info(f"local list {path} loaded with {len(entries)} entries")
+            if reloaded and not force:
+                self.reloads += 1
+            return reloaded
+
+    def lookup(self, ioc: str, ioc_type: str = None):
+        """
+        This method returns the local verdict of the IoC.
+
+        Parameters:
+        ioc (str)
+        ioc_type (str): the type of the IoC, None to classify it here.
+
+        Returns:
+        VERDICT_MALICIOUS or VERDICT_CLEAN, or None if the IoC is not in the local lists
+        """
+        if self.timer() - self._checked_at >= self.reload_interval:
+            self.reload_if_changed()
+        if ioc_type is None:
+            ioc_type = classify_ioc(ioc)
+        if ioc_type is None:
+            return None
+        address = ipaddress.ip_address(ioc) if ioc_type in (IOC_TYPE_IPV4, IOC_TYPE_IPV6) else None
+
+        if self._blocklist.matches(ioc, ioc_type, address):
+            verdict = VERDICT_MALICIOUS
+        elif self._allowlist.matches(ioc, ioc_type, address) or (address is not None and self._reserved.matches(ioc, ioc_type, address)):
+            verdict = VERDICT_CLEAN
+        else:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return verdict
+
+    def stats(self) -> dict:
+        """
+        This method returns the counters of the index.
+
+        Returns:
+        dict with hits, misses, the number of entries of every list and the number of reloads
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "blocklist_entries": len(self._blocklist),
+            "allowlist_entries": len(self._allowlist),
+            "reloads": self.reloads,
+        }
@@ -1,9 +1,21 @@
 from app.enrichment_service import EnrichmentService
-from app.ingestion_service import IngestionService
-from dotenv import load_dotenv
-import os
-import time
+from app.ingestion_service import IngestionService, MAX_OUTSTANDING_MESSAGES, MAX_OUTSTANDING_BYTES
+from app.verdict_cache import VerdictCache
+from app.rate_limiter import RateLimiter
+from app.report_sink import build_report_sink_from_env
+from app.report_index import ReportIndex
+from app.cache_refresher import CacheRefresher
+from app.local_index import LocalIndex
+from app.spool_queue import SpoolQueue
+from app.message_parser import MessageParser
+from app.pull_scheduler import PullScheduler
+from app.scoring import build_scoring_policy_from_env
+from app.priority_scheduler import PriorityScheduler
+from app.metrics import build_metrics_registry_from_env, build_metrics_exporter_from_env
+from app.config import load_env, load_config
+import queue
 import logging
+import threading
 
 # Setup logging
 logging.basicConfig(
@@ -11,57 +23,487 @@ logging.basicConfig(
     format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
-load_dotenv()  # Load environment variables from .env file
+# Seconds the streaming consumer waits for work before checking if it should stop.
+STREAMING_POLL_SECONDS = 1.0
 
-def main():
-    # Retrieve required environment variables
-    subscription_name = os.getenv("SUBSCRIPTION_NAME")
-    service_account_path = os.getenv("SERVICE_ACCOUNT")
+def process_alerts(enrichment_service, alerts:list) -> list:
+    """
+    This function enriches the alerts, saves their reports and logs the service stats.
+
+    Parameters:
+    enrichment_service (EnrichmentService)
+    alerts (list): list of Alert objects.
+
+    Returns:
+    set of the ids of the alerts whose reports could not be saved, their messages must not be acknowledged
+    """
+    logging.info("enriching...")
+    # Analyze the alerts using VirusTotal, the report of every alert is saved as soon as the alert is done
+    enrichment_service.analyze_alerts(alerts, on_report=lambda report: enrichment_service.save_report_to_file(report=report))
+    # Write the buffered reports as one group, the messages are acknowledged after this
+    enrichment_service.flush_reports()
+    unsaved_alert_ids = enrichment_service.take_unsaved_alert_ids()
+    if unsaved_alert_ids:
+        logging.error(f"{len(unsaved_alert_ids)} report(s) could not be saved")
+    logging.info("alerts processed and reports saved.")
+    logging.info(f"batch lookup stats: {enrichment_service.last_batch_stats}")
+    if enrichment_service.local_index is not None:
+        logging.info(f"local lists stats: {enrichment_service.local_index.stats()}")
+    if enrichment_service.verdict_cache is not None:
+        logging.info(f"verdict cache stats: {enrichment_service.verdict_cache.stats()}")
+    if enrichment_service.cache_refresher is not None:
+        logging.info(f"cache refresher stats: {enrichment_service.cache_refresher.stats()}")
+    if enrichment_service.rate_limiter is not None:
+        logging.info(f"VirusTotal remaining budget: {enrichment_service.rate_limiter.remaining()}")
+    logging.info(f"VirusTotal request latency: {enrichment_service.virustotal_client.latency.summary()}")
+    return unsaved_alert_ids
+
+def run_pull_loop(ingestion_service, enrichment_service, stop_event, pull_scheduler=None):
+    """
+    This function is the synchronous pull mode: pull a batch, process it, and wait before the next pull.
+    The pull size and the wait adapt to how full the pulls come back (see PullScheduler).
+
+    Parameters:
+    ingestion_service (IngestionService)
+    enrichment_service (EnrichmentService)
+    stop_event (threading.Event): set to stop the loop.
+    pull_scheduler (PullScheduler): decides the pull size and the wait, a default one if None.
+
+    Returns:
+    None
+    """
+    if pull_scheduler is None:
+        pull_scheduler = PullScheduler(metrics=enrichment_service.metrics)
+    while not stop_event.is_set():
+        # Do not pull more while the lookups already wait for VirusTotal budget
+        delay = pull_scheduler.throttle_delay(rate_limiter=enrichment_service.rate_limiter)
+        if delay > 0:
+            logging.info(f"VirusTotal budget spent, holding the next pull for {delay:.1f} seconds")
+            stop_event.wait(delay)
+            continue
+        logging.info("pulling new messages...")
+        pull_size = pull_scheduler.pull_size_for()
+        messages = ingestion_service.pull_messages(max_messages=pull_size)
+
+        if not messages:
+            logging.info("no new messages received")
+        else:
+            logging.info(f"{len(messages)} message(s) received. Proccessing messages to Alerts")
+            # Convert raw messages into Alert objects
+            alerts = ingestion_service.transform_messages_to_alerts(messages)
+
+            if alerts:
+                unsaved_alert_ids = process_alerts(enrichment_service, alerts)
+                # Acknowledge the messages whose reports are saved, if not acknowledged already
+                ingestion_service.acknowledge_alerts(alerts, unsaved_alert_ids)
+                logging.info(f"acknowledgement stats: {ingestion_service.ack_manager.stats()}")
+            else:
+                logging.info("messages pulled, but not valid alerts found")
+            if ingestion_service.rejected_iocs or enrichment_service.rejected_iocs:
+                logging.info(f"malformed IoCs rejected: {ingestion_service.rejected_iocs} at ingestion, "
+                             f"{enrichment_service.rejected_iocs} at enrichment")
+
+        interval = pull_scheduler.record_pull(len(messages), pull_size)
+        if interval > 0:
+            logging.info(f"waiting {interval:.1f} seconds until pulling new alerts... \n")
+            # Back off while the subscription is empty to avoid excessive querying
+            stop_event.wait(interval)
+
+def drain_work_queue(work_queue, max_items:int, timeout:float) -> list:
+    """
+    This function waits up to timeout seconds for the first item of the work queue,
+    and then takes whatever else is already waiting, up to max_items items.
+
+    Parameters:
+    work_queue (queue.Queue)
+    max_items (int): most items to take.
+    timeout (float): seconds to wait for the first item.
+
+    Returns:
+    list of items, empty if nothing arrived in time
+    """
+    try:
+        items = [work_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(items) < max_items:
+        try:
+            items.append(work_queue.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+def run_streaming_loop(ingestion_service, enrichment_service, stop_event, batch_size:int=10,
+                       work_queue_size:int=100, max_outstanding_messages:int=MAX_OUTSTANDING_MESSAGES,
+                       max_outstanding_bytes:int=MAX_OUTSTANDING_BYTES):
+    """
+    This function is the streaming pull mode: the subscriber keeps feeding a bounded work queue,
+    and alerts are processed as soon as they arrive, in batches of up to batch_size alerts.
+    A message is acknowledged only after its report is saved, so unfinished alerts are redelivered.
+
+    Parameters:
+    ingestion_service (IngestionService)
+    enrichment_service (EnrichmentService)
+    stop_event (threading.Event): set to stop the loop.
+    batch_size (int): most alerts enriched together.
+    work_queue_size (int): capacity of the work queue between the subscriber and the enrichment.
+    max_outstanding_messages (int): flow control of the subscriber, in messages.
+    max_outstanding_bytes (int): flow control of the subscriber, in bytes.
+
+    Returns:
+    None
+    """
+    work_queue = queue.Queue(maxsize=work_queue_size)
+    streaming_pull_future = ingestion_service.start_streaming(
+        work_queue=work_queue,
+        max_outstanding_messages=max_outstanding_messages,
+        max_outstanding_bytes=max_outstanding_bytes
+        )
+    try:
+        while not stop_event.is_set() and not streaming_pull_future.done():
+            batch = drain_work_queue(work_queue, max_items=batch_size, timeout=STREAMING_POLL_SECONDS)
+            if not batch:
+                continue
+            logging.info(f"{len(batch)} alert(s) received from the stream")
+            unsaved_alert_ids = process_alerts(enrichment_service, [alert for alert, _ in batch])
+            # Acknowledge pub/sub only after the reports are saved, the others are redelivered
+            for alert, message in batch:
+                if alert.id in unsaved_alert_ids:
+                    message.nack()
+                else:
+                    message.ack()
+    finally:
+        ingestion_service.stop_streaming()
+        # Give the alerts that were not processed back to pub/sub right away
+        while True:
+            try:
+                _, message = work_queue.get_nowait()
+            except queue.Empty:
+                break
+            message.nack()
+
+def consume_spool(ingestion_service, enrichment_service, stop_event, batch_size:int=10):
+    """
+    This function enriches the messages of the spool at the pace VirusTotal allows, in batches of up to batch_size,
+    and deletes them from the spool once their reports are saved. A batch that fails stays in the spool
+    and is handed out again when its lease expires.
+
+    Parameters:
+    ingestion_service (IngestionService): its spool is consumed, and it transforms the messages to alerts.
+    enrichment_service (EnrichmentService)
+    stop_event (threading.Event): set to stop after the current batch.
+    batch_size (int): most messages enriched together.
+
+    Returns:
+    None
+    """
+    spool = ingestion_service.spool
+    while not stop_event.is_set():
+        entries = spool.get_batch(batch_size)
+        if not entries:
+            stop_event.wait(STREAMING_POLL_SECONDS)
+            continue
+        alerts = []
+        spool_ids = []
+        # alert id -> spool id of its message
+        spool_id_of_alert = {}
+        for spool_id, data in entries:
+            spool_ids.append(spool_id)
+            try:
+                alert = ingestion_service.message_data_to_alert(data)
+            # A malformed message will not get better by replaying it, drop it from the spool
+            except Exception as e:
+                logging.error(f"Failed to transform spooled message {spool_id} to an Alert: {e}")
+                continue
+            spool_id_of_alert[alert.id] = spool_id
+            alerts.append(alert)
+        logging.info(f"{len(entries)} message(s) taken from the spool")
+        if alerts:
+            unsaved_alert_ids = process_alerts(enrichment_service, alerts)
+            # Messages whose reports could not be saved stay in the spool, they are handed out again when their lease expires
+            unsaved_spool_ids = {spool_id_of_alert[alert_id] for alert_id in unsaved_alert_ids if alert_id in spool_id_of_alert}
+            spool_ids = [spool_id for spool_id in spool_ids if spool_id not in unsaved_spool_ids]
+        spool.ack(spool_ids)
+        logging.info(f"spool stats: {spool.stats()}")
+
+def run_spooled_pipeline(ingestion_service, enrichment_service, stop_event, streaming:bool=False, batch_size:int=10,
+                         max_outstanding_messages:int=MAX_OUTSTANDING_MESSAGES, max_outstanding_bytes:int=MAX_OUTSTANDING_BYTES,
+                         pull_scheduler=None):
+    """
+    This function runs ingestion and enrichment decoupled by the spool: ingestion writes the messages to the spool
+    and acknowledges them once they are durable, on its own thread (pull) or the subscriber threads (streaming),
+    while enrichment consumes the spool in this thread. Messages left in the spool are replayed after a restart.
+
+    Parameters:
+    ingestion_service (IngestionService): with a spool.
+    enrichment_service (EnrichmentService)
+    stop_event (threading.Event): set to stop.
+    streaming (bool): use a streaming pull instead of synchronous pulls.
+    batch_size (int): most messages enriched together.
+    max_outstanding_messages (int): flow control of the streaming subscriber, in messages.
+    max_outstanding_bytes (int): flow control of the streaming subscriber, in bytes.
+    pull_scheduler (PullScheduler): decides the pull size and the wait in the pull mode, a default one if None.
+
+    Returns:
+    None
+    """
+    spool = ingestion_service.spool
+    feeder = None
+    if streaming:
+        ingestion_service.start_streaming(work_queue=None, max_outstanding_messages=max_outstanding_messages,
+                                          max_outstanding_bytes=max_outstanding_bytes)
+    else:
+        if pull_scheduler is None:
+            pull_scheduler = PullScheduler(metrics=enrichment_service.metrics)
+
+        def pull_to_spool():
+            while not stop_event.is_set():
+                # Stop pulling while the spool is full, the messages stay in pub/sub meanwhile
+                if not spool.wait_for_room(timeout=STREAMING_POLL_SECONDS):
+                    continue
+                # Hold back while enrichment is behind, the spool would only grow
+                backlog = spool.depth()
+                delay = pull_scheduler.throttle_delay(backlog=backlog, rate_limiter=enrichment_service.rate_limiter)
+                if delay > 0:
+                    stop_event.wait(delay)
+                    continue
+                pull_size = pull_scheduler.pull_size_for(backlog)
+                messages = ingestion_service.pull_messages(max_messages=pull_size)
+                ingestion_service.spool_messages(messages)
+                # Pull again right away while the subscription has a backlog
+                stop_event.wait(pull_scheduler.record_pull(len(messages), pull_size))
+        feeder = threading.Thread(target=pull_to_spool, name="spool-feeder", daemon=True)
+        feeder.start()
+    try:
+        consume_spool(ingestion_service, enrichment_service, stop_event, batch_size=batch_size)
+    finally:
+        stop_event.set()
+        if streaming:
+            ingestion_service.stop_streaming()
+        else:
+            feeder.join()
+
+def build_enrichment_service(config, metrics, report_sink=None, worker_count:int=1, max_workers:int=None):
+    """
+    This function creates the enrichment service and everything it uses from the .env file.
+
+    Parameters:
+    config (Config): the settings.
+    metrics (MetricsRegistry): registry of the pipeline metrics.
+    report_sink (ReportSink): where the reports are written, None to save one json file per report.
+    worker_count (int): number of processes sharing the VirusTotal quotas equally.
+    max_workers (int): parallel VirusTotal lookups, ENRICHMENT_MAX_WORKERS if None.
+
+    Returns:
+    EnrichmentService
+    """
+    verdict_cache = VerdictCache.from_env()
+    rate_limiter = RateLimiter.from_env()
+    if worker_count > 1:
+        rate_limiter = RateLimiter(
+            requests_per_minute=max(1, rate_limiter.buckets["minute"].capacity // worker_count),
+            requests_per_day=max(1, rate_limiter.buckets["day"].capacity // worker_count)
+            )
+    local_index = LocalIndex.from_env()
+    enrichment_service = EnrichmentService(verdict_cache=verdict_cache, rate_limiter=rate_limiter,
+                             max_workers=max_workers if max_workers is not None else config.enrichment_max_workers,
+                             report_sink=report_sink, local_index=local_index, metrics=metrics,
+                             bulk_size=config.virustotal_bulk_size,
+                             scoring_policy=build_scoring_policy_from_env(),
+                             early_emit_severity=config.early_emit_severity,
+                             priority_scheduler=PriorityScheduler.from_env(),
+                             report_index=ReportIndex.from_env())
+    # Keep the hot verdicts fresh (and warm the cache from a previous run) when it is configured
+    cache_refresher = CacheRefresher.from_env(enrichment_service, metrics=metrics)
+    if cache_refresher is not None:
+        enrichment_service.cache_refresher = cache_refresher.start()
+    return enrichment_service
+
+def close_enrichment_service(enrichment_service):
+    """
+    This function flushes and releases everything the enrichment service holds.
+
+    Parameters:
+    enrichment_service (EnrichmentService)
+
+    Returns:
+    None
+    """
+    if enrichment_service.cache_refresher is not None:
+        enrichment_service.cache_refresher.stop()
+    # Durable flush of the buffered reports
+    if enrichment_service.report_sink is not None:
+        enrichment_service.report_sink.close()
+    if enrichment_service.report_index is not None:
+        enrichment_service.report_index.close()
+    enrichment_service.virustotal_client.close()
+    if enrichment_service.verdict_cache is not None:
+        enrichment_service.verdict_cache.close()
+
+def build_services(worker_count:int=1, worker_index:int=None, config=None):
+    """
+    This function creates the ingestion and enrichment services from the .env file.
+
+    Parameters:
+    worker_count (int): number of processes running the pipeline side by side,
+    each of them gets an equal share of the VirusTotal quotas.
+    worker_index (int): index of this process among them, None for a single process.
+    config (Config): the settings, loaded from the .env file if None.
+
+    Returns:
+    (ingestion_service, enrichment_service), or None if required environment variables are missing
+    """
+    # The components below read their own settings from the environment
+    load_env()
+    config = config if config is not None else load_config()
 
     # Validate required inputs
-    if not subscription_name or not service_account_path:
+    if not config.subscription_name or not config.service_account_path:
         logging.error("missing environment variables, please check your .env file")
-        return
+        return None
     
     # Initialize services
-    ingestion_service = IngestionService(subscription_name=subscription_name, service_account_path=service_account_path)
-    enrichment_service = EnrichmentService()
+    metrics = build_metrics_registry_from_env()
+    ingestion_service = IngestionService(subscription_name=config.subscription_name, service_account_path=config.service_account_path,
+                                         ack_after_report=config.ack_after_report, metrics=metrics, spool=SpoolQueue.from_env(worker_index=worker_index),
+                                         message_parser=MessageParser.from_env(metrics=metrics))
+    enrichment_service = build_enrichment_service(config, metrics, report_sink=build_report_sink_from_env(),
+                                                  worker_count=worker_count)
+    register_service_metrics(metrics, ingestion_service, enrichment_service)
+    return ingestion_service, enrichment_service
 
-    try:
-        while(True):
-            logging.info("pulling new messages...")
-            messages = ingestion_service.pull_messages()
+def register_service_metrics(metrics, ingestion_service, enrichment_service):
+    """
+    This function exposes the counters the services already keep as metrics, they are read only when the metrics are rendered.
 
-            if not messages:
-                logging.info("no new messages received")
-            else:
-                logging.info(f"{len(messages)} message(s) received. Proccessing messages to Alerts")
-                # Convert raw messages into Alert objects
-                alerts = ingestion_service.transform_messages_to_alerts(messages)
-
-                if alerts:
-                    logging.info("enriching...")
-                    for alert in alerts:
-                        # Analyze the alert using VirusTotal and save results
-                        report = enrichment_service.analyze_response(alert)
-                        enrichment_service.save_report_to_file(report=report)
-                    logging.info("alerts processed and reports saved.")
-                else:
-                    logging.info("messages pulled, but not valid alerts found")
+    Parameters:
+    metrics (MetricsRegistry)
+    ingestion_service (IngestionService)
+    enrichment_service (EnrichmentService)
 
-            logging.info("waiting 5 minutes until pulling new alerts... \n")
+    Returns:
+    None
+    """
+    ack_manager = ingestion_service.ack_manager
+    metrics.register_collector("ack_rpcs_total", "counter", "Acknowledge RPCs sent to Pub/Sub",
+                               lambda: ack_manager.stats()["ack_rpcs"])
+    metrics.register_collector("acked_messages_total", "counter", "Messages acknowledged",
+                               lambda: ack_manager.stats()["acked_messages"])
+    metrics.register_collector("ack_failed_rpcs_total", "counter", "Acknowledge and deadline RPCs that failed",
+                               lambda: ack_manager.stats()["failed_rpcs"])
+    metrics.register_collector("messages_in_flight", "gauge", "Messages leased and waiting for their report",
+                               lambda: ack_manager.stats()["in_flight"])
+    latency = enrichment_service.virustotal_client.latency
+    metrics.register_collector("virustotal_requests_total", "counter", "VirusTotal requests by HTTP status code",
+                               lambda: {**latency.summary()["status_codes"], "connection_error": latency.summary()["connection_errors"]},
+                               label="status_code")
+    metrics.register_collector("virustotal_retries_total", "counter", "VirusTotal requests retried",
+                               lambda: latency.summary()["retries"])
+    metrics.register_collector("alerts_analyzed_total", "counter", "Alerts analyzed",
+                               lambda: enrichment_service.alerts_analyzed)
+    verdict_cache = enrichment_service.verdict_cache
+    if verdict_cache is not None:
+        metrics.register_collector("verdict_cache_hit_ratio", "gauge", "Hit ratio of the verdict cache",
+                                   lambda: verdict_cache.stats()["hit_ratio"])
+        metrics.register_collector("verdict_cache_evictions_total", "counter", "Verdicts evicted from the cache",
+                                   lambda: verdict_cache.stats()["evictions"])
+    rate_limiter = enrichment_service.rate_limiter
+    if rate_limiter is not None:
+        metrics.register_collector("virustotal_budget_remaining", "gauge", "VirusTotal requests left in the quota window",
+                                   lambda: {window: rate_limiter.remaining()[window] for window in ("minute", "day")},
+                                   label="window")
 
-            # Sleep for 5 minutes before pulling new messages to avoid excessive querying
-            time.sleep(300) 
-    except KeyboardInterrupt:
-        # Gracefully handle keyboard shutdown
-        logging.info("Shutdown requested, exiting gracefully ")
+def start_metrics_exporter(enrichment_service, worker_index:int=None):
+    """
+    This function starts the /metrics endpoint and the metrics file dumps, if they are configured.
 
-if __name__== "__main__":
-    main()
+    Parameters:
+    enrichment_service (EnrichmentService): its metrics registry is exported.
+    worker_index (int): index of the worker process under the supervisor, None for a single process.
+
+    Returns:
+    the started MetricsExporter, or None if the metrics are not exported
+    """
+    exporter = build_metrics_exporter_from_env(enrichment_service.metrics, worker_index=worker_index)
+    if exporter is None:
+        return None
+    try:
+        return exporter.start()
+    except OSError as e:
+        logging.error(f"Failed to start the metrics exporter: {e}")
+        return None
+
+def run_pipeline(ingestion_service, enrichment_service, stop_event, config=None):
+    """
+    This function runs the ingestion mode selected by INGESTION_MODE until stop_event is set.
 
+    Parameters:
+    ingestion_service (IngestionService)
+    enrichment_service (EnrichmentService)
+    stop_event (threading.Event or multiprocessing.Event): set to stop, the current batch is finished first.
+    config (Config): the settings, loaded from the .env file if None.
 
+    Returns:
+    None
+    """
+    config = config if config is not None else load_config()
+    if ingestion_service.spool is not None:
+        run_spooled_pipeline(
+            ingestion_service, enrichment_service, stop_event, streaming=config.streaming,
+            batch_size=config.spool_batch_size,
+            max_outstanding_messages=config.streaming_max_outstanding_messages,
+            max_outstanding_bytes=config.streaming_max_outstanding_bytes,
+            pull_scheduler=None if config.streaming else PullScheduler.from_env(metrics=enrichment_service.metrics)
+            )
+    # Streaming pull processes alerts as they arrive, the pull mode stays available as a fallback
+    elif config.streaming:
+        run_streaming_loop(
+            ingestion_service, enrichment_service, stop_event,
+            batch_size=config.streaming_batch_size,
+            work_queue_size=config.streaming_work_queue_size,
+            max_outstanding_messages=config.streaming_max_outstanding_messages,
+            max_outstanding_bytes=config.streaming_max_outstanding_bytes
+            )
+    else:
+        run_pull_loop(ingestion_service, enrichment_service, stop_event,
+                      pull_scheduler=PullScheduler.from_env(metrics=enrichment_service.metrics))
 
+def close_services(ingestion_service, enrichment_service):
+    """
+    This function flushes and releases everything the services hold.
 
+    Parameters:
+    ingestion_service (IngestionService)
+    enrichment_service (EnrichmentService)
+
+    Returns:
+    None
+    """
+    # Durable flush of the buffered reports before acknowledging what is left
+    close_enrichment_service(enrichment_service)
+    ingestion_service.ack_manager.close()
+    if ingestion_service.spool is not None:
+        ingestion_service.spool.close()
+
+def main():
+    # Load the .env file once, the entry point settings come from config and the components read theirs in from_env
+    config = load_config()
+    services = build_services(config=config)
+    if services is None:
+        return
+    ingestion_service, enrichment_service = services
+    stop_event = threading.Event()
+    metrics_exporter = start_metrics_exporter(enrichment_service)
 
+    try:
+        run_pipeline(ingestion_service, enrichment_service, stop_event, config=config)
+    except KeyboardInterrupt:
+        # Gracefully handle keyboard shutdown
+        logging.info("Shutdown requested, exiting gracefully ")
+    finally:
+        close_services(ingestion_service, enrichment_service)
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
 
+if __name__== "__main__":
+    main()
@@ -0,0 +1,121 @@
+import os
+import logging
+from app.ioc_classifier import classify_ioc, ioc_match_keys
+from app.metrics import DISABLED_METRICS
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values, each can be overridden from the .env file. 0 means no cap.
+DEFAULT_MAX_MESSAGE_BYTES = 10 * 1024 * 1024
+DEFAULT_MAX_MESSAGE_IOCS = 50000
+
+# Bytes stripped around an IoC, the \r of CRLF line ends included
+_WHITESPACE = frozenset(b" \t\r\n\x0b\x0c")
+
+
+def iter_lines(data: bytes):
+    """
+    This function streams the non blank lines of the message data as memoryview slices of it, stripped of the
+    whitespace around them. Nothing is copied: the data is not decoded or split as a whole.
+
+    Parameters:
+    data (bytes): the message data, lines separated by \\n or \\r\\n.
+
+    Returns:
+    generator of memoryview
+    """
+    view = memoryview(data)
+    size = len(view)
+    start = 0
+    while start < size:
+        end = data.find(b"\n", start)
+        if end == -1:
+            end = size
+        next_start = end + 1
+        while start < end and view[start] in _WHITESPACE:
+            start += 1
+        while end > start and view[end - 1] in _WHITESPACE:
+            end -= 1
+        if start < end:
+            yield view[start:end]
+        start = next_start
+
+
+class MessageParser:
+    """
+    This class turns the data of a message into its IoCs: the IoCs are decoded, classified and deduplicated
+    one line at a time while the raw bytes are scanned, so the message is never decoded or split as a whole.
+    A message bigger than max_bytes is rejected, one with more than max_iocs IoCs is cut to its first max_iocs.
+    """
+    def __init__(self, max_bytes: int = 0, max_iocs: int = 0, metrics=None):
+        """
+        This method initializes the MessageParser.
+
+        Parameters:
+        max_bytes (int): biggest message data accepted, 0 for no cap.
+        max_iocs (int): most IoCs kept of a message, 0 for no cap.
+        metrics (MetricsRegistry): registry of the pipeline metrics, None for no metrics.
+
+        Returns:
+        None
+        """
+        self.max_bytes = max_bytes
+        self.max_iocs = max_iocs
+        metrics = metrics if metrics is not None else DISABLED_METRICS
+        self.duplicate_iocs = metrics.counter("duplicate_iocs_total", "IoCs dropped because they were already in their message")
+        self.truncated_messages = metrics.counter("truncated_messages_total", "Messages cut to MESSAGE_MAX_IOCS IoCs")
+
+    @classmethod
+    def from_env(cls, metrics=None):
+        """
+        This method creates the MessageParser from the MESSAGE_MAX_BYTES and MESSAGE_MAX_IOCS settings of the .env file.
+
+        Parameters:
+        metrics (MetricsRegistry)
+
+        Returns:
+        MessageParser
+        """
+        return cls(
+            max_bytes=int(os.getenv("MESSAGE_MAX_BYTES", DEFAULT_MAX_MESSAGE_BYTES)),
+            max_iocs=int(os.getenv("MESSAGE_MAX_IOCS", DEFAULT_MAX_MESSAGE_IOCS)),
+            metrics=metrics,
+        )
+
+    def iter_iocs(self, data: bytes, on_rejected=None):
+        """
+        This method streams the well-formed IoCs of the message data with their types, in the order of the message.
+        An IoC that is already in the message in another form (e.g. another case of a domain or a hash) is dropped.
+
+        Parameters:
+        data (bytes): the message data, IoCs separated by new lines.
+        on_rejected (callable): called with every malformed IoC, None to drop them silently.
+
+        Returns:
+        generator of (IoC, type of the IoC)
+
+        Raises:
+        ValueError if the data is bigger than max_bytes
+        UnicodeDecodeError if a line is not valid utf-8
+        """
+        if self.max_bytes and len(data) > self.max_bytes:
+            raise ValueError(f"message of {len(data)} bytes is bigger than the {self.max_bytes} bytes limit")
+        seen = set()
+        for line in iter_lines(data):
+            if self.max_iocs and len(seen) >= self.max_iocs:
+                self.truncated_messages.inc()
+                logger.warning(f"message has more than {self.max_iocs} IoCs, the rest of it is dropped")
+                return
+            value = str(line, "utf-8")
+            ioc_type = classify_ioc(value)
+            if ioc_type is None:
+                if on_rejected is not None:
+                    on_rejected(value)
+                continue
+            key = ioc_match_keys(value, ioc_type)[0]
+            if key in seen:
+                self.duplicate_iocs.inc()
+                continue
+            seen.add(key)
+            yield value, ioc_type
@@ -0,0 +1,443 @@
+import os
+import time
+import bisect
+import logging
+import threading
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_DUMP_INTERVAL_SECONDS = 15.0
+
+# Bucket upper bounds (in seconds) of the latency histograms.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bucket upper bounds of the histograms of sizes (messages per pull, IoCs per alert...).
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Bucket upper bounds of the alert severity histogram, severity is a percentage.
+SEVERITY_BUCKETS = (0, 10, 25, 50, 75, 90, 100)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer:
+    """
+    Context manager that observes the seconds spent inside it.
+    """
+    __slots__ = ("_histogram", "_started")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started)
+
+
+class _Metric:
+    """
+    This class is the base of the metrics. A metric with label names holds one child per
+    combination of label values, created by labels() the first time it is used.
+    """
+    kind = None
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        This method returns the child of the metric for the given label values.
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        return type(self)(self.name, self.help)
+
+    def samples(self):
+        """
+        This method yields (name suffix, labels, value) for every sample of the metric.
+        """
+        if not self.labelnames:
+            yield from self._own_samples({})
+            return
+        for key, child in list(self._children.items()):
+            yield from child._own_samples(dict(zip(self.labelnames, key)))
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up, e.g. the number of acknowledged messages.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def _own_samples(self, labels):
+        yield "", labels, self.value
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, e.g. the number of messages in flight.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def _own_samples(self, labels):
+        yield "", labels, self.value
+
+
+class Histogram(_Metric):
+    """
+    The distribution of observed values in fixed buckets, plus their sum and count.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value: float):
+        # The last count is the +Inf bucket
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[position] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        This method returns a context manager that observes the seconds spent inside it.
+        """
+        return _Timer(self)
+
+    def _own_samples(self, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            yield "_bucket", {**labels, "le": _format_value(bound)}, cumulative
+        yield "_sum", labels, total
+        yield "_count", labels, count
+
+
+class _NullMetric:
+    """
+    The metric handed out by a disabled registry: every method does nothing,
+    so instrumented code costs one empty method call.
+    """
+    __slots__ = ()
+
+    def labels(self, *values):
+        return self
+
+    def inc(self, amount: float = 1):
+        pass
+
+    def dec(self, amount: float = 1):
+        pass
+
+    def set(self, value: float):
+        pass
+
+    def observe(self, value: float):
+        pass
+
+    def time(self):
+        return _NULL_TIMER
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_METRIC = _NullMetric()
+_NULL_TIMER = _NULL_METRIC
+
+
+class MetricsRegistry:
+    """
+    This class creates the metrics of the pipeline and renders them in the Prometheus text format.
+    Besides the metrics the services update on their hot paths, collectors read counters the services
+    already keep (cache stats, ack stats...) only when the metrics are rendered.
+    A disabled registry hands out metrics that do nothing and renders nothing.
+    """
+    def __init__(self, enabled: bool = True, prefix: str = "tip_"):
+        self.enabled = enabled
+        self.prefix = prefix
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric_class, name: str, help: str, labelnames: tuple, **kwargs):
+        if not self.enabled:
+            return _NULL_METRIC
+        name = self.prefix + name
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = metric_class(name, help, labelnames, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()):
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name: str, help: str, labelnames: tuple = ()):
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, labelnames, buckets=buckets)
+
+    def register_collector(self, name: str, kind: str, help: str, function, label: str = None):
+        """
+        This method adds a metric whose value is read when the metrics are rendered.
+
+        Parameters:
+        name (str): name of the metric, without the prefix.
+        kind (str): "counter" or "gauge".
+        help (str): description of the metric.
+        function (callable): returns the value, or a dict of label value -> value when label is given.
+        label (str): name of the label of the dict keys, None for a single value.
+
+        Returns:
+        None
+        """
+        if self.enabled:
+            with self._lock:
+                self._collectors.append((self.prefix + name, kind, help, function, label))
+
+    def render(self) -> str:
+        """
+        This method returns all the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        for name, kind, help, function, label in collectors:
+            try:
+                value = function()
+            except Exception as e:
+                logger.error(f"Failed to collect metric {name}: {e}")
+                continue
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if label is None:
+                lines.append(f"{name} {_format_value(value)}")
+            else:
+                for label_value, sample in value.items():
+                    lines.append(f"{name}{_format_labels({label: label_value})} {_format_value(sample)}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def dump(self, path: str):
+        """
+        This method writes the rendered metrics to a file, replacing it in one step
+        so a reader never sees a half written file.
+        """
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            file.write(self.render())
+        os.replace(temporary_path, path)
+
+
+# Registry of the services created without metrics, everything it hands out does nothing.
+DISABLED_METRICS = MetricsRegistry(enabled=False)
+
+
+def _metrics_handler(registry):
+    """
+    This function creates the request handler of the /metrics endpoint. http.server is imported here,
+    only when the endpoint is started.
+    """
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+class MetricsExporter:
+    """
+    This class exposes the metrics of a registry on a local HTTP /metrics endpoint,
+    and/or dumps them to a file every dump_interval seconds.
+    """
+    def __init__(self, registry: MetricsRegistry, port: int = None, host: str = DEFAULT_METRICS_HOST,
+                 file_path: str = None, dump_interval: float = DEFAULT_DUMP_INTERVAL_SECONDS):
+        """
+        This method initializes the MetricsExporter.
+
+        Parameters:
+        registry (MetricsRegistry)
+        port (int): port of the HTTP endpoint, 0 for any free port, None for no endpoint.
+        host (str): address the HTTP endpoint listens on.
+        file_path (str): file the metrics are dumped to, None for no file.
+        dump_interval (float): seconds between two dumps of the file.
+
+        Returns:
+        None
+        """
+        self.registry = registry
+        self.port = port
+        self.host = host
+        self.file_path = file_path
+        self.dump_interval = dump_interval
+        self._server = None
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """
+        This method starts the HTTP endpoint and the file dumps in background threads.
+        """
+        if self.port is not None:
+            from http.server import ThreadingHTTPServer
+            self._server = ThreadingHTTPServer((self.host, self.port), _metrics_handler(self.registry))
+            self._server.daemon_threads = True
+            self.port = self._server.server_address[1]
+            self._threads.append(threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.1},
+                                                  name="metrics-http", daemon=True))
+            logger.info(f"metrics served on http://{self.host}:{self.port}/metrics")
+        if self.file_path is not None:
+            self._threads.append(threading.Thread(target=self._dump_periodically, name="metrics-dump", daemon=True))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _dump_periodically(self):
+        while not self._stopped.wait(self.dump_interval):
+            self._dump()
+
+    def _dump(self):
+        try:
+            self.registry.dump(self.file_path)
+        except Exception as e:
+            logger.error(f"Failed to dump metrics to {self.file_path}: {e}")
+
+    def stop(self):
+        """
+        This method stops the HTTP endpoint and writes the file one last time.
+        """
+        self._stopped.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self.file_path is not None:
+            self._dump()
+
+
+def build_metrics_registry_from_env() -> MetricsRegistry:
+    """
+    This function creates the metrics registry, enabled when METRICS_ENABLED is true.
+
+    Returns:
+    the MetricsRegistry, a disabled one (that costs next to nothing) when the metrics are off
+    """
+    if os.getenv("METRICS_ENABLED", "false").lower() != "true":
+        return DISABLED_METRICS
+    return MetricsRegistry()
+
+
+def build_metrics_exporter_from_env(registry: MetricsRegistry, worker_index: int = None):
+    """
+    This function creates the exporter of the registry from the METRICS_* settings of the .env file.
+
+    Parameters:
+    registry (MetricsRegistry)
+    worker_index (int): index of the worker process under the supervisor, its port is METRICS_PORT + worker_index
+    and its file gets the index as a suffix. None for a single process.
+
+    Returns:
+    a MetricsExporter (not started yet), or None when the registry is disabled or neither METRICS_PORT nor METRICS_FILE is set
+    """
+    port = os.getenv("METRICS_PORT")
+    file_path = os.getenv("METRICS_FILE") or None
+    if not registry.enabled or (not port and not file_path):
+        return None
+    if worker_index is not None:
+        if port:
+            port = int(port) + worker_index
+        if file_path:
+            root, extension = os.path.splitext(file_path)
+            file_path = f"{root}_{worker_index}{extension}"
+    return MetricsExporter(
+        registry,
+        port=int(port) if port else None,
+        host=os.getenv("METRICS_HOST", DEFAULT_METRICS_HOST),
+        file_path=file_path,
+        dump_interval=float(os.getenv("METRICS_DUMP_INTERVAL", DEFAULT_DUMP_INTERVAL_SECONDS))
+    )
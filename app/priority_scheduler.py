@@ -0,0 +1,103 @@
+import os
+import logging
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# How the alerts of a batch are ordered for their lookups
+ORDER_FIFO = "fifo"  # in the order they were pulled
+ORDER_SIZE = "size"  # alerts with more IoCs first
+ORDER_PRIORITY = "priority"  # by the priority attribute of their message, then like size
+ORDERS = (ORDER_FIFO, ORDER_SIZE, ORDER_PRIORITY)
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_ORDER = ORDER_SIZE
+
+
+class PriorityScheduler:
+    """
+    This class decides in which order the VirusTotal lookups of a batch run, and when the lookups
+    of an alert can stop. Alerts are ranked by the configured order, and among alerts of the same rank
+    the ones with fewer IoCs left to look up (the others came from the local lists, the cache or a bulk)
+    go first, since they are the closest to done. Every IoC is looked up at the rank of the best ranked
+    alert that needs it.
+
+    With a decision_severity an alert is decided as soon as its severity reaches it, or its highest
+    reachable severity (the IoCs left counted as malicious) stays below it: looking up its other IoCs
+    cannot change which side of the threshold it is on.
+    """
+    def __init__(self, order: str = DEFAULT_ORDER, decision_severity: int = None):
+        """
+        This method initializes the PriorityScheduler.
+
+        Parameters:
+        order (str): ORDER_FIFO, ORDER_SIZE or ORDER_PRIORITY.
+        decision_severity (int): severity that decides an alert, None to look up every IoC.
+
+        Returns:
+        None
+        """
+        if order not in ORDERS:
+            raise ValueError(f"unknown alert order {order}, use {', '.join(ORDERS)}")
+        self.order = order
+        self.decision_severity = decision_severity
+
+    @classmethod
+    def from_env(cls):
+        """
+        This method creates the PriorityScheduler from the ALERT_ORDER and EARLY_EXIT_SEVERITY settings of the .env file.
+
+        Returns:
+        PriorityScheduler
+        """
+        decision_severity = os.getenv("EARLY_EXIT_SEVERITY")
+        return cls(
+            order=os.getenv("ALERT_ORDER", DEFAULT_ORDER).lower(),
+            decision_severity=int(decision_severity) if decision_severity else None
+        )
+
+    def alert_rank(self, score, position: int) -> tuple:
+        """
+        This method returns the rank of an alert in the batch, lower goes first.
+
+        Parameters:
+        score (AlertScore): the running score of the alert.
+        position (int): the position of the alert in the batch.
+
+        Returns:
+        tuple to sort by
+        """
+        lookups_left = len(score.records) - score.resolved
+        if self.order == ORDER_FIFO:
+            return (position,)
+        if self.order == ORDER_SIZE:
+            return (-len(score.records), lookups_left, position)
+        return (-score.alert.priority, -len(score.records), lookups_left, position)
+
+    def order_lookups(self, scores: list, pending_scores: dict) -> list:
+        """
+        This method returns the IoCs that wait for a lookup, in the order to look them up.
+
+        Parameters:
+        scores (list): AlertScore of every alert of the batch, in the batch order.
+        pending_scores (dict): IoC -> AlertScores waiting for its verdict.
+
+        Returns:
+        list of IoCs
+        """
+        ranks = {id(score): self.alert_rank(score, position) for position, score in enumerate(scores)}
+        return sorted(pending_scores, key=lambda ioc: min(ranks[id(score)] for score in pending_scores[ioc]))
+
+    def is_decided(self, score) -> bool:
+        """
+        This method returns whether the lookups of the alert can stop.
+
+        Parameters:
+        score (AlertScore): the running score of the alert.
+
+        Returns:
+        True if the alert has IoCs left and none of them can move it across decision_severity
+        """
+        if self.decision_severity is None or score.complete:
+            return False
+        return score.severity >= self.decision_severity or score.max_severity < self.decision_severity
@@ -0,0 +1,151 @@
+import os
+import logging
+import threading
+from app.metrics import DISABLED_METRICS
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values, each can be overridden from the .env file.
+# Pub/Sub returns at most 1000 messages per pull.
+DEFAULT_MIN_PULL_SIZE = 10
+DEFAULT_MAX_PULL_SIZE = 1000
+DEFAULT_MIN_INTERVAL_SECONDS = 1.0
+DEFAULT_MAX_INTERVAL_SECONDS = 300.0
+DEFAULT_MAX_BACKLOG = 1000
+# Most seconds a throttled pull waits before the scheduler looks again.
+MAX_THROTTLE_SECONDS = 30.0
+
+# Why a pull was delayed
+THROTTLE_BACKLOG = "backlog"
+THROTTLE_BUDGET = "budget"
+
+
+class PullScheduler:
+    """
+    This class decides how many messages the next pull asks for and how long to wait before it.
+    A pull that comes back full doubles the pull size (up to max_pull_size) and the next pull
+    is made right away, a pull that comes back empty halves the pull size and doubles the wait
+    (from min_interval up to max_interval), anything in between keeps the size and waits min_interval.
+    Pulls are also held back while the enrichment backlog is at max_backlog messages, or while
+    the VirusTotal budget is spent: pulling more then only makes the messages wait in memory.
+    """
+    def __init__(self, min_pull_size: int = DEFAULT_MIN_PULL_SIZE, max_pull_size: int = DEFAULT_MAX_PULL_SIZE,
+                 min_interval: float = DEFAULT_MIN_INTERVAL_SECONDS, max_interval: float = DEFAULT_MAX_INTERVAL_SECONDS,
+                 max_backlog: int = DEFAULT_MAX_BACKLOG, metrics=None):
+        """
+        This method initializes the PullScheduler with the smallest pull size.
+
+        Parameters:
+        min_pull_size (int): pull size to start with and to shrink back to.
+        max_pull_size (int): largest pull size.
+        min_interval (float): seconds between pulls that return some messages.
+        max_interval (float): longest wait after a series of empty pulls.
+        max_backlog (int): messages waiting for enrichment at which pulls are held back.
+        metrics (MetricsRegistry): where the decisions are exposed, None for no metrics.
+
+        Returns:
+        None
+        """
+        self.min_pull_size = min_pull_size
+        self.max_pull_size = max(min_pull_size, max_pull_size)
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.max_backlog = max_backlog
+        self.pull_size = min_pull_size
+        self.interval = min_interval
+        self.empty_pulls = 0
+        self._lock = threading.Lock()
+
+        metrics = metrics if metrics is not None else DISABLED_METRICS
+        self.pull_size_gauge = metrics.gauge("pull_scheduler_pull_size", "Messages the next pull asks for")
+        self.interval_gauge = metrics.gauge("pull_scheduler_interval_seconds", "Seconds to wait before the next pull")
+        self.backlog_gauge = metrics.gauge("pull_scheduler_backlog", "Messages waiting for enrichment at the last decision")
+        self.throttled = metrics.counter("pull_scheduler_throttled_total", "Pulls held back", ("reason",))
+        self.pull_size_gauge.set(self.pull_size)
+        self.interval_gauge.set(self.interval)
+
+    @classmethod
+    def from_env(cls, metrics=None):
+        """
+        This method creates the PullScheduler from the PULL_* settings of the .env file.
+
+        Parameters:
+        metrics (MetricsRegistry): where the decisions are exposed, None for no metrics.
+
+        Returns:
+        PullScheduler
+        """
+        return cls(
+            min_pull_size=int(os.getenv("PULL_MIN_MESSAGES", DEFAULT_MIN_PULL_SIZE)),
+            max_pull_size=int(os.getenv("PULL_MAX_MESSAGES", DEFAULT_MAX_PULL_SIZE)),
+            min_interval=float(os.getenv("PULL_MIN_INTERVAL", DEFAULT_MIN_INTERVAL_SECONDS)),
+            max_interval=float(os.getenv("PULL_MAX_INTERVAL", DEFAULT_MAX_INTERVAL_SECONDS)),
+            max_backlog=int(os.getenv("PULL_MAX_BACKLOG", DEFAULT_MAX_BACKLOG)),
+            metrics=metrics
+        )
+
+    def record_pull(self, received: int, requested: int = None) -> float:
+        """
+        This method adapts the pull size and the interval to the result of a pull.
+
+        Parameters:
+        received (int): number of messages the pull returned.
+        requested (int): number of messages the pull asked for (see pull_size_for), None for the pull size.
+
+        Returns:
+        seconds to wait before the next pull
+        """
+        with self._lock:
+            if requested is None:
+                requested = self.pull_size
+            if received >= requested:
+                # The subscription has a backlog, take bigger bites and do not wait
+                self.pull_size = min(self.max_pull_size, self.pull_size * 2)
+                self.interval = 0.0
+                self.empty_pulls = 0
+            elif received > 0:
+                self.interval = self.min_interval
+                self.empty_pulls = 0
+            else:
+                self.pull_size = max(self.min_pull_size, self.pull_size // 2)
+                self.interval = min(self.max_interval, self.min_interval * 2 ** self.empty_pulls)
+                self.empty_pulls += 1
+            self.pull_size_gauge.set(self.pull_size)
+            self.interval_gauge.set(self.interval)
+            return self.interval
+
+    def throttle_delay(self, backlog: int = 0, rate_limiter=None) -> float:
+        """
+        This method returns how long to hold the next pull back because enrichment cannot keep up.
+
+        Parameters:
+        backlog (int): messages pulled (or spooled) and not enriched yet.
+        rate_limiter (RateLimiter): the VirusTotal budget, None if there is no limit.
+
+        Returns:
+        seconds to wait before pulling, 0 to pull now
+        """
+        self.backlog_gauge.set(backlog)
+        if backlog >= self.max_backlog:
+            self.throttled.labels(THROTTLE_BACKLOG).inc()
+            return min(MAX_THROTTLE_SECONDS, max(self.min_interval, 1.0))
+        if rate_limiter is not None:
+            # The quota is spent or VirusTotal asked to back off, new messages would only wait for budget
+            wait = rate_limiter.seconds_until_available()
+            if wait > 0:
+                self.throttled.labels(THROTTLE_BUDGET).inc()
+                return min(MAX_THROTTLE_SECONDS, max(self.min_interval, wait))
+        return 0.0
+
+    def pull_size_for(self, backlog: int = 0) -> int:
+        """
+        This method returns the size of the next pull, never more than the room left in the backlog.
+
+        Parameters:
+        backlog (int): messages pulled (or spooled) and not enriched yet.
+
+        Returns:
+        number of messages to ask for, at least 1
+        """
+        return max(1, min(self.pull_size, self.max_backlog - backlog))
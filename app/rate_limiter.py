@@ -0,0 +1,237 @@
+import os
+import time
+import logging
+import threading
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# The quotas of the VirusTotal public API, each can be overridden from the .env file.
+DEFAULT_REQUESTS_PER_MINUTE = 4
+DEFAULT_REQUESTS_PER_DAY = 500
+
+# How long to back off on a 429 response that has no (valid) Retry-After header.
+DEFAULT_RETRY_AFTER_SECONDS = 60
+
+# Waiting lookups re-check the clock at least this often, so a budget that refills
+# (or a back off that ends) is noticed even when nobody notifies them.
+MAX_WAIT_SLICE_SECONDS = 0.5
+
+
+def parse_retry_after(value, default: float = DEFAULT_RETRY_AFTER_SECONDS) -> float:
+    """
+    This function parses a Retry-After header that is either a number of seconds or an HTTP date.
+
+    Parameters:
+    value (str): the header value, may be None.
+    default (float): seconds to return when the header is missing or invalid.
+
+    Returns:
+    number of seconds to wait
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    # An HTTP date, the email package is only imported for it
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class TokenBucket:
+    """
+    This class is a token bucket that holds up to capacity tokens
+    and refills completely over refill_period seconds.
+    """
+    def __init__(self, capacity: int, refill_period: float, timer):
+        self.capacity = capacity
+        self.refill_rate = capacity / refill_period
+        self.tokens = float(capacity)
+        self.timer = timer
+        self.updated_at = timer()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def seconds_until_available(self, now: float) -> float:
+        """
+        This method returns how long until the bucket has a whole token, 0 if it has one now.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.refill_rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """
+    This class enforces the per-minute and per-day VirusTotal quotas for all the threads that share it.
+    Lookups that find the budget spent wait in a first come first served queue until it refills,
+    and a 429 response pauses every lookup for the Retry-After period.
+    """
+    def __init__(self, requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+                 requests_per_day: int = DEFAULT_REQUESTS_PER_DAY, timer=time.monotonic):
+        """
+        This method initializes a full token bucket for every quota.
+
+        Parameters:
+        requests_per_minute (int): requests allowed in a minute.
+        requests_per_day (int): requests allowed in a day.
+        timer (callable): monotonic clock source, replaceable in tests.
+
+        Returns:
+        None
+        """
+        self.timer = timer
+        self.buckets = {
+            "minute": TokenBucket(requests_per_minute, 60, timer),
+            "day": TokenBucket(requests_per_day, 24 * 60 * 60, timer),
+        }
+        self.paused_until = 0.0
+        self.rate_limited_responses = 0
+        self._condition = threading.Condition()
+        # Tickets keep the waiting lookups in arrival order.
+        self._next_ticket = 0
+        self._serving_ticket = 0
+        logger.info("RateLimiter initialized successfully")
+
+    @classmethod
+    def from_env(cls):
+        """
+        This method builds a RateLimiter from the VIRUSTOTAL_REQUESTS_PER_* environment variables.
+
+        Returns:
+        RateLimiter
+        """
+        return cls(
+            requests_per_minute=int(os.getenv("VIRUSTOTAL_REQUESTS_PER_MINUTE", DEFAULT_REQUESTS_PER_MINUTE)),
+            requests_per_day=int(os.getenv("VIRUSTOTAL_REQUESTS_PER_DAY", DEFAULT_REQUESTS_PER_DAY)),
+        )
+
+    def _seconds_until_allowed(self, now: float) -> float:
+        wait = max(0.0, self.paused_until - now)
+        for bucket in self.buckets.values():
+            wait = max(wait, bucket.seconds_until_available(now))
+        return wait
+
+    def try_acquire(self, reserve: int = 0) -> bool:
+        """
+        This method takes one request from every quota if all of them have budget
+        and no lookup is already waiting, without blocking.
+
+        Parameters:
+        reserve (int): requests of every quota that must be left after this one, for the live lookups
+        when the request is a background one.
+
+        Returns:
+        True if the request may be sent now, False otherwise
+        """
+        with self._condition:
+            if not self._has_spare_budget(reserve):
+                return False
+            self._take()
+            return True
+
+    def acquire(self):
+        """
+        This method blocks until the caller's turn comes and every quota has budget,
+        then takes one request from every quota.
+
+        Returns:
+        None
+        """
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while True:
+                if ticket == self._serving_ticket:
+                    wait = self._seconds_until_allowed(self.timer())
+                    if wait <= 0:
+                        self._take()
+                        self._serving_ticket += 1
+                        # Let the next lookup in line check the budget
+                        self._condition.notify_all()
+                        return
+                else:
+                    wait = MAX_WAIT_SLICE_SECONDS
+                self._condition.wait(min(wait, MAX_WAIT_SLICE_SECONDS))
+
+    def _take(self):
+        for bucket in self.buckets.values():
+            bucket.take()
+
+    def seconds_until_available(self) -> float:
+        """
+        This method returns the seconds until every quota has budget and no back off is in progress, 0 if a request may be sent now.
+        """
+        with self._condition:
+            return self._seconds_until_allowed(self.timer())
+
+    def has_spare_budget(self, reserve: int = 0) -> bool:
+        """
+        This method returns whether a background request can be sent without delaying a live one:
+        no lookup is waiting, no back off is in progress, and every quota keeps reserve requests after it.
+
+        Parameters:
+        reserve (int): requests of every quota left for the live lookups.
+
+        Returns:
+        True if there is spare budget
+        """
+        with self._condition:
+            return self._has_spare_budget(reserve)
+
+    def _has_spare_budget(self, reserve: int) -> bool:
+        if self._next_ticket != self._serving_ticket:
+            return False
+        now = self.timer()
+        if self.paused_until > now:
+            return False
+        for bucket in self.buckets.values():
+            bucket.refill(now)
+            if bucket.tokens < 1 + reserve:
+                return False
+        return True
+
+    def back_off(self, seconds: float):
+        """
+        This method pauses all lookups for the given number of seconds, used when VirusTotal answers 429.
+
+        Parameters:
+        seconds (float): the Retry-After period.
+
+        Returns:
+        None
+        """
+        with self._condition:
+            self.rate_limited_responses += 1
+            self.paused_until = max(self.paused_until, self.timer() + seconds)
+        logger.warning(f"VirusTotal rate limit reached, backing off for {seconds:.1f} seconds")
+
+    def remaining(self) -> dict:
+        """
+        This method reports the remaining budget.
+
+        Returns:
+        dict with the whole requests left in each quota, the seconds left in a back off,
+        and the number of lookups waiting for budget.
+        """
+        with self._condition:
+            now = self.timer()
+            for bucket in self.buckets.values():
+                bucket.refill(now)
+            return {
+                "minute": int(self.buckets["minute"].tokens),
+                "day": int(self.buckets["day"].tokens),
+                "backoff_seconds": max(0.0, self.paused_until - now),
+                "queued": self._next_ticket - self._serving_ticket,
+            }
@@ -0,0 +1,370 @@
+import os
+import re
+import gzip
+import json
+import time
+import sqlite3
+import logging
+import argparse
+import threading
+from datetime import datetime
+from app.utils import ensure_output_directory
+from app.ioc_classifier import classify_ioc, ioc_match_keys
+from app.config import load_env
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_REPORT_INDEX_DB = "app/output/report_index.db"
+DEFAULT_COMMIT_EVERY = 100
+
+# Format of get_current_time, the time part of the report file names
+TIME_FORMAT = "%d%m%Y_%H%M%S_%f"
+_FILE_TIME = re.compile(r"^reports?_(\d{8}_\d{6}_\d{6})")
+
+# Units of the durations of the query CLI, e.g. --since 1h
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def index_key(ioc: str) -> str:
+    """
+    This function returns the form an IoC is indexed and queried by, so "1.2.3.4" and an upper case
+    hash or domain find the same alerts.
+
+    Parameters:
+    ioc (str)
+
+    Returns:
+    the normalized IoC, the IoC itself if it cannot be classified
+    """
+    ioc = ioc.strip()
+    ioc_type = classify_ioc(ioc)
+    return ioc_match_keys(ioc, ioc_type)[0] if ioc_type else ioc
+
+
+def file_time(path: str) -> float:
+    """
+    This function returns the time in the name of a report file (report_<time>.json, reports_<time>_<pid>.jsonl),
+    or its modification time if the name has none.
+
+    Parameters:
+    path (str)
+
+    Returns:
+    unix time
+    """
+    match = _FILE_TIME.match(os.path.basename(path))
+    if match:
+        try:
+            return datetime.strptime(match.group(1), TIME_FORMAT).timestamp()
+        except ValueError:
+            pass
+    return os.path.getmtime(path)
+
+
+class ReportIndex:
+    """
+    This class keeps a SQLite index of the saved reports: every alert with its severity and the time it was saved,
+    and every IoC -> the alerts that contain it. It is updated as the reports are saved, so the lookups by IoC,
+    severity or time range read a few index pages instead of opening every report file.
+    A report saved again under the same AlertId (e.g. a complete report after a partial one) replaces it.
+    """
+    def __init__(self, db_path: str = DEFAULT_REPORT_INDEX_DB, commit_every: int = DEFAULT_COMMIT_EVERY, timer=time.time):
+        """
+        This method opens (or creates) the index.
+
+        Parameters:
+        db_path (str): path of the SQLite database file.
+        commit_every (int): reports added before they are committed, flush commits the rest.
+        timer (callable): returns the current unix time, replaceable in tests.
+
+        Returns:
+        None
+        """
+        directory = os.path.dirname(db_path)
+        if directory:
+            ensure_output_directory(directory=directory)
+        self.db_path = db_path
+        self.commit_every = commit_every
+        self.timer = timer
+        self.indexed = 0
+        self._uncommitted = 0
+        # Worker processes of the supervisor can share the index, wait for each other's commits
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS alerts (alert_id TEXT PRIMARY KEY, severity INTEGER NOT NULL,"
+            " saved_at REAL NOT NULL, partial INTEGER NOT NULL DEFAULT 0, location TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS alerts_severity ON alerts (severity, saved_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS alerts_saved_at ON alerts (saved_at)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS alert_iocs (ioc TEXT NOT NULL, alert_id TEXT NOT NULL,"
+            " PRIMARY KEY (ioc, alert_id)) WITHOUT ROWID"
+        )
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        """
+        This method creates the ReportIndex from the REPORT_INDEX_DB setting of the .env file.
+
+        Returns:
+        a ReportIndex, or None when REPORT_INDEX_DB is not set (the reports are not indexed)
+        """
+        db_path = os.getenv("REPORT_INDEX_DB")
+        if not db_path:
+            return None
+        return cls(db_path=db_path)
+
+    def add(self, report: dict, saved_at: float = None, location: str = None):
+        """
+        This method indexes a report. It is committed together with the next reports, see flush.
+
+        Parameters:
+        report (dict): the report generated from analyzing the alert.
+        saved_at (float): unix time the report was saved, now if None.
+        location (str): where the report was saved (e.g. its file), None if unknown.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._add_locked(report, self.timer() if saved_at is None else saved_at, location)
+            if self._uncommitted >= self.commit_every:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def _add_locked(self, report: dict, saved_at: float, location: str):
+        alert_id = report["AlertId"]
+        self._db.execute(
+            "INSERT OR REPLACE INTO alerts (alert_id, severity, saved_at, partial, location) VALUES (?, ?, ?, ?, ?)",
+            (alert_id, int(report.get("Severity") or 0), saved_at, int(bool(report.get("Partial"))), location)
+        )
+        self._db.executemany(
+            "INSERT OR IGNORE INTO alert_iocs (ioc, alert_id) VALUES (?, ?)",
+            {(index_key(entry["IoCs"]), alert_id) for entry in report.get("IoCs", [])}
+        )
+        self.indexed += 1
+        self._uncommitted += 1
+
+    def flush(self):
+        """
+        This method commits the reports added since the last commit.
+        """
+        with self._lock:
+            if self._uncommitted:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def query(self, ioc: str = None, min_severity: int = None, max_severity: int = None,
+              since: float = None, until: float = None, limit: int = None) -> list:
+        """
+        This method returns the alerts that match every filter given, the latest first.
+
+        Parameters:
+        ioc (str): alerts that contain this IoC.
+        min_severity (int): alerts with at least this severity.
+        max_severity (int): alerts with at most this severity.
+        since (float): alerts saved at or after this unix time.
+        until (float): alerts saved before this unix time.
+        limit (int): most alerts returned, None for all.
+
+        Returns:
+        list of dicts with the AlertId, Severity, SavedAt, Partial and Location of every alert
+        """
+        conditions = []
+        parameters = []
+        source = "alerts"
+        if ioc is not None:
+            source = "alert_iocs JOIN alerts USING (alert_id)"
+            conditions.append("alert_iocs.ioc = ?")
+            parameters.append(index_key(ioc))
+        for condition, value in (("severity >= ?", min_severity), ("severity <= ?", max_severity),
+                                 ("saved_at >= ?", since), ("saved_at < ?", until)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        sql = f"SELECT alert_id, severity, saved_at, partial, location FROM {source}"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY saved_at DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            parameters.append(limit)
+        with self._lock:
+            rows = self._db.execute(sql, parameters).fetchall()
+        return [{"AlertId": alert_id, "Severity": severity, "SavedAt": saved_at, "Partial": bool(partial), "Location": location}
+                for alert_id, severity, saved_at, partial, location in rows]
+
+    def alert_iocs(self, alert_id: str) -> list:
+        """
+        This method returns the indexed IoCs of an alert.
+        """
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT ioc FROM alert_iocs WHERE alert_id = ? ORDER BY ioc", (alert_id,))]
+
+    def rebuild(self, directory: str) -> int:
+        """
+        This method indexes every report saved in a directory, the report_*.json files, the
+        reports_*.jsonl (.gz or .zst) files of the JSON Lines sink and the database of the SQLite sink
+        (see read_saved_reports). The index is emptied first.
+
+        Parameters:
+        directory (str): the output directory.
+
+        Returns:
+        number of reports indexed
+        """
+        with self._lock:
+            self._db.execute("DELETE FROM alerts")
+            self._db.execute("DELETE FROM alert_iocs")
+            indexed = 0
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                try:
+                    for report, saved_at in read_saved_reports(path):
+                        self._add_locked(report, saved_at, path)
+                        indexed += 1
+                except (OSError, ValueError, KeyError) as e:
+                    logger.error(f"Failed to index {path}: {e}")
+            self._db.commit()
+            self._uncommitted = 0
+        logger.info(f"{indexed} report(s) of {directory} indexed")
+        return indexed
+
+    def close(self):
+        """
+        This method commits what is left and closes the database.
+        """
+        self.flush()
+        with self._lock:
+            self._db.close()
+
+
+def read_reports(path: str):
+    """
+    This function streams the reports of a saved report file, see read_saved_reports. Other files have no reports.
+
+    Parameters:
+    path (str)
+
+    Returns:
+    generator of reports
+    """
+    for report, _ in read_saved_reports(path):
+        yield report
+
+
+def read_saved_reports(path: str):
+    """
+    This function streams the reports of a saved report file with the time they were saved: a report_*.json file,
+    a reports_*.jsonl (.gz or .zst) file of the JSON Lines sink, or a .db file of the SQLite sink (newest first,
+    each report with its own time). A report file gets the time of its name. Other files have no reports.
+
+    Parameters:
+    path (str)
+
+    Returns:
+    generator of (report, unix time it was saved)
+
+    Raises:
+    ValueError if the file is zstd compressed and the zstandard package is not installed
+    """
+    name = os.path.basename(path)
+    if name.startswith("report_") and name.endswith(".json"):
+        with open(path, encoding="utf-8") as file:
+            yield json.load(file), file_time(path)
+    elif name.startswith("reports_") and name.endswith((".jsonl", ".jsonl.gz", ".jsonl.zst")):
+        saved_at = file_time(path)
+        with _open_jsonl(path) as file:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line), saved_at
+    elif name.endswith(".db"):
+        yield from _read_sqlite_reports(path)
+    else:
+        logger.debug(f"{path} is not a report file, skipped")
+
+
+def _open_jsonl(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("reading zstd compressed reports needs the zstandard package, pip install zstandard")
+        return zstandard.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def _read_sqlite_reports(path: str):
+    # Read only, the sink of a running pipeline may be writing to it
+    try:
+        db = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    except sqlite3.Error as e:
+        raise ValueError(f"cannot open {path}: {e}")
+    try:
+        columns = {row[1] for row in db.execute("PRAGMA table_info(reports)")}
+        if not {"report", "saved_at"} <= columns:
+            # Another database in the output directory, e.g. the report index itself
+            logger.debug(f"{path} has no reports table of the SQLite sink, skipped")
+            return
+        default_time = file_time(path)
+        # A report saved again gets a new rowid, so the rowid order is the order they were saved
+        for report, saved_at in db.execute("SELECT report, saved_at FROM reports ORDER BY rowid DESC"):
+            try:
+                saved_at = datetime.strptime(saved_at, TIME_FORMAT).timestamp()
+            except (TypeError, ValueError):
+                saved_at = default_time
+            yield json.loads(report), saved_at
+    except sqlite3.Error as e:
+        raise ValueError(f"cannot read the reports of {path}: {e}")
+    finally:
+        db.close()
+
+
+def parse_time(value: str) -> float:
+    """
+    This function parses a time of the query CLI: an ISO date/time, or a duration back from now like 30m, 1h or 7d.
+    """
+    unit = _DURATION_UNITS.get(value[-1:])
+    if unit is not None and value[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(value[:-1]) * unit
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main(argv: list = None):
+    load_env()
+    parser = argparse.ArgumentParser(description="Query the index of the saved reports")
+    parser.add_argument("--db", default=os.getenv("REPORT_INDEX_DB") or DEFAULT_REPORT_INDEX_DB)
+    parser.add_argument("--rebuild", metavar="DIRECTORY", help="index the reports of the directory again first")
+    parser.add_argument("--ioc", help="alerts that contain this IoC")
+    parser.add_argument("--min-severity", type=int)
+    parser.add_argument("--max-severity", type=int)
+    parser.add_argument("--since", type=parse_time, help="ISO time or a duration back from now: 30m, 1h, 7d")
+    parser.add_argument("--until", type=parse_time, help="ISO time or a duration back from now")
+    parser.add_argument("--limit", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    index = ReportIndex(db_path=args.db)
+    try:
+        if args.rebuild:
+            index.rebuild(args.rebuild)
+        started = time.perf_counter()
+        alerts = index.query(ioc=args.ioc, min_severity=args.min_severity, max_severity=args.max_severity,
+                             since=args.since, until=args.until, limit=args.limit)
+        for alert in alerts:
+            alert["SavedAt"] = datetime.fromtimestamp(alert["SavedAt"]).isoformat(sep=" ", timespec="seconds")
+            print(json.dumps(alert))
+        print(f"{len(alerts)} alert(s) in {(time.perf_counter() - started) * 1000:.1f}ms")
+    finally:
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
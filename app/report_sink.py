@@ -0,0 +1,280 @@
+import os
+import gzip
+import json
+import time
+import sqlite3
+import logging
+import threading
+from app.utils import get_current_time, ensure_output_directory
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_OUTPUT_DIRECTORY = "app/output"
+DEFAULT_FLUSH_EVERY = 100
+DEFAULT_FLUSH_INTERVAL_SECONDS = 5.0
+DEFAULT_ROTATE_BYTES = 64 * 1024 * 1024
+DEFAULT_ROTATE_SECONDS = 60 * 60
+
+
+class ReportSink:
+    """
+    This class is the base of the report sinks. Reports are buffered in memory and written
+    in groups, when flush_every reports are waiting or the oldest waited flush_interval seconds.
+    Every backend implements _write_batch, and close makes a durable flush.
+    """
+    def __init__(self, flush_every: int = DEFAULT_FLUSH_EVERY,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS, timer=time.monotonic):
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.timer = timer
+        self.written = 0
+        self.flushes = 0
+        self.failed = 0
+        # AlertIds of the reports whose write failed, until take_failed hands them out
+        self._failed_ids = set()
+        self._buffer = []
+        self._oldest_at = None
+        self._lock = threading.Lock()
+
+    def write(self, report: dict):
+        """
+        This method buffers the report, and flushes the buffer if it is full or old enough.
+
+        Parameters:
+        report (dict): the report generated from analyzing the alert.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._buffer.append(report)
+            if self._oldest_at is None:
+                self._oldest_at = self.timer()
+            due = len(self._buffer) >= self.flush_every or self.timer() - self._oldest_at >= self.flush_interval
+            if due:
+                self._flush_locked(durable=False)
+
+    def flush(self, durable: bool = False):
+        """
+        This method writes all the buffered reports.
+
+        Parameters:
+        durable (bool): also fsync, so the reports survive a crash of the machine.
+
+        Returns:
+        None
+        """
+        with self._lock:
+            self._flush_locked(durable=durable)
+
+    def _flush_locked(self, durable: bool):
+        batch, self._buffer = self._buffer, []
+        self._oldest_at = None
+        if batch:
+            try:
+                self._write_batch(batch, durable=durable)
+                self.written += len(batch)
+                self.flushes += 1
+            except Exception as e:
+                logger.error(f"Failed to save {len(batch)} report(s): {e}")
+                self.failed += len(batch)
+                self._failed_ids.update(report.get("AlertId") for report in batch)
+                return
+        elif durable:
+            self._sync()
+
+    def take_failed(self) -> set:
+        """
+        This method returns the AlertIds of the reports that could not be written since the last call,
+        so the messages of their alerts are not acknowledged.
+
+        Returns:
+        set of AlertIds
+        """
+        with self._lock:
+            failed, self._failed_ids = self._failed_ids, set()
+        return failed
+
+    def _write_batch(self, batch: list, durable: bool):
+        raise NotImplementedError
+
+    def _sync(self):
+        """
+        Make what was already written durable, backends that keep a file open override it.
+        """
+
+    def close(self):
+        """
+        This method makes a durable flush of the buffered reports and releases the backend.
+        """
+        self.flush(durable=True)
+        with self._lock:
+            self._close_locked()
+
+    def _close_locked(self):
+        pass
+
+
+class JsonFileSink(ReportSink):
+    """
+    This sink saves every report to its own indented json file, named by the time it is written,
+    the same files save_report_to_file creates.
+    """
+    def __init__(self, directory: str = DEFAULT_OUTPUT_DIRECTORY, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        ensure_output_directory(directory=directory)
+
+    def _write_batch(self, batch: list, durable: bool):
+        for report in batch:
+            name_of_file = os.path.join(self.directory, f"report_{get_current_time()}.json")
+            # Reports of one batch can be written within the same microsecond
+            suffix = 1
+            while os.path.exists(name_of_file):
+                name_of_file = os.path.join(self.directory, f"report_{get_current_time()}_{suffix}.json")
+                suffix += 1
+            with open(name_of_file, "w") as file:
+                json.dump(report, file, indent=4)
+                if durable:
+                    file.flush()
+                    os.fsync(file.fileno())
+        logger.info(f"{len(batch)} report(s) saved to {self.directory}")
+
+
+class JsonLinesSink(ReportSink):
+    """
+    This sink appends the reports, one json object per line, to a file that is rotated
+    when it reaches rotate_bytes or is older than rotate_seconds. Rotated files can be
+    compressed with gzip or zstd (zstd needs the zstandard package).
+    """
+    def __init__(self, directory: str = DEFAULT_OUTPUT_DIRECTORY, rotate_bytes: int = DEFAULT_ROTATE_BYTES,
+                 rotate_seconds: float = DEFAULT_ROTATE_SECONDS, compression: str = None, **kwargs):
+        super().__init__(**kwargs)
+        if compression not in (None, "gzip", "zstd"):
+            raise ValueError(f"unknown compression {compression}, use gzip or zstd")
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("zstd compression needs the zstandard package, pip install zstandard")
+        self.directory = directory
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.compression = compression
+        self.rotated_files = []
+        self._file = None
+        self._opened_at = None
+        ensure_output_directory(directory=directory)
+
+    def _open_new_file(self):
+        # The pid keeps the files of worker processes writing to the same directory apart
+        self.current_path = os.path.join(self.directory, f"reports_{get_current_time()}_{os.getpid()}.jsonl")
+        self._file = open(self.current_path, "a", encoding="utf-8")
+        self._opened_at = self.timer()
+
+    def _write_batch(self, batch: list, durable: bool):
+        if self._file is None:
+            self._open_new_file()
+        self._file.write("".join(json.dumps(report) + "\n" for report in batch))
+        self._file.flush()
+        if durable:
+            os.fsync(self._file.fileno())
+        if self._file.tell() >= self.rotate_bytes or self.timer() - self._opened_at >= self.rotate_seconds:
+            self._rotate()
+
+    def _sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _rotate(self):
+        """
+        This method closes the current file and compresses it if compression is set.
+        """
+        self._file.close()
+        self._file = None
+        path = self.current_path
+        if self.compression == "gzip":
+            path = self._compress(path, path + ".gz", gzip.open)
+        elif self.compression == "zstd":
+            import zstandard
+            path = self._compress(path, path + ".zst", lambda target, mode: zstandard.open(target, mode))
+        self.rotated_files.append(path)
+        logger.info(f"reports file rotated to {path}")
+
+    def _compress(self, source: str, target: str, opener) -> str:
+        with open(source, "rb") as plain, opener(target, "wb") as compressed:
+            while True:
+                chunk = plain.read(1024 * 1024)
+                if not chunk:
+                    break
+                compressed.write(chunk)
+        os.remove(source)
+        return target
+
+    def _close_locked(self):
+        if self._file is not None:
+            self._rotate()
+
+
+class SQLiteSink(ReportSink):
+    """
+    This sink stores the reports in a local SQLite database, every flush is one transaction.
+    """
+    def __init__(self, db_path: str = os.path.join(DEFAULT_OUTPUT_DIRECTORY, "reports.db"), **kwargs):
+        super().__init__(**kwargs)
+        directory = os.path.dirname(db_path)
+        if directory:
+            ensure_output_directory(directory=directory)
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS reports (alert_id TEXT PRIMARY KEY, severity INTEGER, saved_at TEXT, report TEXT NOT NULL)"
+        )
+        self._db.commit()
+
+    def _write_batch(self, batch: list, durable: bool):
+        saved_at = get_current_time()
+        # WAL with synchronous=NORMAL only syncs on checkpoints, FULL syncs every commit
+        self._db.execute(f"PRAGMA synchronous={'FULL' if durable else 'NORMAL'}")
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO reports (alert_id, severity, saved_at, report) VALUES (?, ?, ?, ?)",
+                [(report.get("AlertId"), report.get("Severity"), saved_at, json.dumps(report)) for report in batch]
+            )
+
+    def _close_locked(self):
+        self._db.close()
+
+
+def build_report_sink_from_env():
+    """
+    This function builds the report sink selected by the REPORT_SINK environment variable.
+
+    Returns:
+    a ReportSink, or None when REPORT_SINK is not set (save one json file per report right away)
+    """
+    kind = os.getenv("REPORT_SINK", "").lower()
+    if not kind:
+        return None
+    directory = os.getenv("REPORT_OUTPUT_DIRECTORY", DEFAULT_OUTPUT_DIRECTORY)
+    buffering = {
+        "flush_every": int(os.getenv("REPORT_FLUSH_EVERY", DEFAULT_FLUSH_EVERY)),
+        "flush_interval": float(os.getenv("REPORT_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL_SECONDS)),
+    }
+    if kind == "json":
+        return JsonFileSink(directory=directory, **buffering)
+    if kind == "jsonl":
+        return JsonLinesSink(
+            directory=directory,
+            rotate_bytes=int(os.getenv("REPORT_ROTATE_BYTES", DEFAULT_ROTATE_BYTES)),
+            rotate_seconds=float(os.getenv("REPORT_ROTATE_SECONDS", DEFAULT_ROTATE_SECONDS)),
+            compression=os.getenv("REPORT_COMPRESSION") or None,
+            **buffering
+        )
+    if kind == "sqlite":
+        return SQLiteSink(db_path=os.path.join(directory, "reports.db"), **buffering)
+    raise ValueError(f"unknown REPORT_SINK {kind}, use json, jsonl or sqlite")
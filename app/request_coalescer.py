@@ -0,0 +1,62 @@
+import threading
+from concurrent.futures import Future
+
+
+class RequestCoalescer:
+    """
+    This class makes concurrent requests for the same key share one call: the first caller runs it,
+    and every caller that asks for the same key while it is in flight waits for that result instead
+    of sending its own request.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, function):
+        """
+        This method returns function() for the key, sharing the call with concurrent callers of the same key.
+
+        Parameters:
+        key: what identifies the request (e.g. the IoC).
+        function (callable): sends the request, called without arguments.
+
+        Returns:
+        the result of the call
+
+        Raises:
+        whatever the call raised, to every caller that waited for it
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = Future()
+                self._in_flight[key] = future
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def stats(self) -> dict:
+        """
+        This method returns how many calls were sent, and how many requests shared an in-flight call.
+        """
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced}
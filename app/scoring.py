@@ -0,0 +1,228 @@
+import os
+import logging
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# The fields of last_analysis_stats kept in an IocRecord, in this order
+STAT_FIELDS = ("malicious", "suspicious", "harmless", "undetected")
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_POLICY = "binary"
+DEFAULT_WEIGHTS = {"malicious": 1.0, "suspicious": 0.5, "harmless": 0.0, "undetected": 0.0}
+DEFAULT_SATURATION = 5.0
+
+
+def analysis_stats(json_response: dict) -> tuple:
+    """
+    This function extracts the engine counts of a VirusTotal report.
+
+    Parameters:
+    json_response (dict): the json response of a lookup.
+
+    Returns:
+    tuple of the STAT_FIELDS counts, or None if the response has no analysis stats
+    """
+    try:
+        stats = json_response.get("data", {}).get("attributes", {}).get("last_analysis_stats")
+    except AttributeError:
+        return None
+    if not isinstance(stats, dict):
+        return None
+    return tuple(int(stats.get(field) or 0) for field in STAT_FIELDS)
+
+
+class ScoringPolicy:
+    """
+    This class is the base of the scoring policies. A policy scores every IoC between 0 (clean)
+    and 1 (malicious), and the severity of an alert is the mean score of its IoCs, as a percentage.
+    """
+    name = None
+
+    def ioc_score(self, record) -> float:
+        """
+        This method scores the IoC of the record.
+
+        Parameters:
+        record (IocRecord)
+
+        Returns:
+        the score of the IoC, between 0 and 1
+        """
+        raise NotImplementedError
+
+
+class BinaryPolicy(ScoringPolicy):
+    """
+    This policy scores an IoC 1 if it is malicious and 0 otherwise, so the severity is the percentage of malicious IoCs.
+    """
+    name = "binary"
+
+    def ioc_score(self, record) -> float:
+        return 1.0 if record.is_malicious else 0.0
+
+
+class WeightedPolicy(ScoringPolicy):
+    """
+    This policy scores an IoC by the engine counts of its VirusTotal report: the weighted sum of the
+    counts divided by saturation, capped between 0 and 1. With the default weights an IoC that 5 engines
+    flag as malicious (or 10 as suspicious) scores 1. IoCs without counts (resolved by the local lists
+    or the verdict cache) score like in the binary policy.
+    """
+    name = "weighted"
+
+    def __init__(self, weights: dict = None, saturation: float = DEFAULT_SATURATION):
+        """
+        This method initializes the policy.
+
+        Parameters:
+        weights (dict): weight of every field of STAT_FIELDS, missing fields weigh 0. Negative weights lower the score.
+        saturation (float): weighted sum at which an IoC scores 1.
+
+        Returns:
+        None
+        """
+        weights = DEFAULT_WEIGHTS if weights is None else weights
+        unknown = set(weights) - set(STAT_FIELDS)
+        if unknown:
+            raise ValueError(f"unknown scoring weight(s) {sorted(unknown)}, use {', '.join(STAT_FIELDS)}")
+        self.weights = tuple(float(weights.get(field, 0.0)) for field in STAT_FIELDS)
+        self.saturation = max(saturation, 1e-9)
+
+    def ioc_score(self, record) -> float:
+        if record.stats is None:
+            return 1.0 if record.is_malicious else 0.0
+        weighted = sum(weight * count for weight, count in zip(self.weights, record.stats))
+        return min(1.0, max(0.0, weighted / self.saturation))
+
+
+# Policies selectable with SCORING_POLICY, register_policy adds more
+POLICIES = {BinaryPolicy.name: BinaryPolicy, WeightedPolicy.name: WeightedPolicy}
+
+
+def register_policy(name: str, factory):
+    """
+    This function makes a policy selectable with SCORING_POLICY.
+
+    Parameters:
+    name (str): the value of SCORING_POLICY that selects it.
+    factory (callable): returns the ScoringPolicy, called without arguments.
+
+    Returns:
+    None
+    """
+    POLICIES[name] = factory
+
+
+def parse_weights(text: str) -> dict:
+    """
+    This function parses weights written as "malicious=1,suspicious=0.5".
+    """
+    weights = {}
+    for item in text.split(","):
+        if item.strip():
+            field, _, value = item.partition("=")
+            weights[field.strip()] = float(value)
+    return weights
+
+
+def build_scoring_policy_from_env() -> ScoringPolicy:
+    """
+    This function builds the scoring policy selected by the SCORING_POLICY environment variable.
+
+    Returns:
+    a ScoringPolicy, the binary policy when SCORING_POLICY is not set
+    """
+    name = os.getenv("SCORING_POLICY", DEFAULT_POLICY).lower()
+    if name == WeightedPolicy.name:
+        weights = os.getenv("SCORING_WEIGHTS")
+        return WeightedPolicy(weights=parse_weights(weights) if weights else None,
+                              saturation=float(os.getenv("SCORING_SATURATION", DEFAULT_SATURATION)))
+    if name not in POLICIES:
+        raise ValueError(f"unknown SCORING_POLICY {name}, use {', '.join(sorted(POLICIES))}")
+    return POLICIES[name]()
+
+
+class AlertScore:
+    """
+    This class keeps the score of an alert up to date while the verdicts of its IoCs arrive one by one.
+    IoCs that are not resolved yet count as clean in severity (a lower bound of the final severity)
+    and as malicious in max_severity (an upper bound), so a partially enriched alert can be acted on early.
+    """
+    __slots__ = ("alert", "policy", "records", "resolved", "score_sum", "emitted", "_positions")
+
+    def __init__(self, alert, policy: ScoringPolicy):
+        """
+        This method initializes the score with no IoC resolved.
+
+        Parameters:
+        alert (Alert)
+        policy (ScoringPolicy)
+
+        Returns:
+        None
+        """
+        self.alert = alert
+        self.policy = policy
+        self.records = [None] * len(alert.ioc)
+        self.resolved = 0
+        self.score_sum = 0.0
+        # Set once a partial report of the alert was emitted
+        self.emitted = False
+        self._positions = {}
+        for index, ioc in enumerate(alert.ioc):
+            self._positions.setdefault(ioc, []).append(index)
+
+    def add(self, record) -> bool:
+        """
+        This method adds the verdict of an IoC, at every position the IoC has in the alert.
+
+        Parameters:
+        record (IocRecord)
+
+        Returns:
+        True if the alert contains the IoC and it was not resolved yet, False otherwise
+        """
+        positions = self._positions.pop(record.value, None)
+        if positions is None:
+            return False
+        score = self.policy.ioc_score(record)
+        for index in positions:
+            self.records[index] = record
+        self.resolved += len(positions)
+        self.score_sum += score * len(positions)
+        return True
+
+    @property
+    def complete(self) -> bool:
+        return self.resolved == len(self.records)
+
+    @property
+    def severity(self) -> int:
+        """
+        The severity with the IoCs resolved so far, the unresolved ones counted as clean.
+        """
+        return int((self.score_sum / len(self.records)) * 100) if self.records else 0
+
+    @property
+    def max_severity(self) -> int:
+        """
+        The highest severity the alert can still reach, the unresolved IoCs counted as malicious.
+        """
+        if not self.records:
+            return 0
+        return int(((self.score_sum + len(self.records) - self.resolved) / len(self.records)) * 100)
+
+    def to_partial_report(self) -> dict:
+        """
+        This method serializes the alert with the IoCs resolved so far, marked as partial.
+
+        Returns:
+        dict: report like Alert.to_report, with the resolved IoCs only and "Partial": True
+        """
+        return {
+            "AlertId": self.alert.id,
+            "Severity": self.severity,
+            "IoCs": [record.to_report_entry() for record in self.records if record is not None],
+            "Partial": True,
+        }
@@ -0,0 +1,341 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from app.utils import ensure_output_directory
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_SPOOL_DB_PATH = "app/spool/spool.db"
+DEFAULT_MAX_ENTRIES = 100000
+DEFAULT_LEASE_SECONDS = 300.0
+DEFAULT_COMMIT_INTERVAL_SECONDS = 0.05
+DEFAULT_COMMIT_BATCH_SIZE = 500
+DEFAULT_MAX_DELIVERIES = 5
+
+
+class SpoolQueue:
+    """
+    This class is a durable local queue of raw message data between ingestion and enrichment,
+    kept in a SQLite database in WAL mode. Ingestion appends messages and acknowledges them to pub/sub
+    only once they are committed to disk, enrichment takes them at its own pace and deletes them
+    after their reports are saved. Messages that were taken but not deleted (the process crashed,
+    or the lease expired) are handed out again, also after a restart. A message handed out max_deliveries
+    times without being deleted is moved to the dead_letters table, so it cannot hold up the messages behind it.
+
+    Appends are committed in groups: put_many commits a whole pull at once, and put (used by the
+    streaming callbacks) collects messages for up to commit_interval seconds or commit_batch_size
+    messages and commits them together, with one fsync for the group.
+    """
+    def __init__(self, db_path: str = DEFAULT_SPOOL_DB_PATH, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS, commit_interval: float = DEFAULT_COMMIT_INTERVAL_SECONDS,
+                 commit_batch_size: int = DEFAULT_COMMIT_BATCH_SIZE, max_deliveries: int = DEFAULT_MAX_DELIVERIES,
+                 timer=time.time):
+        """
+        This method initializes the SpoolQueue and releases the leases left by a previous run.
+
+        Parameters:
+        db_path (str): path of the SQLite database file.
+        max_entries (int): the spool is full at this many messages, ingestion stops pulling until enrichment catches up.
+        lease_seconds (float): seconds a taken message waits for its deletion before it is handed out again.
+        commit_interval (float): most seconds a message given to put waits for its group commit.
+        commit_batch_size (int): a group commit is made as soon as this many messages wait.
+        max_deliveries (int): times a message is handed out before it is moved to the dead letters, 0 for no cap.
+        timer (callable): returns the current unix time, replaceable in tests.
+
+        Returns:
+        None
+        """
+        directory = os.path.dirname(db_path)
+        if directory:
+            ensure_output_directory(directory=directory)
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.lease_seconds = lease_seconds
+        self.commit_interval = commit_interval
+        self.commit_batch_size = commit_batch_size
+        self.max_deliveries = max_deliveries
+        self.timer = timer
+
+        self.spooled = 0
+        self.consumed = 0
+        self.redelivered = 0
+        self.group_commits = 0
+        self.failed_commits = 0
+        self.dead_lettered = 0
+
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # Every commit is fsynced, the commits are what is batched
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, data BLOB NOT NULL,"
+            " spooled_at REAL NOT NULL, leased_until REAL, deliveries INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS spool_leased_until ON spool (leased_until)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY, data BLOB NOT NULL, spooled_at REAL NOT NULL,"
+            " deliveries INTEGER NOT NULL, dead_at REAL NOT NULL)"
+        )
+        with self._db:
+            # Nothing is in progress right after a start, what the last run left is replayed
+            replayed = self._db.execute("UPDATE spool SET leased_until = NULL WHERE leased_until IS NOT NULL").rowcount
+        self._depth = self._db.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        if self._depth:
+            logger.info(f"spool {db_path} opened with {self._depth} message(s) to replay ({replayed} were in progress)")
+
+        self._lock = threading.Lock()
+        self._pending = []  # (data, on_spooled, on_failed) waiting for the group commit
+        self._pending_condition = threading.Condition()
+        self._room = threading.Condition()
+        self._closed = False
+        self._committer = None
+
+    @classmethod
+    def from_env(cls, worker_index: int = None):
+        """
+        This method creates the SpoolQueue from the SPOOL_* settings of the .env file.
+
+        Parameters:
+        worker_index (int): index of the worker process under the supervisor, every worker has its own spool file
+        with the index as a suffix. None for a single process.
+
+        Returns:
+        a SpoolQueue, or None when SPOOL_DB_PATH is not set (no spool, messages go straight to enrichment)
+        """
+        db_path = os.getenv("SPOOL_DB_PATH")
+        if not db_path:
+            return None
+        if worker_index is not None:
+            root, extension = os.path.splitext(db_path)
+            db_path = f"{root}_{worker_index}{extension}"
+        return cls(
+            db_path=db_path,
+            max_entries=int(os.getenv("SPOOL_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            lease_seconds=float(os.getenv("SPOOL_LEASE_SECONDS", DEFAULT_LEASE_SECONDS)),
+            commit_interval=float(os.getenv("SPOOL_COMMIT_INTERVAL", DEFAULT_COMMIT_INTERVAL_SECONDS)),
+            max_deliveries=int(os.getenv("SPOOL_MAX_DELIVERIES", DEFAULT_MAX_DELIVERIES))
+        )
+
+    def _insert_locked(self, payloads: list):
+        now = self.timer()
+        with self._db:
+            self._db.executemany("INSERT INTO spool (data, spooled_at) VALUES (?, ?)",
+                                 [(sqlite3.Binary(data), now) for data in payloads])
+        self._depth += len(payloads)
+        self.spooled += len(payloads)
+
+    def put_many(self, payloads: list):
+        """
+        This method appends the messages and returns once they are durable, in one transaction.
+
+        Parameters:
+        payloads (list): data (bytes) of the messages.
+
+        Returns:
+        None
+
+        Raises:
+        sqlite3.Error if the messages could not be written, none of them is spooled then
+        """
+        if not payloads:
+            return
+        with self._lock:
+            self._insert_locked(payloads)
+
+    def put(self, data: bytes, on_spooled, on_failed=None):
+        """
+        This method queues one message for the next group commit, and calls on_spooled once it is durable
+        (or on_failed if the commit failed). It returns right away.
+
+        Parameters:
+        data (bytes): the message data.
+        on_spooled (callable): called without arguments once the message is durable, e.g. message.ack.
+        on_failed (callable): called without arguments if the message could not be spooled, e.g. message.nack.
+
+        Returns:
+        None
+        """
+        with self._pending_condition:
+            self._pending.append((data, on_spooled, on_failed))
+            if self._committer is None:
+                self._committer = threading.Thread(target=self._commit_groups, name="spool-committer", daemon=True)
+                self._committer.start()
+            # Wake the committer for the first message of a group, and when the group is full
+            if len(self._pending) == 1 or len(self._pending) >= self.commit_batch_size:
+                self._pending_condition.notify()
+
+    def _commit_groups(self):
+        while True:
+            with self._pending_condition:
+                while not self._pending and not self._closed:
+                    self._pending_condition.wait()
+                if len(self._pending) < self.commit_batch_size and not self._closed:
+                    # Give the group up to commit_interval seconds to fill up
+                    self._pending_condition.wait(self.commit_interval)
+                group, self._pending = self._pending, []
+                closed = self._closed
+            if group:
+                self._commit_group(group)
+            if closed:
+                return
+
+    def _commit_group(self, group: list):
+        try:
+            with self._lock:
+                self._insert_locked([data for data, _, _ in group])
+            self.group_commits += 1
+        except Exception as e:
+            self.failed_commits += 1
+            logger.error(f"Failed to spool {len(group)} message(s): {e}")
+            for _, _, on_failed in group:
+                if on_failed is not None:
+                    on_failed()
+            return
+        for _, on_spooled, _ in group:
+            on_spooled()
+
+    def get_batch(self, max_items: int) -> list:
+        """
+        This method takes up to max_items messages that are not in progress, oldest first,
+        and leases them for lease_seconds. The messages already handed out max_deliveries times
+        are moved to the dead letters instead.
+
+        Parameters:
+        max_items (int)
+
+        Returns:
+        list of (spool id, data) tuples, empty if there is nothing to do
+        """
+        now = self.timer()
+        dead_lettered = 0
+        with self._lock:
+            while True:
+                rows = self._db.execute(
+                    "SELECT id, data, deliveries FROM spool WHERE leased_until IS NULL OR leased_until <= ? ORDER BY id LIMIT ?",
+                    (now, max_items)
+                ).fetchall()
+                poisoned = [row[0] for row in rows if self.max_deliveries and row[2] >= self.max_deliveries]
+                if not poisoned:
+                    break
+                self._dead_letter_locked(poisoned, now)
+                dead_lettered += len(poisoned)
+            if rows:
+                # Leases do not need to survive a crash, they are released on start anyway
+                self._db.execute("PRAGMA synchronous=OFF")
+                try:
+                    with self._db:
+                        self._db.executemany("UPDATE spool SET leased_until = ?, deliveries = deliveries + 1 WHERE id = ?",
+                                             [(now + self.lease_seconds, row[0]) for row in rows])
+                finally:
+                    self._db.execute("PRAGMA synchronous=FULL")
+        if dead_lettered:
+            with self._room:
+                self._room.notify_all()
+        self.redelivered += sum(1 for _, _, deliveries in rows if deliveries)
+        return [(spool_id, bytes(data)) for spool_id, data, _ in rows]
+
+    def _dead_letter_locked(self, spool_ids: list, now: float):
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO dead_letters (id, data, spooled_at, deliveries, dead_at)"
+                " SELECT id, data, spooled_at, deliveries, ? FROM spool WHERE id = ?",
+                [(now, spool_id) for spool_id in spool_ids]
+            )
+            self._db.executemany("DELETE FROM spool WHERE id = ?", [(spool_id,) for spool_id in spool_ids])
+        self._depth -= len(spool_ids)
+        self.dead_lettered += len(spool_ids)
+        logger.error(f"{len(spool_ids)} spooled message(s) {spool_ids} were handed out {self.max_deliveries} times "
+                     f"without being processed, moved to the dead_letters table of {self.db_path}")
+
+    def ack(self, spool_ids: list):
+        """
+        This method deletes the messages whose reports are saved, in one transaction.
+
+        Parameters:
+        spool_ids (list)
+
+        Returns:
+        None
+        """
+        if not spool_ids:
+            return
+        with self._lock:
+            # Losing a deletion in a crash only replays the message, it does not need its own fsync
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            try:
+                with self._db:
+                    deleted = self._db.executemany("DELETE FROM spool WHERE id = ?",
+                                                   [(spool_id,) for spool_id in spool_ids]).rowcount
+            finally:
+                self._db.execute("PRAGMA synchronous=FULL")
+            self._depth -= deleted
+            self.consumed += deleted
+        with self._room:
+            self._room.notify_all()
+
+    def nack(self, spool_ids: list):
+        """
+        This method releases the leases of messages that were taken but not processed, so they are handed out again.
+        """
+        if not spool_ids:
+            return
+        with self._lock:
+            with self._db:
+                self._db.executemany("UPDATE spool SET leased_until = NULL WHERE id = ?",
+                                     [(spool_id,) for spool_id in spool_ids])
+
+    def depth(self) -> int:
+        """
+        This method returns the number of messages in the spool, in progress ones included.
+        """
+        return self._depth
+
+    def is_full(self) -> bool:
+        return self._depth >= self.max_entries
+
+    def wait_for_room(self, timeout: float = None) -> bool:
+        """
+        This method waits until the spool is not full.
+
+        Parameters:
+        timeout (float): most seconds to wait, None to wait as long as needed.
+
+        Returns:
+        True if there is room, False if the timeout passed first
+        """
+        with self._room:
+            return self._room.wait_for(lambda: not self.is_full(), timeout)
+
+    def stats(self) -> dict:
+        """
+        This method returns the spool counters.
+
+        Returns:
+        dict with the depth and the number of spooled, consumed, redelivered and dead lettered messages and group commits
+        """
+        return {
+            "depth": self._depth,
+            "spooled": self.spooled,
+            "consumed": self.consumed,
+            "redelivered": self.redelivered,
+            "group_commits": self.group_commits,
+            "failed_commits": self.failed_commits,
+            "dead_lettered": self.dead_lettered,
+        }
+
+    def close(self):
+        """
+        This method commits the messages waiting for a group commit and closes the database.
+        """
+        with self._pending_condition:
+            self._closed = True
+            self._pending_condition.notify()
+            committer = self._committer
+        if committer is not None:
+            committer.join()
+        with self._lock:
+            self._db.close()
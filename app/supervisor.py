@@ -0,0 +1,283 @@
+import os
+import sys
+import time
+import queue
+import signal
+import logging
+import argparse
+import threading
+import multiprocessing
+from app.main import build_services, run_pipeline, close_services, start_metrics_exporter
+from app.config import load_config
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# Seconds between two stats snapshots sent by a worker.
+STATS_INTERVAL_SECONDS = 10
+# Seconds to wait before restarting a crashed worker, so a worker that crashes on start does not spin.
+RESTART_DELAY_SECONDS = 5
+# Seconds the workers get to finish their in-flight alerts on shutdown before they are terminated.
+SHUTDOWN_TIMEOUT_SECONDS = 120
+# Seconds between two checks of the workers by the supervisor.
+MONITOR_INTERVAL_SECONDS = 1.0
+# Exit code of a worker that stopped while the supervisor is running (e.g. a SIGTERM sent to the worker itself),
+# the supervisor starts it again right away.
+WORKER_STOPPED_EXIT_CODE = 3
+
+
+def worker_stats(worker_index: int, ingestion_service, enrichment_service) -> dict:
+    """
+    This function takes a snapshot of the counters of a worker.
+
+    Returns:
+    dict of the worker counters
+    """
+    verdict_cache = enrichment_service.verdict_cache
+    return {
+        "worker": worker_index,
+        "pid": os.getpid(),
+        "alerts": enrichment_service.alerts_analyzed,
+        "virustotal_requests": enrichment_service.virustotal_client.latency.summary()["requests"],
+        "cache_hits": verdict_cache.stats()["hits"] if verdict_cache is not None else 0,
+        "ack_rpcs": ingestion_service.ack_manager.stats()["ack_rpcs"],
+    }
+
+
+def worker_stop_event(stop_event) -> threading.Event:
+    """
+    This function returns the stop event of a worker process. It is set by a SIGTERM sent to the worker itself,
+    which stops only this worker, and by a watcher thread when the supervisor sets the shared stop_event.
+    Ctrl+C is ignored, the supervisor handles it.
+
+    Parameters:
+    stop_event (multiprocessing.Event): the stop event shared by the supervisor and all its workers.
+
+    Returns:
+    threading.Event
+    """
+    local_stop_event = threading.Event()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: local_stop_event.set())
+
+    def watch_supervisor():
+        # Poll instead of waiting on the shared event: a process that exits while it sleeps in
+        # multiprocessing.Event.wait is still counted as a sleeper, and the next set() blocks forever waking it
+        while not local_stop_event.wait(MONITOR_INTERVAL_SECONDS):
+            if stop_event.is_set():
+                local_stop_event.set()
+
+    threading.Thread(target=watch_supervisor, name="stop-watcher", daemon=True).start()
+    return local_stop_event
+
+
+def worker_main(worker_index: int, worker_count: int, stop_event, stats_queue):
+    """
+    This function is the entry point of a worker process: it runs its own ingestion and enrichment services
+    on the shared subscription until stop_event is set, and sends stats snapshots to the supervisor.
+    A worker stopped on its own, e.g. by a SIGTERM sent to it, drains and exits with WORKER_STOPPED_EXIT_CODE
+    so the supervisor starts it again, the other workers keep running.
+
+    Parameters:
+    worker_index (int)
+    worker_count (int): number of workers, each gets an equal share of the VirusTotal quotas.
+    stop_event (multiprocessing.Event): set by the supervisor to stop after the current batch.
+    stats_queue (multiprocessing.Queue): where the stats snapshots are sent.
+
+    Returns:
+    None
+    """
+    local_stop_event = worker_stop_event(stop_event)
+
+    services = build_services(worker_count=worker_count, worker_index=worker_index)
+    if services is None:
+        return
+    ingestion_service, enrichment_service = services
+
+    def report_stats():
+        while not local_stop_event.wait(STATS_INTERVAL_SECONDS):
+            stats_queue.put(worker_stats(worker_index, ingestion_service, enrichment_service))
+
+    threading.Thread(target=report_stats, daemon=True).start()
+    # Every worker exports its own metrics, on METRICS_PORT + worker_index
+    metrics_exporter = start_metrics_exporter(enrichment_service, worker_index=worker_index)
+    try:
+        run_pipeline(ingestion_service, enrichment_service, local_stop_event)
+    finally:
+        close_services(ingestion_service, enrichment_service)
+        if metrics_exporter is not None:
+            metrics_exporter.stop()
+        stats_queue.put(worker_stats(worker_index, ingestion_service, enrichment_service))
+    if not stop_event.is_set():
+        sys.exit(WORKER_STOPPED_EXIT_CODE)
+
+
+class Supervisor:
+    """
+    This class starts N worker processes that share the subscription, restarts the ones that crash,
+    drains them gracefully on SIGTERM (or Ctrl+C), and aggregates the stats they report.
+    """
+    def __init__(self, worker_count: int, target=worker_main, restart_delay: float = RESTART_DELAY_SECONDS,
+                 shutdown_timeout: float = SHUTDOWN_TIMEOUT_SECONDS):
+        """
+        This method initializes the Supervisor.
+
+        Parameters:
+        worker_count (int): number of worker processes.
+        target (callable): the worker entry point, called with (worker_index, worker_count, stop_event, stats_queue).
+        restart_delay (float): seconds to wait before restarting a crashed worker.
+        shutdown_timeout (float): seconds the workers get to drain on shutdown.
+
+        Returns:
+        None
+        """
+        self.worker_count = worker_count
+        self.target = target
+        self.restart_delay = restart_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.stop_event = multiprocessing.Event()
+        self.stats_queue = multiprocessing.Queue()
+        self.workers = {}  # worker index -> Process
+        self.crashed_at = {}  # worker index -> when its crash was noticed
+        self.restarts = 0
+        self.latest_stats = {}  # worker index -> the latest stats snapshot of its current process
+        self.base_stats = {}  # worker index -> the totals of its processes that ended, so restarts do not reset them
+
+    def _start_worker(self, worker_index: int):
+        process = multiprocessing.Process(
+            target=self.target,
+            args=(worker_index, self.worker_count, self.stop_event, self.stats_queue),
+            name=f"worker-{worker_index}"
+            )
+        process.start()
+        self.workers[worker_index] = process
+        logger.info(f"worker {worker_index} started with pid {process.pid}")
+
+    def start(self):
+        """
+        This method starts all the workers.
+        """
+        for worker_index in range(self.worker_count):
+            self._start_worker(worker_index)
+
+    def collect_stats(self):
+        """
+        This method reads the stats snapshots the workers sent since the last call.
+        """
+        while True:
+            try:
+                stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            process = self.workers.get(stats["worker"])
+            # A late snapshot of a process that ended is already in base_stats
+            if process is None or stats.get("pid") != process.pid:
+                continue
+            self.latest_stats[stats["worker"]] = stats
+
+    def _retire_stats(self, worker_index: int):
+        """
+        This method adds the last stats snapshot of a worker process that ended to the base totals of its index.
+        """
+        self.collect_stats()
+        stats = self.latest_stats.pop(worker_index, None)
+        if stats is None:
+            return
+        base = self.base_stats.setdefault(worker_index, {})
+        for name, value in stats.items():
+            if name not in ("worker", "pid"):
+                base[name] = base.get(name, 0) + value
+
+    def check_workers(self):
+        """
+        This method restarts the workers that crashed, each after restart_delay seconds, and the workers that
+        stopped on their own (WORKER_STOPPED_EXIT_CODE) right away.
+        A worker that exited cleanly (e.g. missing configuration) is not restarted.
+        """
+        now = time.monotonic()
+        for worker_index, process in list(self.workers.items()):
+            if process.is_alive() or self.stop_event.is_set():
+                continue
+            if process.exitcode == 0:
+                logger.info(f"worker {worker_index} exited")
+                self._retire_stats(worker_index)
+                del self.workers[worker_index]
+                continue
+            if process.exitcode == WORKER_STOPPED_EXIT_CODE:
+                logger.info(f"worker {worker_index} stopped, starting it again")
+                self._retire_stats(worker_index)
+                self.restarts += 1
+                self._start_worker(worker_index)
+                continue
+            crashed_at = self.crashed_at.setdefault(worker_index, now)
+            if crashed_at == now:
+                logger.error(f"worker {worker_index} crashed with exit code {process.exitcode}")
+                self._retire_stats(worker_index)
+            if now - crashed_at >= self.restart_delay:
+                del self.crashed_at[worker_index]
+                self.restarts += 1
+                self._start_worker(worker_index)
+
+    def aggregated_stats(self) -> dict:
+        """
+        This method sums the stats of all the workers, the processes that ended included.
+
+        Returns:
+        dict with the totals, the number of workers alive and the number of restarts
+        """
+        self.collect_stats()
+        totals = {}
+        for stats in list(self.base_stats.values()) + list(self.latest_stats.values()):
+            for name, value in stats.items():
+                if name not in ("worker", "pid"):
+                    totals[name] = totals.get(name, 0) + value
+        totals["workers_alive"] = sum(process.is_alive() for process in self.workers.values())
+        totals["restarts"] = self.restarts
+        return totals
+
+    def stop(self):
+        """
+        This method asks the workers to stop, waits for them to finish their in-flight alerts,
+        and terminates the ones that did not finish within shutdown_timeout.
+        """
+        self.stop_event.set()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for worker_index, process in self.workers.items():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"worker {worker_index} did not stop in time, terminating it")
+                process.terminate()
+                process.join()
+        self.collect_stats()
+        logger.info(f"all workers stopped, totals: {self.aggregated_stats()}")
+
+    def run(self):
+        """
+        This method starts the workers and supervises them until SIGTERM or Ctrl+C.
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop_event.set())
+        self.start()
+        last_log = time.monotonic()
+        try:
+            while not self.stop_event.is_set():
+                self.stop_event.wait(MONITOR_INTERVAL_SECONDS)
+                self.check_workers()
+                if time.monotonic() - last_log >= STATS_INTERVAL_SECONDS:
+                    logger.info(f"workers stats: {self.aggregated_stats()}")
+                    last_log = time.monotonic()
+        except KeyboardInterrupt:
+            logger.info("Shutdown requested, exiting gracefully ")
+        finally:
+            logger.info("draining workers...")
+            self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the alert pipeline in several worker processes")
+    parser.add_argument("--workers", type=int, default=load_config().worker_processes or os.cpu_count() or 1)
+    args = parser.parse_args()
+    Supervisor(worker_count=args.workers).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from cachetools import Cache, TLRUCache
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+# The possible verdicts stored in the cache. A failed verdict is stored as well (negative caching)
+# so an IoC that keeps failing does not hit VirusTotal on every alert.
+VERDICT_MALICIOUS = "malicious"
+VERDICT_CLEAN = "clean"
+VERDICT_FAILED = "failed"
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MALICIOUS_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_CLEAN_TTL_SECONDS = 6 * 60 * 60
+DEFAULT_FAILED_TTL_SECONDS = 5 * 60
+
+
+class CacheEntry:
+    """
+    A single cached verdict with the wall clock time it stops being valid.
+    """
+    __slots__ = ("verdict", "expires_at")
+
+    def __init__(self, verdict: str, expires_at: float):
+        self.verdict = verdict
+        self.expires_at = expires_at
+
+
+class _CountingTLRUCache(TLRUCache):
+    """
+    TLRUCache that reports every item pushed out because the cache is full.
+    """
+    def __init__(self, maxsize: int, timer, on_evict):
+        super().__init__(maxsize=maxsize, ttu=lambda key, entry, now: entry.expires_at, timer=timer)
+        self._on_evict = on_evict
+
+    def popitem(self):
+        key, entry = super().popitem()
+        self._on_evict(key, entry)
+        return key, entry
+
+    def peek(self, key):
+        """
+        This method returns the value of the key without making it the most recently used, None if it is missing or expired.
+        """
+        # Unlike get, the membership test and the plain Cache lookup do not move the key in the LRU order
+        if key not in self:
+            return None
+        return Cache.__getitem__(self, key)
+
+
+class VerdictCache:
+    """
+    This class caches VirusTotal verdicts keyed by IoC. It has an in-memory LRU tier
+    and an optional SQLite tier that survives restarts. Every verdict type has its own TTL,
+    and hits, misses and evictions are counted so the cache efficiency can be reported.
+    """
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 malicious_ttl: float = DEFAULT_MALICIOUS_TTL_SECONDS,
+                 clean_ttl: float = DEFAULT_CLEAN_TTL_SECONDS,
+                 failed_ttl: float = DEFAULT_FAILED_TTL_SECONDS,
+                 db_path: str = None, timer=time.time):
+        """
+        This method initializes the memory tier, and opens the disk tier if a db path is given.
+
+        Parameters:
+        max_entries (int): maximum number of verdicts kept in memory.
+        malicious_ttl (float): seconds a malicious verdict stays valid.
+        clean_ttl (float): seconds a clean verdict stays valid.
+        failed_ttl (float): seconds a failed lookup is remembered before retrying it.
+        db_path (str): path of the SQLite file, None to keep the cache in memory only.
+        timer (callable): wall clock source, replaceable in tests.
+
+        Returns:
+        None
+        """
+        self.ttls = {
+            VERDICT_MALICIOUS: malicious_ttl,
+            VERDICT_CLEAN: clean_ttl,
+            VERDICT_FAILED: failed_ttl,
+        }
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # The cache is shared between enrichment threads.
+        self._lock = threading.Lock()
+        self._memory = _CountingTLRUCache(maxsize=max_entries, timer=timer, on_evict=self._count_eviction)
+        self._db = None
+        if db_path:
+            self._open_db(db_path)
+        logger.info("VerdictCache initialized successfully")
+
+    @classmethod
+    def from_env(cls):
+        """
+        This method builds a VerdictCache from the VERDICT_CACHE_* environment variables.
+
+        Returns:
+        VerdictCache
+        """
+        return cls(
+            max_entries=int(os.getenv("VERDICT_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)),
+            malicious_ttl=float(os.getenv("VERDICT_CACHE_MALICIOUS_TTL", DEFAULT_MALICIOUS_TTL_SECONDS)),
+            clean_ttl=float(os.getenv("VERDICT_CACHE_CLEAN_TTL", DEFAULT_CLEAN_TTL_SECONDS)),
+            failed_ttl=float(os.getenv("VERDICT_CACHE_FAILED_TTL", DEFAULT_FAILED_TTL_SECONDS)),
+            db_path=os.getenv("VERDICT_CACHE_DB") or None,
+        )
+
+    def _open_db(self, db_path: str):
+        """
+        This method opens (or creates) the SQLite tier and removes verdicts that already expired.
+
+        Parameters:
+        db_path (str): path of the SQLite file.
+
+        Returns:
+        None
+        """
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The supervisor workers share the file: wait for each other's writes instead of failing with "database is locked"
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS verdicts (ioc TEXT PRIMARY KEY, verdict TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._db.execute("DELETE FROM verdicts WHERE expires_at <= ?", (self.timer(),))
+        self._db.commit()
+
+    def _count_eviction(self, ioc: str, entry: CacheEntry):
+        self.evictions += 1
+
+    def get(self, ioc: str) -> str:
+        """
+        This method returns the cached verdict of the IoC, looking in memory first and then on disk.
+
+        Parameters:
+        ioc (str)
+
+        Returns:
+        the verdict string, or None if the IoC is not cached or its verdict expired
+        """
+        with self._lock:
+            entry = self._memory.get(ioc)
+            if entry is None and self._db is not None:
+                entry = self._get_from_db(ioc)
+                if entry is not None:
+                    # Promote the disk hit to memory so the next lookup is cheaper
+                    self._memory[ioc] = entry
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry.verdict
+
+    def _get_from_db(self, ioc: str) -> CacheEntry:
+        try:
+            row = self._db.execute(
+                "SELECT verdict, expires_at FROM verdicts WHERE ioc = ? AND expires_at > ?",
+                (ioc, self.timer())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to read verdict of {ioc} from disk cache: {e}")
+            return None
+        return CacheEntry(row[0], row[1]) if row else None
+
+    def peek(self, ioc: str) -> CacheEntry:
+        """
+        This method returns the cached entry of the IoC without counting a hit or a miss, for the cache refresher.
+        It does not make the IoC the most recently used either, so looking at an entry does not keep it from eviction.
+
+        Parameters:
+        ioc (str)
+
+        Returns:
+        the CacheEntry, or None if the IoC is not cached or its verdict expired
+        """
+        with self._lock:
+            entry = self._memory.peek(ioc)
+            if entry is None and self._db is not None:
+                entry = self._get_from_db(ioc)
+            return entry
+
+    def set(self, ioc: str, verdict: str, resolved_at: float = None):
+        """
+        This method caches the verdict of the IoC with the TTL of its verdict type.
+
+        Parameters:
+        ioc (str)
+        verdict (str): one of VERDICT_MALICIOUS, VERDICT_CLEAN or VERDICT_FAILED
+        resolved_at (float): unix time the verdict was resolved, now if None. An older verdict expires sooner,
+        and one older than its TTL is not cached.
+
+        Returns:
+        None
+        """
+        entry = CacheEntry(verdict, (self.timer() if resolved_at is None else resolved_at) + self.ttls[verdict])
+        if entry.expires_at <= self.timer():
+            return
+        with self._lock:
+            self._memory[ioc] = entry
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO verdicts (ioc, verdict, expires_at) VALUES (?, ?, ?)",
+                        (ioc, entry.verdict, entry.expires_at)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error(f"Failed to write verdict of {ioc} to disk cache: {e}")
+
+    def stats(self) -> dict:
+        """
+        This method returns the cache counters.
+
+        Returns:
+        dict with hits, misses, evictions, hit ratio and the number of verdicts in memory
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "size": len(self._memory),
+            }
+
+    def close(self):
+        """
+        This method closes the disk tier if it is open.
+        """
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,250 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from app.rate_limiter import parse_retry_after
+
+# Get the logger setup.
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://www.virustotal.com/api/v3/"
+
+# Default values, each can be overridden from the .env file.
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 5.0
+DEFAULT_READ_TIMEOUT_SECONDS = 30.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_BASE_SECONDS = 0.5
+DEFAULT_BACKOFF_MAX_SECONDS = 30.0
+
+# How many times a lookup that got HTTP 429 is retried (after backing off) before giving up.
+MAX_RATE_LIMIT_RETRIES = 3
+
+# Number of recent request latencies kept to calculate the percentiles.
+LATENCY_WINDOW_SIZE = 1000
+
+
+class LatencyStats:
+    """
+    This class records the latency and outcome of every request sent to VirusTotal.
+    """
+    def __init__(self, window_size: int = LATENCY_WINDOW_SIZE):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.status_codes = {}
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self._recent = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, status_code: int = None):
+        """
+        This method records one request, status_code None means the request got no response.
+        """
+        with self._lock:
+            self.requests += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+            self._recent.append(seconds)
+            if status_code is None:
+                self.errors += 1
+            else:
+                self.status_codes[status_code] = self.status_codes.get(status_code, 0) + 1
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def summary(self) -> dict:
+        """
+        This method returns the request counters and latency percentiles (in seconds).
+        """
+        with self._lock:
+            recent = sorted(self._recent)
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "connection_errors": self.errors,
+                "status_codes": dict(self.status_codes),
+                "mean": self.total_seconds / self.requests if self.requests else 0.0,
+                "p50": _percentile(recent, 50),
+                "p99": _percentile(recent, 99),
+                "max": self.max_seconds,
+            }
+
+
+def _percentile(sorted_values: list, percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percent / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class VirusTotalClient:
+    """
+    This class is the HTTP client of the VirusTotal API. It keeps a pooled keep-alive session
+    so lookups reuse their TCP+TLS connections, applies connect and read timeouts so a stuck socket
+    cannot stall the pipeline, and retries 5xx responses and connection errors with jittered exponential backoff.
+    """
+    def __init__(self, api_key: str, base_url: str = DEFAULT_BASE_URL,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT_SECONDS,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_base: float = DEFAULT_BACKOFF_BASE_SECONDS,
+                 backoff_max: float = DEFAULT_BACKOFF_MAX_SECONDS,
+                 pool_size: int = 10, rate_limiter=None, sleep=time.sleep):
+        """
+        This method initializes the session and its connection pool.
+
+        Parameters:
+        api_key (str): the VirusTotal API key.
+        base_url (str): the API root, replaceable to point the client at a stub server.
+        connect_timeout (float): seconds to wait for a connection.
+        read_timeout (float): seconds to wait for the response.
+        max_retries (int): retries of a 5xx response or a connection error.
+        backoff_base (float): the backoff ceiling of the first retry, doubled on every retry.
+        backoff_max (float): the maximum backoff ceiling.
+        pool_size (int): connections kept open, should be at least the number of enrichment workers.
+        rate_limiter (RateLimiter): optional limiter that keeps the lookups inside the VirusTotal quotas.
+        sleep (callable): replaceable in tests.
+
+        Returns:
+        None
+        """
+        self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter
+        self.sleep = sleep
+        self.latency = LatencyStats()
+        self.api_key = api_key
+        self.pool_size = pool_size
+
+        # The session is created by the first request, see the session property
+        self._session = None
+        self._session_lock = threading.Lock()
+        logger.info("VirusTotalClient initialized successfully")
+
+    @property
+    def session(self):
+        """
+        The pooled keep-alive session, requests is imported and the session created the first time it is needed.
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    session.headers.update({"x-apikey": self.api_key or "", "Accept": "application/json"})
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    @classmethod
+    def from_env(cls, pool_size: int = 10, rate_limiter=None):
+        """
+        This method builds a VirusTotalClient from the VIRUSTOTAL_* environment variables.
+
+        Parameters:
+        pool_size (int): connections kept open.
+        rate_limiter (RateLimiter): optional limiter shared by all lookups.
+
+        Returns:
+        VirusTotalClient
+        """
+        return cls(
+            api_key=os.getenv("VIRUSTOTAL_API_KEY"),
+            base_url=os.getenv("VIRUSTOTAL_BASE_URL", DEFAULT_BASE_URL),
+            connect_timeout=float(os.getenv("VIRUSTOTAL_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT_SECONDS)),
+            read_timeout=float(os.getenv("VIRUSTOTAL_READ_TIMEOUT", DEFAULT_READ_TIMEOUT_SECONDS)),
+            max_retries=int(os.getenv("VIRUSTOTAL_MAX_RETRIES", DEFAULT_MAX_RETRIES)),
+            pool_size=pool_size,
+            rate_limiter=rate_limiter,
+        )
+
+    def _backoff_seconds(self, retry: int) -> float:
+        # Full jitter: a random wait up to an exponentially growing ceiling
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (retry - 1)))
+
+    def get_json(self, path: str, params: dict = None, background: bool = False) -> dict:
+        """
+        This method sends a GET request to the given API path and returns the JSON response.
+
+        Parameters:
+        path (str): the path under the API root, e.g. "ip_addresses/1.2.3.4".
+        params (dict): query string parameters, e.g. the query of a search.
+        background (bool): the caller already took the budget of the request (RateLimiter.try_acquire),
+        it is sent once without waiting in the rate limiter queue and without retries, so it never holds up live lookups.
+
+        Returns:
+        the json response dictionary
+
+        Raises:
+        requests.RequestException if the request still fails after all the retries, a 429 included
+        """
+        import requests
+        url = self.base_url + path
+        retries = 0
+        rate_limit_retries = 0
+        while True:
+            # Wait for budget in the VirusTotal quotas
+            if self.rate_limiter is not None and not background:
+                self.rate_limiter.acquire()
+
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.latency.record(time.perf_counter() - started)
+                if background or retries >= self.max_retries:
+                    raise
+                retries += 1
+                self._retry_after_backoff(retries, reason=str(e))
+                continue
+            self.latency.record(time.perf_counter() - started, status_code=response.status_code)
+
+            # On 429 back off for the Retry-After period and try again instead of losing the verdict,
+            # a background request only backs off and gives up
+            if response.status_code == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if self.rate_limiter is not None:
+                    self.rate_limiter.back_off(retry_after)
+                if not background and rate_limit_retries < MAX_RATE_LIMIT_RETRIES:
+                    rate_limit_retries += 1
+                    self.latency.record_retry()
+                    # Without a limiter the next acquire does not wait, so wait here
+                    if self.rate_limiter is None:
+                        logger.warning(f"VirusTotal rate limited the request, retry {rate_limit_retries}/{MAX_RATE_LIMIT_RETRIES} in {retry_after:.2f} seconds")
+                        self.sleep(retry_after)
+                    continue
+                if not background:
+                    logger.error(f"VirusTotal still rate limited the request after {MAX_RATE_LIMIT_RETRIES} retries")
+
+            if response.status_code >= 500 and not background and retries < self.max_retries:
+                retries += 1
+                self._retry_after_backoff(retries, reason=f"HTTP {response.status_code}")
+                continue
+
+            # Raise error if bad response status code
+            response.raise_for_status()
+            return response.json()
+
+    def _retry_after_backoff(self, retry: int, reason: str):
+        self.latency.record_retry()
+        backoff = self._backoff_seconds(retry)
+        logger.warning(f"VirusTotal request failed ({reason}), retry {retry}/{self.max_retries} in {backoff:.2f} seconds")
+        self.sleep(backoff)
+
+    def close(self):
+        """
+        This method closes the pooled connections, if the session was created.
+        """
+        if self._session is not None:
+            self._session.close()
@@ -0,0 +1,106 @@
+"""
+Memory benchmark of the alert representation.
+
+Builds N analyzed alerts from synthetic IoC messages twice: with the dict-backed representation
+the pipeline used before (an Alert with a __dict__, a dict of IoC types and one report dict per IoC
+kept per alert), and with the slotted Alert and its shared IocRecords. Prints the traced bytes per alert.
+
+Run from the project root:
+    python -m benchmarks.alert_memory --alerts 20000
+"""
+import gc
+import uuid
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from app.alert import Alert, IocRecord, SOURCE_REMOTE
+from app.ioc_classifier import classify_ioc
+from publisher_service.publisher import generate_iocs
+
+
+class DictAlert:
+    """
+    The alert representation before slots: attributes in a __dict__, types in a dict,
+    and the analysis kept as one report dict per IoC.
+    """
+    def __init__(self, ioc: list, ioc_types: dict):
+        self.id = str(uuid.uuid4())
+        self.severity = None
+        self.ioc = ioc
+        self.ack_id = None
+        self.ioc_types = ioc_types
+        self.results = None
+
+
+def _build_legacy(messages: list) -> list:
+    alerts = []
+    for message in messages:
+        ioc = message.split("\n")
+        alert = DictAlert(ioc, {value: classify_ioc(value) for value in ioc})
+        alert.results = [{"IoCs": value, "IsMalicious": False} for value in ioc]
+        alert.severity = 0
+        alerts.append(alert)
+    return alerts
+
+
+def _build_compact(messages: list) -> list:
+    alerts = []
+    records = {}
+    for message in messages:
+        ioc = message.split("\n")
+        alert = Alert(ioc, ioc_types=[classify_ioc(value) for value in ioc])
+        # An IoC seen in several alerts shares one record, like in analyze_alerts
+        alert.records = [records.get(value) or records.setdefault(
+            value, IocRecord(value, alert.ioc_type(index), False, SOURCE_REMOTE, time.time()))
+            for index, value in enumerate(ioc)]
+        alert.severity = 0
+        alerts.append(alert)
+    return alerts
+
+
+def _traced_bytes(build, messages: list) -> int:
+    gc.collect()
+    tracemalloc.start()
+    alerts = build(messages)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del alerts
+    return current
+
+
+def run_memory_benchmark(alerts: int = 10000, seed: int = 1) -> dict:
+    """
+    This function measures the memory held by N analyzed alerts in both representations.
+
+    Parameters:
+    alerts (int): number of alerts.
+    seed (int): seed of the synthetic messages.
+
+    Returns:
+    dict with the bytes per alert of both representations and the saving
+    """
+    random.seed(seed)
+    messages = list(generate_iocs(alerts, interval_seconds=0))
+    legacy = _traced_bytes(_build_legacy, messages) / alerts
+    compact = _traced_bytes(_build_compact, messages) / alerts
+    return {
+        "alerts": alerts,
+        "iocs_per_alert": sum(message.count("\n") + 1 for message in messages) / alerts,
+        "legacy_bytes_per_alert": round(legacy),
+        "compact_bytes_per_alert": round(compact),
+        "saving_percent": round((legacy - compact) / legacy * 100, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory footprint of the alert representation")
+    parser.add_argument("--alerts", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(run_memory_benchmark(alerts=args.alerts, seed=args.seed), indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+import time
+import threading
+from types import SimpleNamespace
+
+
+class FakeMessage:
+    """
+    Stand-in for a Pub/Sub message. It has the attributes of a streaming pull message
+    (google.cloud.pubsub_v1.subscriber.message.Message: data, ack_id, publish_time, ack, nack)
+    and, through .message, of a synchronous pull ReceivedMessage.
+    """
+    def __init__(self, data: bytes, ack_id: str, subscriber=None, publish_time: float = None):
+        self.data = data
+        self.ack_id = ack_id
+        self.size = len(data)
+        self.publish_time = publish_time if publish_time is not None else time.time()
+        self.message = SimpleNamespace(data=data, publish_time=self.publish_time)
+        self._subscriber = subscriber
+        self.acked = False
+        self.nacked = False
+
+    def ack(self):
+        self.acked = True
+        if self._subscriber is not None:
+            self._subscriber._release(self)
+
+    def nack(self):
+        self.nacked = True
+        if self._subscriber is not None:
+            self._subscriber._release(self)
+
+
+class FakeStreamingPullFuture:
+    """
+    Stand-in for StreamingPullFuture: cancel stops the delivery thread.
+    """
+    def __init__(self, thread, stopped: threading.Event):
+        self._thread = thread
+        self._stopped = stopped
+
+    def cancel(self):
+        self._stopped.set()
+
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def result(self, timeout: float = None):
+        self._thread.join(timeout)
+
+
+class FakeSubscriber:
+    """
+    In-process fake of pubsub_v1.SubscriberClient that replays the given payloads.
+    It supports the synchronous pull (pull, acknowledge, modify_ack_deadline) and the
+    streaming pull (subscribe), honouring the max_messages flow control: no more than
+    max_messages are delivered and not yet acked or nacked at once.
+
+    With a publish rate, message i becomes available i / rate seconds after the subscriber is created,
+    otherwise all of them are available right away.
+    """
+    def __init__(self, payloads: list, publish_rate: float = None):
+        self.payloads = list(payloads)
+        self.publish_rate = publish_rate
+        self.started_at = time.time()
+        self.messages = []
+        self.peak_outstanding = 0
+        self.pull_rpcs = 0
+        self.ack_rpcs = 0
+        self.modify_deadline_rpcs = 0
+        self.acked_ids = set()
+        self.nacked_ids = set()
+        self._next_index = 0
+        self._outstanding = 0
+        self._condition = threading.Condition()
+
+    def _publish_time(self, index: int) -> float:
+        if not self.publish_rate:
+            return self.started_at
+        return self.started_at + index / self.publish_rate
+
+    def _release(self, message):
+        with self._condition:
+            self._outstanding -= 1
+            self._condition.notify_all()
+
+    @property
+    def exhausted(self) -> bool:
+        """
+        True once every payload was delivered.
+        """
+        with self._condition:
+            return self._next_index >= len(self.payloads)
+
+    def pull(self, request: dict, timeout: float = None):
+        with self._condition:
+            self.pull_rpcs += 1
+            received = []
+            now = time.time()
+            while (self._next_index < len(self.payloads) and len(received) < request["max_messages"]
+                   and self._publish_time(self._next_index) <= now):
+                index = self._next_index
+                message = FakeMessage(self.payloads[index], ack_id=f"ack-{index}", publish_time=self._publish_time(index))
+                self.messages.append(message)
+                received.append(message)
+                self._next_index += 1
+        return SimpleNamespace(received_messages=received)
+
+    def acknowledge(self, request: dict):
+        with self._condition:
+            self.ack_rpcs += 1
+            self.acked_ids.update(request["ack_ids"])
+
+    def modify_ack_deadline(self, request: dict):
+        with self._condition:
+            self.modify_deadline_rpcs += 1
+            if request["ack_deadline_seconds"] == 0:
+                self.nacked_ids.update(request["ack_ids"])
+
+    def subscribe(self, subscription, callback, flow_control=None):
+        max_messages = flow_control.max_messages if flow_control is not None else len(self.payloads)
+        stopped = threading.Event()
+
+        def deliver():
+            while True:
+                with self._condition:
+                    while self._outstanding >= max_messages and not stopped.is_set():
+                        self._condition.wait(0.05)
+                    if stopped.is_set() or self._next_index >= len(self.payloads):
+                        break
+                    index = self._next_index
+                    self._next_index += 1
+                    self._outstanding += 1
+                    self.peak_outstanding = max(self.peak_outstanding, self._outstanding)
+                # Wait until the message is published
+                delay = self._publish_time(index) - time.time()
+                if delay > 0 and stopped.wait(delay):
+                    return
+                message = FakeMessage(self.payloads[index], ack_id=f"ack-{index}", subscriber=self,
+                                      publish_time=self._publish_time(index))
+                self.messages.append(message)
+                callback(message)
+            # A real subscription keeps streaming until it is cancelled
+            stopped.wait()
+
+        thread = threading.Thread(target=deliver, daemon=True)
+        thread.start()
+        return FakeStreamingPullFuture(thread, stopped)
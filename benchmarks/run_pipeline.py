@@ -0,0 +1,233 @@
+"""
+End-to-end benchmark of the ingestion -> enrichment -> report saving pipeline.
+
+Synthetic IoC messages (made by the generator of publisher_service/publisher.py) are replayed
+by an in-process fake subscriber, lookups go to a local stub VirusTotal server, and the results
+(alerts/sec, IoC lookups/sec, p50/p99 end-to-end latency, memory high-water mark) are saved to
+benchmarks/results/ so runs can be compared.
+
+Run from the project root:
+    python -m benchmarks.run_pipeline --messages 500 --workers 8 --latency 0.02
+    python -m benchmarks.run_pipeline --messages 500 --workers 8 --compare benchmarks/results/<previous>.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import shutil
+import resource
+import tempfile
+import threading
+import tracemalloc
+from app.enrichment_service import EnrichmentService
+from app.ingestion_service import IngestionService
+from app.verdict_cache import VerdictCache
+from app.virustotal_client import VirusTotalClient
+from app.report_sink import JsonFileSink, JsonLinesSink, SQLiteSink
+from app.utils import get_current_time, ensure_output_directory
+from app.main import process_alerts, run_streaming_loop
+from benchmarks.fake_pubsub import FakeSubscriber
+from benchmarks.stub_virustotal import StubVirusTotalServer
+from publisher_service.publisher import generate_iocs
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), "results")
+
+
+class InstrumentedEnrichmentService(EnrichmentService):
+    """
+    EnrichmentService that records when the report of every alert was saved.
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.saved_at = {}  # alert id -> time its report was saved
+        self.ack_ids = {}  # alert id -> ack id of its message
+
+    def analyze_alerts(self, alerts: list, on_report=None) -> list:
+        for alert in alerts:
+            self.ack_ids[alert.id] = alert.ack_id
+        return super().analyze_alerts(alerts, on_report=on_report)
+
+    def save_report_to_file(self, report: dict):
+        super().save_report_to_file(report)
+        # A partial report is not the end of the alert
+        if not report.get("Partial"):
+            self.saved_at[report["AlertId"]] = time.time()
+
+
+def percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def build_sink(kind: str, directory: str):
+    if kind == "json":
+        return JsonFileSink(directory=directory)
+    if kind == "jsonl":
+        return JsonLinesSink(directory=directory)
+    if kind == "sqlite":
+        return SQLiteSink(db_path=os.path.join(directory, "reports.db"))
+    return None
+
+
+def run_benchmark(messages: int = 200, mode: str = "pull", workers: int = 8, latency: float = 0.01,
+                  error_rate: float = 0.0, cache: bool = True, sink: str = "jsonl",
+                  publish_rate: float = None, seed: int = 1, bulk_size: int = 0) -> dict:
+    """
+    This function runs the pipeline once over synthetic messages and returns the measurements.
+
+    Parameters:
+    messages (int): number of IoC messages to replay.
+    mode (str): "pull" (synchronous pull batches) or "streaming" (streaming pull).
+    workers (int): ENRICHMENT_MAX_WORKERS of the enrichment service.
+    latency (float): seconds the stub VirusTotal server takes to answer.
+    error_rate (float): fraction of lookups the stub answers with HTTP 500.
+    cache (bool): put a verdict cache in front of VirusTotal.
+    sink (str): json, jsonl or sqlite, written to a temporary directory that is removed after the run,
+    or none to save the reports to app/output like save_report_to_file does without a sink.
+    publish_rate (float): messages published per second, None to publish them all at the start.
+    seed (int): seed of the synthetic messages and the stub errors.
+    bulk_size (int): VIRUSTOTAL_BULK_SIZE of the enrichment service, 0 for single lookups.
+
+    Returns:
+    dict with the parameters and the results of the run
+    """
+    random.seed(seed)
+    payloads = [message.encode() for message in generate_iocs(messages, interval_seconds=0)]
+    total_iocs = sum(len(payload.split(b"\n")) for payload in payloads)
+
+    stub = StubVirusTotalServer(delay=latency, error_rate=error_rate, seed=seed).start()
+    output_directory = tempfile.mkdtemp(prefix="pipeline_benchmark_")
+    ensure_output_directory(output_directory)
+    verdict_cache = VerdictCache() if cache else None
+    virustotal_client = VirusTotalClient(api_key="benchmark", base_url=stub.base_url, pool_size=workers,
+                                         backoff_base=0.01, backoff_max=0.1)
+    report_sink = build_sink(sink, output_directory)
+    enrichment_service = InstrumentedEnrichmentService(verdict_cache=verdict_cache, max_workers=workers,
+                                                       virustotal_client=virustotal_client, report_sink=report_sink,
+                                                       bulk_size=bulk_size)
+    subscriber = FakeSubscriber(payloads, publish_rate=publish_rate)
+    ingestion_service = IngestionService(subscription_name="benchmark", service_account_path="benchmark.json",
+                                         ack_after_report=True, subscriber=subscriber)
+
+    tracemalloc.start()
+    started = time.time()
+    if mode == "streaming":
+        stop_event = threading.Event()
+        watcher = threading.Thread(target=_stop_when_done, args=(enrichment_service, messages, stop_event), daemon=True)
+        watcher.start()
+        run_streaming_loop(ingestion_service, enrichment_service, stop_event, batch_size=workers * 4)
+    else:
+        while len(enrichment_service.saved_at) < messages:
+            received = ingestion_service.pull_messages()
+            if not received:
+                time.sleep(0.01)
+                continue
+            alerts = ingestion_service.transform_messages_to_alerts(received)
+            unsaved_alert_ids = process_alerts(enrichment_service, alerts)
+            ingestion_service.acknowledge_alerts(alerts, unsaved_alert_ids)
+    if report_sink is not None:
+        report_sink.close()
+    elapsed = time.time() - started
+    _, peak_traced_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    ingestion_service.ack_manager.close()
+    virustotal_client.close()
+    stub.stop()
+    shutil.rmtree(output_directory, ignore_errors=True)
+
+    publish_times = {message.ack_id: message.publish_time for message in subscriber.messages}
+    latencies = [saved_at - publish_times[enrichment_service.ack_ids[alert_id]]
+                 for alert_id, saved_at in enrichment_service.saved_at.items()]
+    return {
+        "timestamp": get_current_time(),
+        "parameters": {
+            "messages": messages, "mode": mode, "workers": workers, "latency": latency, "error_rate": error_rate,
+            "cache": cache, "sink": sink, "publish_rate": publish_rate, "seed": seed, "bulk_size": bulk_size,
+        },
+        "results": {
+            "alerts": len(enrichment_service.saved_at),
+            "iocs": total_iocs,
+            "elapsed_seconds": elapsed,
+            "alerts_per_second": len(enrichment_service.saved_at) / elapsed,
+            "ioc_lookups_per_second": total_iocs / elapsed,
+            "upstream_requests": len(stub.requests),
+            "upstream_requests_per_second": len(stub.requests) / elapsed,
+            "latency_p50_seconds": percentile(latencies, 50),
+            "latency_p99_seconds": percentile(latencies, 99),
+            "peak_traced_memory_bytes": peak_traced_bytes,
+            # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024),
+            "ack_rpcs": subscriber.ack_rpcs,
+            "cache": verdict_cache.stats() if verdict_cache is not None else None,
+        },
+    }
+
+
+def _stop_when_done(enrichment_service, messages: int, stop_event):
+    while len(enrichment_service.saved_at) < messages and not stop_event.is_set():
+        time.sleep(0.01)
+    stop_event.set()
+
+
+def save_results(results: dict) -> str:
+    """
+    This function saves the results of a run to benchmarks/results and returns the file path.
+    """
+    ensure_output_directory(RESULTS_DIRECTORY)
+    path = os.path.join(RESULTS_DIRECTORY, f"pipeline_{results['timestamp']}.json")
+    with open(path, "w") as file:
+        json.dump(results, file, indent=4)
+    return path
+
+
+def compare_results(current: dict, previous: dict) -> list:
+    """
+    This function returns a line per numeric result with its previous value and the relative change.
+    """
+    lines = []
+    for name, value in current["results"].items():
+        old = previous.get("results", {}).get(name)
+        if isinstance(value, (int, float)) and isinstance(old, (int, float)):
+            change = (value - old) / old * 100 if old else 0.0
+            lines.append(f"{name:32} {old:>14.4f} -> {value:>14.4f} ({change:+.1f}%)")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the alert pipeline")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--mode", choices=["pull", "streaming"], default="pull")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.01, help="stub VirusTotal latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub responses that are HTTP 500")
+    parser.add_argument("--no-cache", action="store_true", help="run without the verdict cache")
+    parser.add_argument("--sink", choices=["json", "jsonl", "sqlite", "none"], default="jsonl")
+    parser.add_argument("--publish-rate", type=float, default=None, help="messages per second, default all at once")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--bulk-size", type=int, default=0, help="IoCs per bulk VirusTotal search, 0 for single lookups")
+    parser.add_argument("--compare", help="results file of a previous run to compare with")
+    args = parser.parse_args()
+
+    # Keep the per-batch logging of the services out of the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = run_benchmark(messages=args.messages, mode=args.mode, workers=args.workers, latency=args.latency,
+                            error_rate=args.error_rate, cache=not args.no_cache, sink=args.sink,
+                            publish_rate=args.publish_rate, seed=args.seed, bulk_size=args.bulk_size)
+    print(json.dumps(results, indent=4))
+    print(f"results saved to {save_results(results)}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+        print("\n".join(compare_results(results, previous)))
+
+
+if __name__ == "__main__":
+    main()
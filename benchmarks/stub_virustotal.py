@@ -0,0 +1,164 @@
+import json
+import random
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from app.ioc_classifier import (classify_ioc, IOC_TYPE_URL, IOC_TYPE_DOMAIN, IOC_TYPE_MD5, IOC_TYPE_SHA1,
+                                IOC_TYPE_SHA256, VIRUSTOTAL_SEARCH_PATH)
+
+# VirusTotal object type and hash attribute of every IoC type
+_OBJECT_TYPES = {IOC_TYPE_URL: "url", IOC_TYPE_DOMAIN: "domain", IOC_TYPE_MD5: "file", IOC_TYPE_SHA1: "file", IOC_TYPE_SHA256: "file"}
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients that time out close the socket mid-response, which is expected here
+
+
+class StubVirusTotalServer:
+    """
+    A local HTTP server that answers like the VirusTotal v3 API, so the client can be
+    tested end to end (sockets, keep-alive, timeouts) without reaching virustotal.com.
+
+    Besides the single object reports it implements the bulk contract of the search endpoint:
+    GET intelligence/search?query=<term> OR <term> ...&limit=<n> answers {"data": [objects], "meta": {...}}
+    with one object for every term it knows, in no particular order. A term is the IoC itself, or url:"<url>"
+    for a URL. A file object has the sha256 as its id and the searched hash among its attributes, a URL object
+    has the sha256 of the URL as its id and the URL as an attribute, domains and addresses are their own id.
+    """
+    def __init__(self, delay: float = 0.0, error_rate: float = 0.0, seed: int = None):
+        """
+        Parameters:
+        delay (float): seconds every response is delayed by.
+        error_rate (float): fraction of the requests answered with HTTP 500.
+        seed (int): seed of the random errors, to make runs repeatable.
+        """
+        self.delay = delay
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self.malicious = {}  # ioc -> value of last_analysis_stats.malicious
+        self.unknown = set()  # iocs the search does not find
+        self.search_enabled = True  # False answers searches with 403, like an API key without the premium plan
+        self.queued_responses = []  # (status, headers) answered before the normal responses
+        self.requests = []  # request paths in arrival order
+        self.connections = set()  # client (host, port) pairs, one per TCP connection
+        self._lock = threading.Lock()
+        self._server = _QuietHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/api/v3/"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def queue_response(self, status: int, headers: dict = None, count: int = 1):
+        """
+        Answer the next count requests with the given status instead of a report.
+        """
+        with self._lock:
+            self.queued_responses.extend([(status, headers or {})] * count)
+
+    def _next_queued_response(self):
+        with self._lock:
+            return self.queued_responses.pop(0) if self.queued_responses else None
+
+    def _random_error(self) -> bool:
+        with self._lock:
+            return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    def _record(self, path: str, client_address):
+        with self._lock:
+            self.requests.append(path)
+            self.connections.add(client_address)
+
+    def _analysis_stats(self, ioc: str) -> dict:
+        return {"malicious": self.malicious.get(ioc, 0), "suspicious": 0, "harmless": 70, "undetected": 10}
+
+    def report_for(self, ioc: str) -> dict:
+        return {"data": {"id": ioc, "attributes": {"last_analysis_stats": self._analysis_stats(ioc)}}}
+
+    def search_object_for(self, ioc: str) -> dict:
+        """
+        The object of the IoC in a search answer, None if the search does not know it.
+        """
+        ioc_type = classify_ioc(ioc)
+        if ioc_type is None or ioc in self.unknown:
+            return None
+        attributes = {"last_analysis_stats": self._analysis_stats(ioc)}
+        object_type = _OBJECT_TYPES.get(ioc_type, "ip_address")
+        object_id = ioc
+        if object_type == "file":
+            attributes[ioc_type] = ioc
+            object_id = ioc if ioc_type == IOC_TYPE_SHA256 else hashlib.sha256(ioc.encode()).hexdigest()
+        elif object_type == "url":
+            attributes["url"] = ioc
+            object_id = hashlib.sha256(ioc.encode()).hexdigest()
+        return {"type": object_type, "id": object_id, "attributes": attributes}
+
+    def search(self, query: str, limit: int) -> dict:
+        found = []
+        for term in query.split(" OR "):
+            if term.startswith('url:"') and term.endswith('"'):
+                term = term[5:-1].replace('\\"', '"').replace("\\\\", "\\")
+            virustotal_object = self.search_object_for(term)
+            if virustotal_object is not None:
+                found.append(virustotal_object)
+        # Search answers are not in the order of the query
+        with self._lock:
+            self._random.shuffle(found)
+        return {"data": found[:limit], "meta": {"total_hits": len(found)}}
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep the connection open between requests
+
+            def do_GET(self):
+                stub._record(self.path, self.client_address)
+                if stub.delay:
+                    threading.Event().wait(stub.delay)
+                queued = stub._next_queued_response()
+                if queued is not None:
+                    status, headers = queued
+                    self._send(status, {"error": {"code": "StubError"}}, headers)
+                    return
+                if stub._random_error():
+                    self._send(500, {"error": {"code": "StubError"}})
+                    return
+                url = urlsplit(self.path)
+                if url.path.endswith("/" + VIRUSTOTAL_SEARCH_PATH):
+                    if not stub.search_enabled:
+                        self._send(403, {"error": {"code": "ForbiddenError"}})
+                        return
+                    params = parse_qs(url.query)
+                    self._send(200, stub.search(params.get("query", [""])[0], int(params.get("limit", [10])[0])))
+                    return
+                ioc = url.path.rsplit("/", 1)[-1]
+                self._send(200, stub.report_for(ioc))
+
+            def _send(self, status: int, body: dict, headers: dict = None):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass  # keep the test output clean
+
+        return Handler
@@ -3,10 +3,17 @@ from typing import Generator
 
 from google.cloud import pubsub
 from google.oauth2 import service_account
+from google.auth.credentials import AnonymousCredentials
+from collections import deque
+from dataclasses import dataclass, field
 import os
 import time
 import random
 import json
+import string
+import hashlib
+import argparse
+import threading
 
 ROOT = os.path.dirname(os.path.dirname(__file__))
 TOPIC = "projects/tip-demo-448009/topics/my-topic"
@@ -16,12 +23,30 @@ SA_ENV_VAR = "TIP_SERVICE_ACCOUNT"
 BYTE_OCTATE = 256
 TIMER_INTERVAL_SECONDS = 10
 
+# Set to the host:port of the Pub/Sub emulator to publish to it, no service account is needed then
+EMULATOR_ENV_VAR = "PUBSUB_EMULATOR_HOST"
+
+# Load generator defaults
+DEFAULT_IOCS_PER_MESSAGE = "1-9"
+DEFAULT_IOC_MIX = "ipv4=1"
+DEFAULT_URL_PATH_LENGTH = "8-64"
+DEFAULT_HOT_SET_SIZE = 1000
+DEFAULT_MAX_IN_FLIGHT = 1000
+DEFAULT_BATCH_MAX_MESSAGES = 100
+DEFAULT_BATCH_MAX_BYTES = 1024 * 1024
+DEFAULT_BATCH_MAX_LATENCY = 0.01
+# Publish latencies kept to calculate the percentiles of the report
+LATENCY_WINDOW_SIZE = 100_000
+
 
 class TipDemoError(Exception):
     """ Base Exception """
 
 
 def load_credentials() -> service_account.Credentials:
+    if os.getenv(EMULATOR_ENV_VAR):
+        # The emulator does not authenticate
+        return AnonymousCredentials()
     try:
         if os.path.exists(SA_PATH):
             with open(SA_PATH) as f:
@@ -39,22 +64,273 @@ def publish_msg(msg: str, credentials, topic_name) -> str:
         return future.result()
 
 
-def generate_iocs(limit: int) -> Generator[str] :
+def generate_ioc_message() -> str:
+    return "\n".join(
+        ".".join(
+            str(random.randint(0, 255)) for _ in range(4)
+        ) for _ in range(random.randrange(1, 10))
+    )
+
+
+def generate_iocs(limit: int, interval_seconds: float = TIMER_INTERVAL_SECONDS) -> Generator[str] :
     for _ in range(limit):
-        yield "\n".join(
-            ".".join(
-                str(random.randint(0, 255)) for _ in range(4)
-            ) for _ in range(random.randrange(1, 10))
-        )
-        time.sleep(TIMER_INTERVAL_SECONDS)
+        yield generate_ioc_message()
+        if interval_seconds:
+            time.sleep(interval_seconds)
+
+
+def parse_distribution(spec: str):
+    """
+    Parse an integer distribution: "5" (always 5), "1-9" (uniform between 1 and 9)
+    or "exp:4" (exponential with mean 4, at least 1). Returns a function of a random.Random.
+    """
+    spec = spec.strip()
+    try:
+        if spec.startswith("exp:"):
+            mean = float(spec[4:])
+            if mean < 1:
+                raise ValueError
+            return lambda rng: max(1, round(rng.expovariate(1 / mean)))
+        if "-" in spec:
+            low, high = (int(value) for value in spec.split("-", 1))
+            if not 0 < low <= high:
+                raise ValueError
+            return lambda rng: rng.randint(low, high)
+        value = int(spec)
+        if value < 1:
+            raise ValueError
+        return lambda rng: value
+    except ValueError:
+        raise TipDemoError(f"invalid distribution {spec!r}, use N, LOW-HIGH or exp:MEAN")
+
+
+def parse_ioc_mix(spec: str) -> dict[str, float]:
+    """ Parse the share of every IoC type, e.g. "ipv4=0.6,domain=0.2,url=0.1,sha256=0.1". """
+    mix = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        ioc_type, _, weight = item.partition("=")
+        ioc_type = ioc_type.strip()
+        if ioc_type not in IOC_FACTORIES:
+            raise TipDemoError(f"unknown IoC type {ioc_type!r}, use {', '.join(IOC_FACTORIES)}")
+        mix[ioc_type] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise TipDemoError(f"invalid IoC mix {spec!r}")
+    return mix
+
+
+def _random_label(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice(string.ascii_lowercase + string.digits) for _ in range(length))
+
+
+def _random_domain(rng: random.Random) -> str:
+    return f"{_random_label(rng, rng.randint(3, 12))}.{rng.choice(('com', 'net', 'org', 'io', 'info'))}"
+
+
+def _random_hash(rng: random.Random, algorithm: str) -> str:
+    return hashlib.new(algorithm, rng.getrandbits(64).to_bytes(8, "big")).hexdigest()
+
+
+IOC_FACTORIES = {
+    "ipv4": lambda rng, url_length: ".".join(str(rng.randrange(BYTE_OCTATE)) for _ in range(4)),
+    "domain": lambda rng, url_length: _random_domain(rng),
+    "url": lambda rng, url_length: f"http://{_random_domain(rng)}/{_random_label(rng, url_length)}",
+    "md5": lambda rng, url_length: _random_hash(rng, "md5"),
+    "sha1": lambda rng, url_length: _random_hash(rng, "sha1"),
+    "sha256": lambda rng, url_length: _random_hash(rng, "sha256"),
+}
+
+
+class IocGenerator:
+    """
+    Generates IoC messages for the load generator. With repeat_ratio r every IoC is, with probability r,
+    one already sent (from a hot set of hot_set_size IoCs), so the verdict cache sees realistic hits.
+    """
+    def __init__(self, iocs_per_message: str = DEFAULT_IOCS_PER_MESSAGE, ioc_mix: str = DEFAULT_IOC_MIX,
+                 url_path_length: str = DEFAULT_URL_PATH_LENGTH, repeat_ratio: float = 0.0,
+                 hot_set_size: int = DEFAULT_HOT_SET_SIZE, seed: int | None = None):
+        if not 0.0 <= repeat_ratio <= 1.0:
+            raise TipDemoError(f"repeat ratio must be between 0 and 1, got {repeat_ratio}")
+        self.rng = random.Random(seed)
+        self.iocs_per_message = parse_distribution(iocs_per_message)
+        self.url_path_length = parse_distribution(url_path_length)
+        mix = parse_ioc_mix(ioc_mix)
+        self.ioc_types = list(mix)
+        self.weights = list(mix.values())
+        self.repeat_ratio = repeat_ratio
+        self.hot_set_size = max(1, hot_set_size)
+        self.hot_set = []
+        self.repeated = 0
+        self.generated = 0
+
+    def next_ioc(self) -> str:
+        self.generated += 1
+        if self.hot_set and self.rng.random() < self.repeat_ratio:
+            self.repeated += 1
+            return self.rng.choice(self.hot_set)
+        ioc_type = self.rng.choices(self.ioc_types, weights=self.weights)[0]
+        ioc = IOC_FACTORIES[ioc_type](self.rng, self.url_path_length(self.rng))
+        if len(self.hot_set) < self.hot_set_size:
+            self.hot_set.append(ioc)
+        else:
+            self.hot_set[self.rng.randrange(self.hot_set_size)] = ioc
+        return ioc
+
+    def next_message(self) -> str:
+        return "\n".join(self.next_ioc() for _ in range(self.iocs_per_message(self.rng)))
+
+
+@dataclass
+class LoadReport:
+    """ Outcome of a load generator run. """
+    published: int = 0
+    failed: int = 0
+    bytes: int = 0
+    elapsed: float = 0.0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=LATENCY_WINDOW_SIZE))
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(percent: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1, int(percent / 100 * len(latencies)))]
+
+        return {
+            "published": self.published,
+            "failed": self.failed,
+            "elapsed_seconds": round(self.elapsed, 3),
+            "messages_per_second": round(self.published / self.elapsed, 1) if self.elapsed else 0.0,
+            "megabytes_per_second": round(self.bytes / self.elapsed / 1e6, 3) if self.elapsed else 0.0,
+            "publish_latency_p50_ms": round(percentile(50) * 1000, 2),
+            "publish_latency_p99_ms": round(percentile(99) * 1000, 2),
+        }
+
+
+def run_load(publisher, topic_name: str, next_message, rate: float | None = None, duration: float | None = None,
+             count: int | None = None, clock=time.perf_counter, sleep=time.sleep) -> LoadReport:
+    """
+    Publish messages until count messages or duration seconds, at rate messages per second (None for as fast
+    as possible). publish only queues a message: the futures complete in the background, many in flight at once,
+    and the publisher batches them. Returns once every published message is acknowledged or failed.
+    """
+    if count is None and duration is None:
+        raise TipDemoError("the load needs a message count or a duration")
+    report = LoadReport()
+    pending = 0
+    done = threading.Condition()
+
+    def on_done(future, size: int, started: float):
+        nonlocal pending
+        try:
+            future.result()
+            succeeded = True
+        except Exception as e:
+            succeeded = False
+            print(f"publish failed: {e}")
+        with done:
+            if succeeded:
+                report.published += 1
+                report.bytes += size
+                report.latencies.append(clock() - started)
+            else:
+                report.failed += 1
+            pending -= 1
+            done.notify_all()
+
+    started_at = clock()
+    sent = 0
+    while count is None or sent < count:
+        now = clock()
+        # Keep to the schedule of the target rate
+        due = started_at + sent / rate if rate else now
+        if duration is not None and max(now, due) - started_at >= duration:
+            break
+        if due > now:
+            sleep(due - now)
+        data = next_message().encode()
+        with done:
+            pending += 1
+        publish_started = clock()
+        future = publisher.publish(topic_name, data)
+        future.add_done_callback(lambda future, size=len(data), started=publish_started: on_done(future, size, started))
+        sent += 1
+    with done:
+        done.wait_for(lambda: pending == 0)
+    report.elapsed = clock() - started_at
+    return report
+
+
+def build_publisher(credentials, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+                    batch_max_messages: int = DEFAULT_BATCH_MAX_MESSAGES, batch_max_bytes: int = DEFAULT_BATCH_MAX_BYTES,
+                    batch_max_latency: float = DEFAULT_BATCH_MAX_LATENCY) -> pubsub.PublisherClient:
+    """
+    One publisher for the whole run: messages are sent in batches, and publish blocks while max_in_flight
+    messages are not acknowledged yet.
+    """
+    return pubsub.PublisherClient(
+        credentials=credentials,
+        batch_settings=pubsub.types.BatchSettings(max_messages=batch_max_messages, max_bytes=batch_max_bytes,
+                                                  max_latency=batch_max_latency),
+        publisher_options=pubsub.types.PublisherOptions(flow_control=pubsub.types.PublishFlowControl(
+            message_limit=max_in_flight, limit_exceeded_behavior=pubsub.types.LimitExceededBehavior.BLOCK)),
+    )
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Publish test IoC messages to the Pub/Sub topic")
+    parser.add_argument("--topic", default=TOPIC)
+    parser.add_argument("--load", action="store_true", help="load generator mode, publish at --rate until --count or --duration")
+    parser.add_argument("--rate", type=float, default=None, help="target messages per second, as fast as possible if not set")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to publish for")
+    parser.add_argument("--count", type=int, default=None, help="messages to publish")
+    parser.add_argument("--iocs-per-message", default=DEFAULT_IOCS_PER_MESSAGE, help="N, LOW-HIGH or exp:MEAN")
+    parser.add_argument("--ioc-mix", default=DEFAULT_IOC_MIX, help=f"share of every IoC type, types: {', '.join(IOC_FACTORIES)}")
+    parser.add_argument("--url-path-length", default=DEFAULT_URL_PATH_LENGTH, help="length of the url paths, N, LOW-HIGH or exp:MEAN")
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="share of IoCs repeated from the hot set")
+    parser.add_argument("--hot-set-size", type=int, default=DEFAULT_HOT_SET_SIZE)
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument("--batch-max-messages", type=int, default=DEFAULT_BATCH_MAX_MESSAGES)
+    parser.add_argument("--batch-max-latency", type=float, default=DEFAULT_BATCH_MAX_LATENCY)
+    parser.add_argument("--create-topic", action="store_true", help="create the topic first, e.g. on the emulator")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def run_load_generator(args: argparse.Namespace, credentials) -> LoadReport:
+    generator = IocGenerator(iocs_per_message=args.iocs_per_message, ioc_mix=args.ioc_mix,
+                             url_path_length=args.url_path_length, repeat_ratio=args.repeat_ratio,
+                             hot_set_size=args.hot_set_size, seed=args.seed)
+    publisher = build_publisher(credentials, max_in_flight=args.max_in_flight,
+                                batch_max_messages=args.batch_max_messages, batch_max_latency=args.batch_max_latency)
+    if args.create_topic:
+        try:
+            publisher.create_topic(name=args.topic)
+        except Exception as e:
+            print(f"topic {args.topic} not created: {e}")
+    try:
+        report = run_load(publisher, args.topic, generator.next_message, rate=args.rate,
+                          duration=args.duration, count=args.count)
+    finally:
+        publisher.stop()
+    summary = report.summary()
+    summary["repeated_ioc_ratio"] = round(generator.repeated / generator.generated, 3) if generator.generated else 0.0
+    print(json.dumps(summary, indent=2))
+    return report
 
 
-def main():
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
     try:
         creds = load_credentials()
+        if args.load:
+            run_load_generator(args, creds)
+            return
         for ioc in generate_iocs(random.randint(1, 5)):
-            msg_id = publish_msg(ioc, creds, TOPIC)
-            print(f"Message with id {msg_id} sent to pub/sub topic {TOPIC}")
+            msg_id = publish_msg(ioc, creds, args.topic)
+            print(f"Message with id {msg_id} sent to pub/sub topic {args.topic}")
     except TipDemoError as e:
         print(f"Publisher Service Exited with error: {e}")
 
@@ -0,0 +1,126 @@
+import unittest
+import threading
+from unittest.mock import MagicMock
+from app.ack_manager import AckManager
+
+
+class FakeTimer:
+    """
+    A controllable clock so the flush delay and deadlines can be tested without sleeping.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestAckManager(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Initialize an AckManager without the background thread before each test.
+        """
+        # Arrange
+        self.mock_subscriber = MagicMock()
+        self.timer = FakeTimer()
+        self.ack_manager = AckManager(subscriber=self.mock_subscriber, subscription_name="fake-subscription",
+                                      max_batch_size=3, max_delay=1.0, ack_deadline=60,
+                                      background=False, timer=self.timer)
+
+    def test_flush_by_size(self):
+        """
+        Test that a full batch is acknowledged in a single RPC.
+        """
+        # Act
+        for ack_id in ["a", "b", "c", "d"]:
+            self.ack_manager.ack(ack_id)
+
+        # Assert
+        self.mock_subscriber.acknowledge.assert_called_once_with(
+            request={"subscription": "fake-subscription", "ack_ids": ["a", "b", "c"]}
+        )
+        self.assertEqual(self.ack_manager.stats()["pending"], 1)
+
+    def test_flush_by_time(self):
+        """
+        Test that pending acknowledgements are flushed once the oldest waited max_delay.
+        """
+        # Arrange
+        self.ack_manager.ack("a")
+
+        # Act
+        self.ack_manager.flush_due()
+        not_due_calls = self.mock_subscriber.acknowledge.call_count
+        self.timer.now += 1.0
+        self.ack_manager.flush_due()
+
+        # Assert
+        self.assertEqual(not_due_calls, 0)
+        self.mock_subscriber.acknowledge.assert_called_once()
+        self.assertEqual(self.ack_manager.stats()["ack_rpcs"], 1)
+
+    def test_extend_deadlines_of_in_flight_messages(self):
+        """
+        Test that in-flight messages get their deadline extended in bulk, and stop being extended once acked.
+        """
+        # Arrange
+        self.ack_manager.track("a")
+        self.ack_manager.track("b")
+
+        # Act
+        self.ack_manager.extend_deadlines()  # first extension is immediate
+        self.timer.now += 10
+        self.ack_manager.extend_deadlines()  # not half of the deadline yet
+        self.ack_manager.ack("a")
+        self.timer.now += 30
+        self.ack_manager.extend_deadlines()
+
+        # Assert
+        calls = self.mock_subscriber.modify_ack_deadline.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0].kwargs["request"]["ack_ids"], ["a", "b"])
+        self.assertEqual(calls[1].kwargs["request"]["ack_ids"], ["b"])
+        self.assertEqual(calls[1].kwargs["request"]["ack_deadline_seconds"], 60)
+
+    def test_failed_ack_rpc_is_counted(self):
+        """
+        Test that a failing RPC is logged and counted without raising.
+        """
+        # Arrange
+        self.mock_subscriber.acknowledge.side_effect = Exception("failed to acknowledge")
+        self.ack_manager.ack("a")
+
+        # Act
+        self.ack_manager.close()
+
+        # Assert
+        self.assertEqual(self.ack_manager.stats()["failed_rpcs"], 1)
+        self.assertEqual(self.ack_manager.stats()["acked_messages"], 0)
+
+    def test_counters_from_concurrent_threads(self):
+        """
+        Test that no RPC is lost from the counters when several threads flush and nack at the same time.
+        """
+        # Arrange
+        def work(thread_index):
+            for index in range(300):
+                self.ack_manager.ack(f"{thread_index}-{index}")
+                self.ack_manager.nack([f"nack-{thread_index}-{index}"])
+        threads = [threading.Thread(target=work, args=(thread_index,)) for thread_index in range(6)]
+
+        # Act
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.ack_manager.close()
+
+        # Assert
+        stats = self.ack_manager.stats()
+        self.assertEqual(stats["acked_messages"], 1800)
+        self.assertEqual(stats["modify_deadline_rpcs"], 1800)
+
+
+if __name__ == "__main__":
+    unittest.main()
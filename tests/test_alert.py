@@ -1,4 +1,5 @@
-from app.alert import Alert
+from app.alert import Alert, IocRecord, SOURCE_CACHE, SOURCE_LOCAL, SOURCE_REMOTE, SOURCE_SKIPPED
+from benchmarks.alert_memory import run_memory_benchmark
 import unittest
 
 class TestAlert(unittest.TestCase):
@@ -16,5 +17,49 @@ class TestAlert(unittest.TestCase):
 
         self.assertEqual(alert.severity,80,"alert severity is not updated correctly")
 
+    def test_alert_is_slotted(self):
+        alert = Alert(["1.1.1.1"])
+
+        self.assertFalse(hasattr(alert, "__dict__"), "alert should not carry a __dict__")
+        with self.assertRaises(AttributeError):
+            alert.unknown_attribute = 1
+
+    def test_alert_ioc_types(self):
+        alert = Alert(["1.1.1.1", "example.com"], ioc_types=["ipv4", "domain"])
+
+        self.assertEqual(alert.ioc_types, {"1.1.1.1": "ipv4", "example.com": "domain"})
+        self.assertEqual(alert.ioc_type(1), "domain")
+        self.assertIsNone(Alert(["1.1.1.1"]).ioc_type(0), "unclassified iocs should have no type")
+
+    def test_alert_to_report_keeps_schema(self):
+        alert = Alert(["1.1.1.1", "2.2.2.2"])
+        alert.severity = 50
+        alert.records = [IocRecord("1.1.1.1", "ipv4", True, SOURCE_CACHE, 1.0),
+                         IocRecord("2.2.2.2", "ipv4", False, SOURCE_LOCAL, 2.0)]
+
+        report = alert.to_report()
+
+        self.assertEqual(report, {
+            "AlertId": alert.id,
+            "Severity": 50,
+            "IoCs": [{"IoCs": "1.1.1.1", "IsMalicious": True, "Source": "cache"},
+                     {"IoCs": "2.2.2.2", "IsMalicious": False, "Source": "local"}]
+        })
+
+    def test_unchecked_iocs_are_flagged_in_report(self):
+        skipped = IocRecord("1.1.1.1", "ipv4", False, SOURCE_SKIPPED, 1.0)
+        failed = IocRecord("2.2.2.2", "ipv4", False, SOURCE_REMOTE, 2.0, failed=True)
+
+        entries = [skipped.to_report_entry(), failed.to_report_entry()]
+
+        self.assertEqual(entries, [{"IoCs": "1.1.1.1", "IsMalicious": False, "Source": "skipped", "Skipped": True},
+                                   {"IoCs": "2.2.2.2", "IsMalicious": False, "Source": "remote", "Failed": True}])
+
+    def test_memory_benchmark_compact_is_smaller(self):
+        results = run_memory_benchmark(alerts=500)
+
+        self.assertLess(results["compact_bytes_per_alert"], results["legacy_bytes_per_alert"],
+                        "slotted alerts should take less memory than dict-backed ones")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,142 @@
+import os
+import gzip
+import json
+import shutil
+import unittest
+import threading
+from unittest.mock import MagicMock
+from app.backfill import Checkpoint, alert_from_iocs, list_sources, read_records, run_backfill
+from app.enrichment_service import EnrichmentService
+from app.report_sink import JsonLinesSink
+
+DUMMY_DIR = "./tests/temporary_backfill"
+
+
+def write_file(path: str, text: str, opener=open):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with opener(path, "wt") as file:
+        file.write(text)
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create an archive of IoC messages and reports, and an enrichment service writing to a JSON Lines sink.
+        """
+        shutil.rmtree(DUMMY_DIR, ignore_errors=True)
+        self.archive = os.path.join(DUMMY_DIR, "archive")
+        self.output = os.path.join(DUMMY_DIR, "output")
+        # 3 messages, one of them only malformed IoCs
+        write_file(os.path.join(self.archive, "a_messages.txt"), "1.1.1.1\n2.2.2.2\n\nnot an ioc\n\n3.3.3.3\n")
+        write_file(os.path.join(self.archive, "report_1.json"),
+                   json.dumps({"AlertId": "old-alert", "Severity": 0, "IoCs": [{"IoCs": "4.4.4.4", "IsMalicious": False}]}))
+        write_file(os.path.join(self.archive, "reports_1.jsonl.gz"),
+                   "".join(json.dumps({"AlertId": f"old-{index}", "IoCs": [{"IoCs": f"5.5.5.{index}"}]}) + "\n" for index in range(4)),
+                   opener=gzip.open)
+        self.sources = list_sources([self.archive])
+
+    def tearDown(self):
+        shutil.rmtree(DUMMY_DIR, ignore_errors=True)  # clean up.
+
+    def enrichment_service(self) -> EnrichmentService:
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock(), max_workers=2,
+                                               report_sink=JsonLinesSink(directory=self.output))
+        enrichment_service.query_virustotal = MagicMock(return_value={})
+        return enrichment_service
+
+    def saved_reports(self, enrichment_service) -> list:
+        enrichment_service.report_sink.close()
+        reports = []
+        for name in sorted(os.listdir(self.output)):
+            if name.endswith(".jsonl"):
+                with open(os.path.join(self.output, name)) as file:
+                    reports.extend(json.loads(line) for line in file)
+        return reports
+
+    def test_read_records(self):
+        """
+        Test that messages, report files and compressed JSON Lines reports are streamed as records.
+        """
+        # Act
+        records = [record for source in self.sources for record in read_records(source)]
+
+        # Assert
+        self.assertEqual(len(records), 8)
+        self.assertEqual(records[0], (None, ["1.1.1.1", "2.2.2.2"]))
+        self.assertEqual(records[3], ("old-alert", ["4.4.4.4"]))
+        self.assertEqual(records[7], ("old-3", ["5.5.5.3"]))
+
+    def test_read_records_skips_other_json_files(self):
+        """
+        Test that json files that are not reports, like a backfill checkpoint, are not replayed as reports or messages.
+        """
+        # Arrange
+        checkpoint_path = os.path.join(self.archive, "backfill_checkpoint.json")
+        write_file(checkpoint_path, json.dumps({"source": "a_messages.txt", "offset": 1, "alerts": 1}))
+
+        # Act
+        records = list(read_records(checkpoint_path))
+
+        # Assert
+        self.assertEqual(records, [])
+
+    def test_replayed_iocs_are_deduplicated_like_live(self):
+        """
+        Test that the IoCs of a replayed record are deduplicated by the message parser, like at ingestion.
+        """
+        # Act
+        alert, rejected = alert_from_iocs(["example.com", "EXAMPLE.com", " example.com ", "not an ioc"], "old-alert")
+
+        # Assert
+        self.assertEqual(alert.ioc, ["example.com"])
+        self.assertEqual(alert.id, "old-alert")
+        self.assertEqual(rejected, 1)
+
+    def test_run_backfill(self):
+        """
+        Test that every record is re-enriched and written, the report ids are kept, and the checkpoint is at the end.
+        """
+        # Arrange
+        enrichment_service = self.enrichment_service()
+        checkpoint = Checkpoint(os.path.join(self.output, "checkpoint.json"))
+
+        # Act
+        stats = run_backfill(self.sources, enrichment_service, checkpoint, batch_size=3)
+        reports = self.saved_reports(enrichment_service)
+
+        # Assert
+        self.assertEqual(stats["alerts"], 8)
+        self.assertEqual(stats["batches"], 3)
+        self.assertEqual(stats["rejected_iocs"], 1)
+        self.assertEqual(len(reports), 8)
+        self.assertIn("old-alert", [report["AlertId"] for report in reports])
+        self.assertEqual(Checkpoint(checkpoint.path).offset, 4)
+        self.assertEqual(Checkpoint(checkpoint.path).alerts, 8)
+
+    def test_resume_from_checkpoint(self):
+        """
+        Test that a stopped backfill resumes after the last batch it wrote, without replaying it.
+        """
+        # Arrange
+        checkpoint_path = os.path.join(self.output, "checkpoint.json")
+        first_service = self.enrichment_service()
+        stop_event = threading.Event()
+        stop_event.set()
+
+        # Act
+        first = run_backfill(self.sources, first_service, Checkpoint(checkpoint_path), batch_size=5, stop_event=stop_event)
+        self.saved_reports(first_service)
+        second_service = self.enrichment_service()
+        second = run_backfill(self.sources, second_service, Checkpoint(checkpoint_path), batch_size=5)
+        reports = self.saved_reports(second_service)
+        again = run_backfill(self.sources, self.enrichment_service(), Checkpoint(checkpoint_path), batch_size=5)
+
+        # Assert
+        self.assertEqual((first["alerts"], second["alerts"], again["alerts"]), (5, 3, 0))
+        self.assertEqual(len(reports), 8)
+        self.assertEqual(len({report["AlertId"] for report in reports}), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
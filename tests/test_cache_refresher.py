@@ -0,0 +1,209 @@
+import os
+import json
+import shutil
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+from app.enrichment_service import EnrichmentService
+from app.cache_refresher import CacheRefresher
+from app.metrics import MetricsRegistry
+from app.rate_limiter import RateLimiter
+from app.verdict_cache import VerdictCache, VERDICT_MALICIOUS, VERDICT_CLEAN, VERDICT_FAILED
+
+DUMMY_DIR = "./tests/temporary_cache_refresher"
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def virustotal_response(malicious: int) -> dict:
+    return {"data": {"attributes": {"last_analysis_stats": {"malicious": malicious}}}}
+
+
+class TestCacheRefresher(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create an enrichment service with a verdict cache, a rate limiter of 3 requests a minute and a mocked
+        VirusTotal client that spends the budget, all on one fake clock, and a refresher of the verdicts
+        expiring within 100 seconds.
+        """
+        self.timer = FakeTimer()
+        self.verdict_cache = VerdictCache(malicious_ttl=1000, clean_ttl=1000, failed_ttl=10, timer=self.timer)
+        self.rate_limiter = RateLimiter(requests_per_minute=3, requests_per_day=1000, timer=self.timer)
+        self.virustotal_client = MagicMock()
+        self.virustotal_client.get_json.side_effect = self.get_json
+        self.enrichment_service = EnrichmentService(verdict_cache=self.verdict_cache, rate_limiter=self.rate_limiter,
+                                                    virustotal_client=self.virustotal_client)
+        self.metrics = MetricsRegistry()
+        self.refresher = CacheRefresher(self.enrichment_service, refresh_ahead=100, top_n=10, min_hits=1.5, reserve=1,
+                                        metrics=self.metrics, timer=self.timer)
+        self.enrichment_service.cache_refresher = self.refresher
+
+    def get_json(self, path, background=False):
+        # The client waits for the budget of live lookups, a background request already took it
+        if not background:
+            self.rate_limiter.try_acquire()
+        return virustotal_response(1)
+
+    def tearDown(self):
+        shutil.rmtree(DUMMY_DIR, ignore_errors=True)
+
+    def look_up(self, ioc: str, times: int):
+        for _ in range(times):
+            self.enrichment_service.get_ioc_record(ioc, "ipv4")
+
+    def test_refreshes_hot_verdicts_about_to_expire(self):
+        """
+        Test that only the verdicts of IoCs looked up often enough and close to their expiry are refreshed.
+        """
+        # Arrange
+        self.look_up("1.1.1.1", 3)
+        self.look_up("2.2.2.2", 1)
+        self.timer.now += 950
+        self.verdict_cache.set("3.3.3.3", VERDICT_FAILED)
+        self.look_up("3.3.3.3", 3)
+
+        # Act
+        refreshed = self.refresher.refresh_once()
+
+        # Assert
+        self.assertEqual(refreshed, 1, "2.2.2.2 is cold and the failed verdict of 3.3.3.3 is retried by the live lookups")
+        self.assertEqual(self.verdict_cache.peek("1.1.1.1").expires_at, self.timer.now + 1000)
+        self.assertEqual(self.verdict_cache.peek("2.2.2.2").expires_at, self.timer.now + 50)
+
+    def test_counts_a_lookup_served_warm_by_a_refresh(self):
+        """
+        Test that a lookup answered by a refreshed verdict after the old one would have expired is counted,
+        and that it does not go to VirusTotal.
+        """
+        # Arrange
+        self.look_up("1.1.1.1", 3)
+        self.timer.now += 950
+        self.refresher.refresh_once()
+        calls = self.virustotal_client.get_json.call_count
+
+        # Act
+        self.timer.now += 100
+        record = self.enrichment_service.get_ioc_record("1.1.1.1", "ipv4")
+
+        # Assert
+        self.assertEqual(record.source, "cache")
+        self.assertEqual(self.virustotal_client.get_json.call_count, calls)
+        self.assertEqual(self.refresher.stats()["served_warm"]["refresh"], 1)
+        self.assertIn('cache_warm_hits_total{origin="refresh"} 1', self.metrics.render())
+
+    def test_keeps_the_reserve_for_live_lookups(self):
+        """
+        Test that a round stops when the refreshes would eat into the reserve of the quota.
+        """
+        # Arrange
+        for ioc in ("1.1.1.1", "2.2.2.2", "3.3.3.3"):
+            self.verdict_cache.set(ioc, VERDICT_CLEAN)
+            self.refresher.record_access(ioc, "ipv4")
+            self.refresher.record_access(ioc, "ipv4")
+        self.timer.now += 950
+
+        # Act
+        refreshed = self.refresher.refresh_once()
+
+        # Assert
+        self.assertEqual(refreshed, 2, "the third request of the minute is the reserve")
+        self.assertEqual(self.rate_limiter.remaining()["minute"], 1)
+        self.assertEqual(self.virustotal_client.get_json.call_count, 2, "every refresh should be sent once")
+        for call in self.virustotal_client.get_json.call_args_list:
+            self.assertTrue(call.kwargs["background"], "a refresh should not wait in the rate limiter queue")
+
+    def test_failed_refresh_keeps_the_verdict(self):
+        """
+        Test that a failed refresh leaves the cached verdict until it expires.
+        """
+        # Arrange
+        self.virustotal_client.get_json.side_effect = Exception("timeout")
+        self.verdict_cache.set("1.1.1.1", VERDICT_MALICIOUS)
+        self.look_up("1.1.1.1", 2)
+        self.timer.now += 950
+
+        # Act
+        refreshed = self.refresher.refresh_once()
+
+        # Assert
+        self.assertEqual(refreshed, 0)
+        self.assertEqual(self.verdict_cache.peek("1.1.1.1").verdict, VERDICT_MALICIOUS)
+        self.assertEqual(self.refresher.stats()["failed"], 1)
+
+    def test_warm_from_reports(self):
+        """
+        Test that the VirusTotal verdicts of saved reports are cached with the time of their report,
+        the newest report wins, and the local verdicts, the entries without a Source and verdicts too old are skipped.
+        """
+        # Arrange
+        os.makedirs(DUMMY_DIR)
+        for seconds_ago, report in (
+                (500, {"AlertId": "a", "Severity": 50, "IoCs": [{"IoCs": "1.1.1.1", "IsMalicious": True, "Source": "remote"},
+                                                               {"IoCs": "10.0.0.1", "IsMalicious": False, "Source": "local"},
+                                                               {"IoCs": "3.3.3.3", "IsMalicious": False}]}),
+                (800, {"AlertId": "b", "Severity": 0, "IoCs": [{"IoCs": "1.1.1.1", "IsMalicious": False, "Source": "remote"}]}),
+                (2000, {"AlertId": "c", "Severity": 0, "IoCs": [{"IoCs": "2.2.2.2", "IsMalicious": False, "Source": "remote"}]})):
+            saved_at = datetime.fromtimestamp(self.timer.now - seconds_ago).strftime("%d%m%Y_%H%M%S_%f")
+            with open(os.path.join(DUMMY_DIR, f"report_{saved_at}.json"), "w") as file:
+                json.dump(report, file)
+
+        # Act
+        warmed = self.refresher.warm_from_reports(DUMMY_DIR)
+        record = self.enrichment_service.get_ioc_record("1.1.1.1", "ipv4")
+
+        # Assert
+        self.assertEqual(warmed, 1)
+        self.assertEqual(self.verdict_cache.peek("1.1.1.1").expires_at, self.timer.now + 500)
+        self.assertIsNone(self.verdict_cache.peek("10.0.0.1"))
+        self.assertIsNone(self.verdict_cache.peek("3.3.3.3"), "an entry without a Source may be a failed lookup")
+        self.assertIsNone(self.verdict_cache.peek("2.2.2.2"), "a verdict older than its TTL should not be warmed")
+        self.assertTrue(record.is_malicious)
+        self.assertEqual(self.refresher.stats()["served_warm"]["startup"], 1)
+        self.virustotal_client.get_json.assert_not_called()
+
+    def test_failed_lookup_is_not_warmed_as_clean(self):
+        """
+        Test that the report of an IoC whose lookup failed marks it failed, and that the warm start skips it.
+        """
+        # Arrange
+        os.makedirs(DUMMY_DIR)
+        self.virustotal_client.get_json.side_effect = Exception("429 Too Many Requests")
+        entry = self.enrichment_service.get_ioc_record("1.1.1.1", "ipv4").to_report_entry()
+        saved_at = datetime.fromtimestamp(self.timer.now - 5).strftime("%d%m%Y_%H%M%S_%f")
+        with open(os.path.join(DUMMY_DIR, f"report_{saved_at}.json"), "w") as file:
+            json.dump({"AlertId": "a", "Severity": 0, "IoCs": [entry]}, file)
+        restarted_cache = VerdictCache(malicious_ttl=1000, clean_ttl=1000, failed_ttl=10, timer=self.timer)
+        self.refresher.verdict_cache = restarted_cache
+
+        # Act
+        warmed = self.refresher.warm_from_reports(DUMMY_DIR)
+
+        # Assert
+        self.assertEqual(entry, {"IoCs": "1.1.1.1", "IsMalicious": False, "Source": "remote", "Failed": True})
+        self.assertEqual(warmed, 0)
+        self.assertIsNone(restarted_cache.peek("1.1.1.1"), "a failed lookup should not be cached as clean")
+
+    def test_from_env_disabled(self):
+        """
+        Test that no refresher is created without CACHE_REFRESH_AHEAD and CACHE_WARM_DIRECTORY.
+        """
+        # Arrange
+        for name in ("CACHE_REFRESH_AHEAD", "CACHE_WARM_DIRECTORY"):
+            os.environ.pop(name, None)
+
+        # Act
+        refresher = CacheRefresher.from_env(self.enrichment_service)
+
+        # Assert
+        self.assertIsNone(refresher)
+
+
+if __name__ == "__main__":
+    unittest.main()
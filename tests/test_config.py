@@ -0,0 +1,60 @@
+import os
+import unittest
+from unittest.mock import patch
+from app.config import Config, load_config
+
+
+class TestConfig(unittest.TestCase):
+
+    def test_from_env(self):
+        """
+        Test that the settings are read from the environment, with their defaults.
+        """
+        # Arrange
+        environment = {"SUBSCRIPTION_NAME": "projects/p/subscriptions/s", "SERVICE_ACCOUNT": "key.json",
+                       "ACK_AFTER_REPORT": "TRUE", "INGESTION_MODE": "streaming", "EARLY_EMIT_SEVERITY": "70"}
+
+        # Act
+        with patch.dict(os.environ, environment, clear=True):
+            config = Config.from_env()
+
+        # Assert
+        self.assertEqual(config.subscription_name, "projects/p/subscriptions/s")
+        self.assertTrue(config.ack_after_report)
+        self.assertTrue(config.streaming)
+        self.assertEqual(config.early_emit_severity, 70)
+        self.assertEqual(config.enrichment_max_workers, 1)
+        self.assertIsNone(config.worker_processes)
+
+    def test_invalid_ingestion_mode(self):
+        """
+        Test that an unknown ingestion mode is rejected when the config is read.
+        """
+        # Act & Assert
+        with patch.dict(os.environ, {"INGESTION_MODE": "push"}):
+            with self.assertRaises(ValueError):
+                Config.from_env()
+
+    def test_load_config_once(self):
+        """
+        Test that the config is read once, and read again after cache_clear.
+        """
+        # Arrange
+        self.addCleanup(load_config.cache_clear)
+        load_config.cache_clear()
+
+        # Act
+        with patch.dict(os.environ, {"SPOOL_BATCH_SIZE": "5"}):
+            first = load_config()
+        with patch.dict(os.environ, {"SPOOL_BATCH_SIZE": "7"}):
+            cached = load_config()
+            load_config.cache_clear()
+            reloaded = load_config()
+
+        # Assert
+        self.assertIs(first, cached)
+        self.assertEqual(reloaded.spool_batch_size, 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,15 @@
+import threading
+import time
 import unittest
 from unittest.mock import patch, MagicMock
 from app.enrichment_service import EnrichmentService
 from app.alert import Alert
+from app.verdict_cache import VerdictCache, VERDICT_MALICIOUS, VERDICT_FAILED
+from app.virustotal_client import VirusTotalClient, MAX_RATE_LIMIT_RETRIES
+from app.scoring import WeightedPolicy
+from app.metrics import MetricsRegistry
+from app.priority_scheduler import PriorityScheduler, ORDER_PRIORITY
+from benchmarks.stub_virustotal import StubVirusTotalServer
 
 class TestEnrichmentService(unittest.TestCase):
 
@@ -12,37 +20,57 @@ class TestEnrichmentService(unittest.TestCase):
         # Arrange
         self.enrichment_service = EnrichmentService()
 
-    @patch("app.enrichment_service.requests.get")
-    def test_query_virustotal_success(self, mock_get):
+    def test_query_virustotal_success(self):
         """
         Test querying VirusTotal successfully returns parsed JSON.
         """
         # Arrange
-        mock_response = MagicMock()
-        mock_response.raise_for_status.return_value = None
-        mock_response.json.return_value = {"data": "some_data"}
-        mock_get.return_value = mock_response
+        mock_client = MagicMock()
+        mock_client.get_json.return_value = {"data": "some_data"}
+        enrichment_service = EnrichmentService(virustotal_client=mock_client)
 
         # Act
-        result = self.enrichment_service.query_virustotal("1.2.3.4")
+        result = enrichment_service.query_virustotal("1.2.3.4")
 
         # Assert
         self.assertEqual(result, {"data": "some_data"})
+        mock_client.get_json.assert_called_once_with("ip_addresses/1.2.3.4")
 
-    @patch("app.enrichment_service.requests.get")
-    def test_query_virustotal_failure(self, mock_get):
+    def test_query_virustotal_failure(self):
         """
         Test querying VirusTotal handles exceptions properly.
         """
         # Arrange
-        mock_get.side_effect = Exception("API failed")
+        mock_client = MagicMock()
+        mock_client.get_json.side_effect = Exception("API failed")
+        enrichment_service = EnrichmentService(virustotal_client=mock_client)
 
         # Act
-        result = self.enrichment_service.query_virustotal("1.2.3.4")
+        result = enrichment_service.query_virustotal("1.2.3.4")
 
         # Assert
         self.assertEqual(result, {}, "Should return empty dict on failure")
 
+    def test_query_virustotal_routes_by_ioc_type(self):
+        """
+        Test that every IoC type is queried at its own endpoint and a malformed IoC is not queried.
+        """
+        # Arrange
+        mock_client = MagicMock()
+        mock_client.get_json.return_value = {"data": "some_data"}
+        enrichment_service = EnrichmentService(virustotal_client=mock_client)
+
+        # Act
+        enrichment_service.query_virustotal("example.com")
+        enrichment_service.query_virustotal("d41d8cd98f00b204e9800998ecf8427e", ioc_type="md5")
+        result = enrichment_service.query_virustotal("not an ioc")
+
+        # Assert
+        self.assertEqual([call.args[0] for call in mock_client.get_json.call_args_list],
+                         ["domains/example.com", "files/d41d8cd98f00b204e9800998ecf8427e"])
+        self.assertEqual(result, {})
+        self.assertEqual(enrichment_service.rejected_iocs, 1)
+
     def test_is_ioc_malicious_from_response_true(self):
         """
         Test determining an IoC is malicious.
@@ -106,6 +134,133 @@ class TestEnrichmentService(unittest.TestCase):
         self.assertEqual(report["IoCs"][1]["IsMalicious"], False)
         self.assertEqual(report["AlertId"], alert.id)
 
+    @patch.object(EnrichmentService, 'query_virustotal')
+    def test_analyze_alerts_concurrent_same_reports(self, mock_query_vt):
+        """
+        Test that the concurrent mode builds the same reports and severities as analyze_response.
+        """
+        # Arrange
+        malicious = {"1.1.1.1": 4, "2.2.2.2": 0, "3.3.3.3": 1}
+        mock_query_vt.side_effect = lambda ioc, ioc_type=None: {"data": {"attributes": {"last_analysis_stats": {"malicious": malicious[ioc]}}}}
+        alerts = [Alert(["1.1.1.1", "2.2.2.2"]), Alert(["3.3.3.3"]), Alert([])]
+        concurrent_service = EnrichmentService(max_workers=4)
+
+        # Act
+        reports = concurrent_service.analyze_alerts(alerts)
+        serial_reports = [self.enrichment_service.analyze_response(alert) for alert in alerts]
+
+        # Assert
+        self.assertEqual(reports, serial_reports)
+        self.assertEqual([report["Severity"] for report in reports], [50, 100, 0])
+        self.assertEqual(alerts[0].severity, 50)
+
+    @patch.object(EnrichmentService, 'query_virustotal')
+    def test_analyze_alerts_respects_concurrency_limit(self, mock_query_vt):
+        """
+        Test that lookups overlap but never exceed max_workers at the same time.
+        """
+        # Arrange
+        lock = threading.Lock()
+        state = {"running": 0, "peak": 0}
+
+        def slow_lookup(ioc, ioc_type=None):
+            with lock:
+                state["running"] += 1
+                state["peak"] = max(state["peak"], state["running"])
+            time.sleep(0.02)
+            with lock:
+                state["running"] -= 1
+            return {}
+
+        mock_query_vt.side_effect = slow_lookup
+        alerts = [Alert([f"10.0.0.{i}" for i in range(9)])]
+        concurrent_service = EnrichmentService(max_workers=3)
+
+        # Act
+        concurrent_service.analyze_alerts(alerts)
+
+        # Assert
+        self.assertEqual(mock_query_vt.call_count, 9)
+        self.assertEqual(state["peak"], 3)
+
+    @patch.object(EnrichmentService, 'query_virustotal')
+    def test_analyze_alerts_deduplicates_iocs(self, mock_query_vt):
+        """
+        Test that an IoC repeated across (and inside) the alerts of a batch is queried once,
+        without changing the severity of any alert.
+        """
+        # Arrange
+        malicious = {"1.1.1.1": 2, "2.2.2.2": 0, "3.3.3.3": 0}
+        mock_query_vt.side_effect = lambda ioc, ioc_type=None: {"data": {"attributes": {"last_analysis_stats": {"malicious": malicious[ioc]}}}}
+        alerts = [Alert(["1.1.1.1", "2.2.2.2", "1.1.1.1"]), Alert(["1.1.1.1", "3.3.3.3"]), Alert(["2.2.2.2"])]
+        concurrent_service = EnrichmentService(virustotal_client=MagicMock(), max_workers=3)
+
+        # Act
+        reports = concurrent_service.analyze_alerts(alerts)
+
+        # Assert
+        self.assertEqual(mock_query_vt.call_count, 3)
+        self.assertEqual([report["Severity"] for report in reports], [66, 50, 0])
+        self.assertEqual([entry["IsMalicious"] for entry in reports[0]["IoCs"]], [True, False, True])
+        self.assertEqual(concurrent_service.last_batch_stats, {"iocs": 6, "unique_iocs": 3, "saved_calls": 3, "resolved_locally": 0, "resolved_in_bulk": 0, "skipped_lookups": 0})
+
+    @patch.object(EnrichmentService, 'query_virustotal')
+    def test_get_ioc_verdict_uses_cache(self, mock_query_vt):
+        """
+        Test that a repeated IoC is answered from the verdict cache without querying VirusTotal again.
+        """
+        # Arrange
+        enrichment_service = EnrichmentService(verdict_cache=VerdictCache())
+        mock_query_vt.return_value = {"data": {"attributes": {"last_analysis_stats": {"malicious": 3}}}}
+
+        # Act
+        first = enrichment_service.get_ioc_verdict("1.2.3.4")
+        second = enrichment_service.get_ioc_verdict("1.2.3.4")
+
+        # Assert
+        self.assertTrue(first)
+        self.assertTrue(second)
+        mock_query_vt.assert_called_once()
+        self.assertEqual(enrichment_service.verdict_cache.get("1.2.3.4"), VERDICT_MALICIOUS)
+
+    @patch.object(EnrichmentService, 'query_virustotal')
+    def test_analyze_alerts_marks_cached_verdicts(self, mock_query_vt):
+        """
+        Test that a verdict served from the cache is marked as such in the report and the metrics, without another query.
+        """
+        # Arrange
+        metrics = MetricsRegistry()
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock(), verdict_cache=VerdictCache(), metrics=metrics)
+        mock_query_vt.return_value = {"data": {"attributes": {"last_analysis_stats": {"malicious": 1}}}}
+
+        # Act
+        first = enrichment_service.analyze_alerts([Alert(["1.2.3.4"])])
+        second = enrichment_service.analyze_alerts([Alert(["1.2.3.4"])])
+
+        # Assert
+        mock_query_vt.assert_called_once()
+        self.assertEqual(first[0]["IoCs"], [{"IoCs": "1.2.3.4", "IsMalicious": True, "Source": "remote"}])
+        self.assertEqual(second[0]["IoCs"], [{"IoCs": "1.2.3.4", "IsMalicious": True, "Source": "cache"}])
+        self.assertEqual(enrichment_service.verdict_cache.stats()["misses"], 1)
+        self.assertIn('tip_ioc_verdicts_total{source="remote"} 1', metrics.render())
+        self.assertIn('tip_ioc_verdicts_total{source="cache"} 1', metrics.render())
+
+    @patch.object(EnrichmentService, 'query_virustotal')
+    def test_get_ioc_verdict_caches_failure(self, mock_query_vt):
+        """
+        Test that a failed lookup is negatively cached and reported as not malicious.
+        """
+        # Arrange
+        enrichment_service = EnrichmentService(verdict_cache=VerdictCache())
+        mock_query_vt.return_value = {}
+
+        # Act
+        result = enrichment_service.get_ioc_verdict("1.2.3.4")
+
+        # Assert
+        self.assertFalse(result)
+        self.assertEqual(enrichment_service.verdict_cache.get("1.2.3.4"), VERDICT_FAILED)
+
     @patch("builtins.open", new_callable=unittest.mock.mock_open)
     @patch("app.enrichment_service.ensure_output_directory")
     def test_save_report_to_file(self, mock_ensure_output, mock_open_file):
@@ -125,3 +280,191 @@ class TestEnrichmentService(unittest.TestCase):
         # Assert
         mock_open_file.assert_called()
         mock_ensure_output.assert_called_once()
+
+    @patch.object(EnrichmentService, 'query_virustotal')
+    def test_analyze_alerts_emits_early_report(self, mock_query_vt):
+        """
+        Test that an alert whose severity crosses the threshold gets a partial report before its last lookup,
+        scored with the engine counts by the weighted policy, and still gets its complete report.
+        """
+        # Arrange
+        malicious = {"1.1.1.1": 5, "2.2.2.2": 0, "3.3.3.3": 1}
+        saved = []
+
+        def lookup(ioc, ioc_type=None):
+            # The partial report is saved before the last IoC is looked up
+            if ioc == "3.3.3.3":
+                saved.append("lookup of 3.3.3.3")
+            return {"data": {"attributes": {"last_analysis_stats": {"malicious": malicious[ioc]}}}}
+
+        mock_query_vt.side_effect = lookup
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock(), scoring_policy=WeightedPolicy(saturation=5),
+                                               early_emit_severity=30)
+        enrichment_service.save_report_to_file = MagicMock(side_effect=lambda report: saved.append(report))
+
+        # Act
+        reports = enrichment_service.analyze_alerts([Alert(["1.1.1.1", "2.2.2.2", "3.3.3.3"])])
+
+        # Assert
+        self.assertEqual(len(saved), 2)
+        partial_report = saved[0]
+        self.assertTrue(partial_report["Partial"])
+        self.assertEqual(partial_report["Severity"], 33)
+        self.assertEqual(len(partial_report["IoCs"]), 1)
+        self.assertEqual(saved[1], "lookup of 3.3.3.3")
+        # 5 engines score 1, 1 engine scores 0.2
+        self.assertEqual(reports[0]["Severity"], 40)
+        self.assertNotIn("Partial", reports[0])
+
+    @patch.object(EnrichmentService, 'query_virustotal')
+    def test_analyze_alerts_early_exit(self, mock_query_vt):
+        """
+        Test that the lookups follow the alert priority, that a decided alert stops its lookups
+        and reports them as skipped, and that every report is handed over as soon as its alert is done.
+        """
+        # Arrange
+        malicious = {"1.1.1.1": 3, "2.2.2.2": 2, "3.3.3.3": 0, "4.4.4.4": 0, "9.9.9.9": 1}
+        mock_query_vt.side_effect = lambda ioc, ioc_type=None: {"data": {"attributes": {"last_analysis_stats": {"malicious": malicious[ioc]}}}}
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock(),
+                                               priority_scheduler=PriorityScheduler(order=ORDER_PRIORITY, decision_severity=50))
+        low = Alert(["9.9.9.9"])
+        urgent = Alert(["1.1.1.1", "2.2.2.2", "3.3.3.3", "4.4.4.4"], priority=1)
+        handed_over = []
+
+        # Act
+        reports = enrichment_service.analyze_alerts([low, urgent], on_report=lambda report: handed_over.append(report["AlertId"]))
+
+        # Assert
+        self.assertEqual([call.kwargs["ioc"] for call in mock_query_vt.call_args_list], ["1.1.1.1", "2.2.2.2", "9.9.9.9"])
+        self.assertEqual([entry["Source"] for entry in reports[1]["IoCs"]], ["remote", "remote", "skipped", "skipped"])
+        self.assertEqual(reports[1]["Severity"], 50)
+        self.assertEqual(handed_over, [urgent.id, low.id])
+        self.assertEqual(enrichment_service.last_batch_stats["skipped_lookups"], 2)
+
+    def test_save_report_to_sink(self):
+        """
+        Test that with a report sink the report is handed to the sink instead of written to its own file.
+        """
+        # Arrange
+        mock_sink = MagicMock()
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock(), report_sink=mock_sink)
+        report = {"AlertId": "test-id", "Severity": 0, "IoCs": []}
+
+        # Act
+        enrichment_service.save_report_to_file(report)
+        enrichment_service.flush_reports()
+
+        # Assert
+        mock_sink.write.assert_called_once_with(report)
+        mock_sink.flush.assert_called_once_with(durable=False)
+
+
+class TestBulkLookup(unittest.TestCase):
+    """
+    Tests of the bulk lookups against the search contract of the local stub server.
+    """
+
+    def setUp(self):
+        """
+        Start a stub server and an enrichment service that looks up to 10 IoCs per bulk before each test.
+        """
+        # Arrange
+        self.stub = StubVirusTotalServer(seed=1).start()
+        self.client = VirusTotalClient(api_key="fake-key", base_url=self.stub.base_url, max_retries=0)
+        self.enrichment_service = EnrichmentService(virustotal_client=self.client, bulk_size=10)
+        self.alerts = [
+            Alert(["1.2.3.4", "example.com"], ioc_types=["ipv4", "domain"]),
+            Alert(["d41d8cd98f00b204e9800998ecf8427e", "http://example.com/a", "1.2.3.4"],
+                  ioc_types=["md5", "url", "ipv4"]),
+        ]
+        self.stub.malicious["1.2.3.4"] = 3
+        self.stub.malicious["d41d8cd98f00b204e9800998ecf8427e"] = 1
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+
+    def _search_requests(self) -> list:
+        return [path for path in self.stub.requests if "/intelligence/search" in path]
+
+    def test_bulk_lookup_maps_results_to_iocs(self):
+        """
+        Test that the IoCs of all the alerts are looked up with one search request and every IoC gets its own verdict.
+        """
+        # Act
+        reports = self.enrichment_service.analyze_alerts(self.alerts)
+
+        # Assert
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(len(self._search_requests()), 1)
+        self.assertEqual([[entry["IsMalicious"] for entry in report["IoCs"]] for report in reports],
+                         [[True, False], [True, False, True]])
+        self.assertEqual(self.enrichment_service.last_batch_stats["resolved_in_bulk"], 4)
+
+    def test_bulk_lookup_falls_back_for_missing_iocs(self):
+        """
+        Test that an IoC the search does not find is looked up on its own.
+        """
+        # Arrange
+        self.stub.unknown.add("example.com")
+
+        # Act
+        reports = self.enrichment_service.analyze_alerts(self.alerts)
+
+        # Assert
+        self.assertEqual(len(self._search_requests()), 1)
+        self.assertEqual(self.stub.requests[1:], ["/api/v3/domains/example.com"])
+        self.assertEqual(self.enrichment_service.last_batch_stats["resolved_in_bulk"], 3)
+        self.assertEqual(reports[0]["Severity"], 50)
+
+    def test_bulk_lookup_falls_back_when_search_fails(self):
+        """
+        Test that when the search is refused every IoC is looked up on its own, with the same reports as without bulks.
+        """
+        # Arrange
+        self.stub.search_enabled = False
+
+        # Act
+        reports = self.enrichment_service.analyze_alerts(self.alerts)
+
+        # Assert
+        self.assertEqual(len(self._search_requests()), 1)
+        self.assertEqual(len(self.stub.requests), 5)
+        self.assertEqual([report["Severity"] for report in reports], [50, 66])
+        self.assertEqual(self.enrichment_service.last_batch_stats["resolved_in_bulk"], 0)
+
+    def test_bulk_lookup_stays_off_after_refusal(self):
+        """
+        Test that after a 403 on the search the next batches do not send search requests, while a server error does not turn bulks off.
+        """
+        # Arrange
+        self.stub.queue_response(500)
+        self.enrichment_service.analyze_alerts(self.alerts)
+        refused_after_server_error = self.enrichment_service.bulk_refused
+        self.stub.search_enabled = False
+        self.enrichment_service.analyze_alerts(self.alerts)
+        searches_before = len(self._search_requests())
+
+        # Act
+        reports = self.enrichment_service.analyze_alerts(self.alerts)
+
+        # Assert
+        self.assertFalse(refused_after_server_error)
+        self.assertTrue(self.enrichment_service.bulk_refused)
+        self.assertEqual(len(self._search_requests()), searches_before)
+        self.assertEqual([report["Severity"] for report in reports], [50, 66])
+
+    def test_rate_limited_lookup_is_reported_failed(self):
+        """
+        Test that an IoC still rate limited after all the 429 retries is reported as a failed lookup, not as clean.
+        """
+        # Arrange
+        self.client.sleep = lambda seconds: None
+        self.stub.queue_response(429, headers={"Retry-After": "0"}, count=MAX_RATE_LIMIT_RETRIES + 1)
+
+        # Act
+        report = self.enrichment_service.analyze_response(Alert(["1.2.3.4"], ioc_types=["ipv4"]))
+
+        # Assert
+        self.assertEqual(report["IoCs"][0]["Failed"], True)
+        self.assertFalse(report["IoCs"][0]["IsMalicious"])
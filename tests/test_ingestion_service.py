@@ -1,7 +1,10 @@
 from app.ingestion_service import IngestionService
+import queue
 import unittest
 from unittest.mock import patch,MagicMock
 from app.alert import Alert
+from app.message_parser import MessageParser
+from benchmarks.fake_pubsub import FakeSubscriber
 
 class TestIngestionService(unittest.TestCase):
     """
@@ -21,7 +24,27 @@ class TestIngestionService(unittest.TestCase):
             subscription_name="path/to/fake_subscription_name",
             service_account_path= "path/to/fake_service_acount_path.json"
             )
-        
+        # The client is created on first use, create it while SubscriberClient is patched
+        self.ingestion_service.subscriber
+
+    @patch("app.ingestion_service.pubsub_v1.SubscriberClient")
+    def test_subscriber_created_on_first_use(self, mock_subscriber_client):
+        """
+        Test that the subscriber client is created on first use, and that the acknowledgements use it.
+        """
+        # Arrange
+        ingestion_service = IngestionService(subscription_name="path/to/fake_subscription_name",
+                                             service_account_path="path/to/fake_service_acount_path.json")
+        created_at_init = mock_subscriber_client.called
+
+        # Act
+        subscriber = ingestion_service.subscriber
+
+        # Assert
+        self.assertFalse(created_at_init)
+        mock_subscriber_client.assert_called_once()
+        self.assertIs(ingestion_service.ack_manager.subscriber, subscriber)
+
     def test_pull_messages(self):
         """
         Test that pulling messages returns the expected number of messages
@@ -63,13 +86,31 @@ class TestIngestionService(unittest.TestCase):
         # ssert
         self.assertEqual(messages,[],"should return an empty list in case of failure")
 
+    def test_transform_messages_reads_priority(self):
+        """
+        Test that the alert priority is read from the priority attribute of the message, 0 if it has none or it is invalid.
+        """
+        # Arrange
+        messages = []
+        for attributes in ({"priority": "7"}, {}, {"priority": "high"}):
+            mock_message = MagicMock()
+            mock_message.message.data = b"1.2.3.4"
+            mock_message.message.attributes = attributes
+            messages.append(mock_message)
+
+        # Act
+        alerts = self.ingestion_service.transform_messages_to_alerts(messages)
+
+        # Assert
+        self.assertEqual([alert.priority for alert in alerts], [7, 0, 0])
+
     def test_transform_messages_to_alerts(self):
         """
         Test that raw message data is correctly transformed into an Alert object.
         """
         # arrange
         mock_message = MagicMock()
-        mock_message.message.data.decode.return_value = "1.2.3.4\n5.6.7.8"
+        mock_message.message.data = b"1.2.3.4\n5.6.7.8"
         mock_message.ack_id = "fake-ack-id"
 
         # act
@@ -83,33 +124,132 @@ class TestIngestionService(unittest.TestCase):
         self.assertEqual(alert.ioc, ["1.2.3.4","5.6.7.8"],"iocs did not assigned properly")
         self.assertIsInstance(alert.id, str,"alert id should be a string")
 
-    def test_acknowledge_message_received(self):
+    def test_transform_messages_rejects_malformed_iocs(self):
         """
-        Test that acknowledging a message calls the acknowledge method with correct arguments.
+        Test that malformed IoCs are dropped and counted, blank lines skipped, and the valid ones classified.
         """
         # Arrange
-        message = MagicMock()
-        message.ack_id = "fake-ack-id"
+        mock_message = MagicMock()
+        mock_message.message.data = b"1.2.3.4\r\n\n  example.com \nnot an ioc\n1.2.3.999"
+        mock_message.ack_id = "fake-ack-id"
 
         # Act
-        self.ingestion_service.acknowledge_message_received(received_message=message)
+        alerts = self.ingestion_service.transform_messages_to_alerts([mock_message])
 
-        #Assert
-        self.mock_subscriber.acknowledge.assert_called_once_with(
-            request={"subscription":self.ingestion_service.subscription_name,"ack_ids":[message.ack_id]}
-        )
+        # Assert
+        self.assertEqual(alerts[0].ioc, ["1.2.3.4", "example.com"])
+        self.assertEqual(alerts[0].ioc_types, {"1.2.3.4": "ipv4", "example.com": "domain"})
+        self.assertEqual(self.ingestion_service.rejected_iocs, 2)
+
+    def test_transform_messages_deduplicates_and_caps_iocs(self):
+        """
+        Test that an IoC repeated in a message is kept once and a message over the size cap is acknowledged as malformed.
+        """
+        # Arrange
+        self.ingestion_service.message_parser = MessageParser(max_bytes=50)
+        messages = []
+        for i, data in enumerate((b"example.com\nEXAMPLE.com\n1.2.3.4\n1.2.3.4", b"1.2.3.4\n" * 10)):
+            mock_message = MagicMock()
+            mock_message.message.data = data
+            mock_message.ack_id = f"ack-{i}"
+            messages.append(mock_message)
+
+        # Act
+        alerts = self.ingestion_service.transform_messages_to_alerts(messages)
+
+        # Assert
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual(alerts[0].ioc, ["example.com", "1.2.3.4"])
+        ack_ids = self.mock_subscriber.acknowledge.call_args.kwargs["request"]["ack_ids"]
+        self.assertEqual(sorted(ack_ids), ["ack-0", "ack-1"])
 
-    def test_acknowledge_message_received_failure(self):
+    def test_transform_messages_acknowledges_in_one_rpc(self):
         """
-        Test that an exception during acknowledgment is handled gracefully.
+        Test that a pull of 10 messages, one of them malformed, is acknowledged with a single RPC.
         """
-        #Arrange
+        # Arrange
+        messages = []
+        for i in range(10):
+            mock_message = MagicMock()
+            mock_message.message.data = b"\xff" if i == 3 else f"10.0.0.{i}".encode()
+            mock_message.ack_id = f"ack-{i}"
+            messages.append(mock_message)
+
+        # Act
+        alerts = self.ingestion_service.transform_messages_to_alerts(messages)
+
+        # Assert
+        self.assertEqual(len(alerts), 9)
+        self.mock_subscriber.acknowledge.assert_called_once()
+        ack_ids = self.mock_subscriber.acknowledge.call_args.kwargs["request"]["ack_ids"]
+        self.assertEqual(sorted(ack_ids), sorted(f"ack-{i}" for i in range(10)))
+
+    def test_acknowledge_after_report_saved(self):
+        """
+        Test that with ack_after_report the messages are acknowledged only by acknowledge_alerts.
+        """
+        # Arrange
+        self.ingestion_service.ack_after_report = True
         mock_message = MagicMock()
+        mock_message.message.data = b"1.2.3.4"
         mock_message.ack_id = "fake-ack-id"
-        self.mock_subscriber.acknowledge.side_effect = Exception("failed to acknowledge")
-        
-        #Act
-        result = self.ingestion_service.acknowledge_message_received(mock_message)
 
-        #Assert 
-        self.mock_subscriber.acknowledge.assert_called_once()
\ No newline at end of file
+        # Act
+        alerts = self.ingestion_service.transform_messages_to_alerts([mock_message])
+        acked_before_report = self.mock_subscriber.acknowledge.called
+        self.ingestion_service.acknowledge_alerts(alerts)
+
+        # Assert
+        self.assertFalse(acked_before_report)
+        self.assertEqual(alerts[0].ack_id, "fake-ack-id")
+        self.mock_subscriber.acknowledge.assert_called_once_with(
+            request={"subscription":self.ingestion_service.subscription_name,"ack_ids":["fake-ack-id"]}
+        )
+
+    def test_start_streaming_feeds_work_queue(self):
+        """
+        Test that streamed messages become alerts on the work queue, and malformed messages are acked and dropped.
+        """
+        # Arrange
+        fake_subscriber = FakeSubscriber([b"1.2.3.4\n5.6.7.8", b"\xff\xfe", b"9.9.9.9"])
+        self.ingestion_service.subscriber = fake_subscriber
+        work_queue = queue.Queue(maxsize=10)
+
+        # Act
+        self.ingestion_service.start_streaming(work_queue=work_queue)
+        first_alert, first_message = work_queue.get(timeout=2)
+        second_alert, _ = work_queue.get(timeout=2)
+        self.ingestion_service.stop_streaming()
+
+        # Assert
+        self.assertEqual(first_alert.ioc, ["1.2.3.4", "5.6.7.8"])
+        self.assertEqual(second_alert.ioc, ["9.9.9.9"])
+        self.assertFalse(first_message.acked, "the consumer acks after the report is saved")
+        self.assertTrue(fake_subscriber.messages[1].acked, "malformed message should be acked")
+        self.assertIsNone(self.ingestion_service.streaming_pull_future)
+
+    def test_start_streaming_flow_control(self):
+        """
+        Test that no more than max_outstanding_messages are delivered before they are acked.
+        """
+        # Arrange
+        fake_subscriber = FakeSubscriber([b"1.1.1.1"] * 5)
+        self.ingestion_service.subscriber = fake_subscriber
+        work_queue = queue.Queue()
+
+        # Act
+        self.ingestion_service.start_streaming(work_queue=work_queue, max_outstanding_messages=2)
+        received = [work_queue.get(timeout=2) for _ in range(2)]
+        blocked = work_queue.empty()
+        for _, message in received:
+            message.ack()
+        for _ in range(3):
+            alert, message = work_queue.get(timeout=2)
+            received.append((alert, message))
+            message.ack()
+        self.ingestion_service.stop_streaming()
+
+        # Assert
+        self.assertTrue(blocked)
+        self.assertEqual(len(received), 5)
+        self.assertEqual(fake_subscriber.peak_outstanding, 2)
@@ -0,0 +1,76 @@
+import unittest
+from app.ioc_classifier import (
+    classify_ioc, virustotal_path, virustotal_search_term, ioc_match_keys, virustotal_object_keys,
+    IOC_TYPE_IPV4, IOC_TYPE_IPV6, IOC_TYPE_DOMAIN, IOC_TYPE_URL, IOC_TYPE_MD5, IOC_TYPE_SHA1, IOC_TYPE_SHA256
+)
+
+class TestIocClassifier(unittest.TestCase):
+
+    def test_classify_ioc_types(self):
+        """
+        Test that every supported IoC type is detected.
+        """
+        # Arrange
+        expected = {
+            "1.2.3.4": IOC_TYPE_IPV4,
+            "2001:db8::1": IOC_TYPE_IPV6,
+            "example.com": IOC_TYPE_DOMAIN,
+            "sub.123-example.co.uk": IOC_TYPE_DOMAIN,
+            "http://example.com/path?q=1": IOC_TYPE_URL,
+            "d41d8cd98f00b204e9800998ecf8427e": IOC_TYPE_MD5,
+            "da39a3ee5e6b4b0d3255bfef95601890afd80709": IOC_TYPE_SHA1,
+            "E3B0C44298FC1C149AFBF4C8996FB92427AE41E4649B934CA495991B7852B855": IOC_TYPE_SHA256,
+        }
+
+        # Act
+        result = {ioc: classify_ioc(ioc) for ioc in expected}
+
+        # Assert
+        self.assertEqual(result, expected)
+
+    def test_classify_malformed_iocs(self):
+        """
+        Test that malformed IoCs are not classified.
+        """
+        # Arrange
+        malformed = ["", "1.2.3.999", "1.2.3", "not an ioc", "example", "http://", "gggg::1", "d41d8cd98f00b204e9800998ecf842"]
+
+        # Act
+        result = [classify_ioc(ioc) for ioc in malformed]
+
+        # Assert
+        self.assertEqual(result, [None] * len(malformed))
+
+    def test_virustotal_path_per_type(self):
+        """
+        Test that every IoC type is sent to its VirusTotal endpoint.
+        """
+        # Act & Assert
+        self.assertEqual(virustotal_path("1.2.3.4", IOC_TYPE_IPV4), "ip_addresses/1.2.3.4")
+        self.assertEqual(virustotal_path("2001:db8::1", IOC_TYPE_IPV6), "ip_addresses/2001:db8::1")
+        self.assertEqual(virustotal_path("example.com", IOC_TYPE_DOMAIN), "domains/example.com")
+        self.assertEqual(virustotal_path("ABCDEF0123456789ABCDEF0123456789", IOC_TYPE_MD5), "files/abcdef0123456789abcdef0123456789")
+        # The url id is the unpadded url-safe base64 of the url
+        self.assertEqual(virustotal_path("http://example.com", IOC_TYPE_URL), "urls/aHR0cDovL2V4YW1wbGUuY29t")
+
+    def test_search_objects_match_their_iocs(self):
+        """
+        Test that the objects of a VirusTotal search are recognized by the IoCs they were searched by.
+        """
+        # Arrange
+        md5 = "D41D8CD98F00B204E9800998ECF8427E"
+        url = "http://example.com/a?b=1"
+        file_object = {"type": "file", "id": "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855",
+                       "attributes": {"md5": md5.lower()}}
+        url_object = {"type": "url", "id": "some-url-id", "attributes": {"url": url}}
+        address_object = {"type": "ip_address", "id": "2001:db8::1"}
+
+        # Act & Assert
+        self.assertIn(ioc_match_keys(md5, IOC_TYPE_MD5)[0], virustotal_object_keys(file_object))
+        self.assertIn(ioc_match_keys(url, IOC_TYPE_URL)[0], virustotal_object_keys(url_object))
+        self.assertIn(ioc_match_keys("2001:DB8:0::1", IOC_TYPE_IPV6)[0], virustotal_object_keys(address_object))
+        self.assertEqual(virustotal_search_term(url, IOC_TYPE_URL), 'url:"http://example.com/a?b=1"')
+        self.assertEqual(virustotal_search_term(md5, IOC_TYPE_MD5), md5.lower())
+
+if __name__ == "__main__":
+    unittest.main()
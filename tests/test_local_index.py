@@ -0,0 +1,126 @@
+import os
+import shutil
+import unittest
+from unittest.mock import MagicMock
+from app.local_index import LocalIndex, IntervalIndex
+from app.enrichment_service import EnrichmentService
+from app.alert import Alert
+from app.verdict_cache import VERDICT_MALICIOUS, VERDICT_CLEAN
+import ipaddress
+
+
+class FakeTimer:
+    """
+    A controllable clock so the reload interval can be tested without sleeping.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestLocalIndex(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Write a blocklist and an allowlist to a temporary directory before each test.
+        """
+        # Arrange
+        self.directory = "./tests/temporary_local_lists"
+        os.makedirs(self.directory, exist_ok=True)
+        self.blocklist_path = os.path.join(self.directory, "blocklist.txt")
+        self.allowlist_path = os.path.join(self.directory, "allowlist.txt")
+        self._write(self.blocklist_path, "# known bad\n203.0.114.0/24\n6.6.6.6\nevil.com\nD41D8CD98F00B204E9800998ECF8427E\n\n")
+        self._write(self.allowlist_path, "8.8.8.0/24 # resolvers\ngood.org\nnot a valid entry\n")
+        self.timer = FakeTimer()
+        self.index = LocalIndex(blocklist_path=self.blocklist_path, allowlist_path=self.allowlist_path,
+                                reload_interval=30, timer=self.timer)
+
+    def tearDown(self):
+        """
+        Remove the temporary directory after each test.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _write(self, path, content):
+        with open(path, "w") as file:
+            file.write(content)
+
+    def test_interval_index_merges_ranges(self):
+        """
+        Test that overlapping and adjacent ranges are merged and lookups respect the range bounds.
+        """
+        # Arrange
+        networks = [ipaddress.ip_network(network) for network in ("10.0.0.0/25", "10.0.0.128/25", "10.0.0.64/26", "11.0.0.1/32")]
+
+        # Act
+        index = IntervalIndex(networks)
+
+        # Assert
+        self.assertEqual(len(index), 2)
+        self.assertIn(int(ipaddress.ip_address("10.0.0.255")), index)
+        self.assertIn(int(ipaddress.ip_address("11.0.0.1")), index)
+        self.assertNotIn(int(ipaddress.ip_address("10.0.1.0")), index)
+        self.assertNotIn(int(ipaddress.ip_address("11.0.0.2")), index)
+
+    def test_lookup_resolves_listed_iocs(self):
+        """
+        Test the verdicts of listed ranges, addresses, domains (with subdomains), hashes and reserved addresses.
+        """
+        # Act & Assert
+        self.assertEqual(self.index.lookup("203.0.114.77"), VERDICT_MALICIOUS)
+        self.assertEqual(self.index.lookup("6.6.6.6"), VERDICT_MALICIOUS)
+        self.assertEqual(self.index.lookup("www.evil.com"), VERDICT_MALICIOUS)
+        self.assertEqual(self.index.lookup("d41d8cd98f00b204e9800998ecf8427e"), VERDICT_MALICIOUS)
+        self.assertEqual(self.index.lookup("8.8.8.8"), VERDICT_CLEAN)
+        self.assertEqual(self.index.lookup("good.org"), VERDICT_CLEAN)
+        self.assertEqual(self.index.lookup("192.168.1.10"), VERDICT_CLEAN)
+        self.assertEqual(self.index.lookup("fe80::1"), VERDICT_CLEAN)
+        self.assertIsNone(self.index.lookup("1.2.3.4"))
+        self.assertIsNone(self.index.lookup("notevil.com"))
+        self.assertEqual(self.index.stats()["misses"], 2)
+
+    def test_hot_reload_after_change(self):
+        """
+        Test that a changed list is picked up after the reload interval, without creating a new index.
+        """
+        # Arrange
+        self._write(self.blocklist_path, "1.2.3.0/24\n")
+        os.utime(self.blocklist_path, ns=(0, 10**18))
+
+        # Act
+        before_interval = self.index.lookup("1.2.3.4")
+        self.timer.now += 30
+        after_interval = self.index.lookup("1.2.3.4")
+
+        # Assert
+        self.assertIsNone(before_interval)
+        self.assertEqual(after_interval, VERDICT_MALICIOUS)
+        self.assertIsNone(self.index.lookup("6.6.6.6"))
+        self.assertEqual(self.index.stats()["reloads"], 1)
+
+    def test_enrichment_resolves_locally_before_virustotal(self):
+        """
+        Test that listed IoCs are not sent to VirusTotal and the report says where each verdict came from.
+        """
+        # Arrange
+        mock_client = MagicMock()
+        mock_client.get_json.return_value = {"data": {"attributes": {"last_analysis_stats": {"malicious": 0}}}}
+        enrichment_service = EnrichmentService(virustotal_client=mock_client, local_index=self.index, max_workers=2)
+        alerts = [Alert(["6.6.6.6", "1.2.3.4"]), Alert(["10.0.0.1"])]
+
+        # Act
+        reports = enrichment_service.analyze_alerts(alerts)
+        single_report = enrichment_service.analyze_response(Alert(["6.6.6.6"]))
+
+        # Assert
+        mock_client.get_json.assert_called_once_with("ip_addresses/1.2.3.4")
+        self.assertEqual([entry["Source"] for entry in reports[0]["IoCs"]], ["local", "remote"])
+        self.assertEqual([report["Severity"] for report in reports], [50, 0])
+        self.assertEqual(single_report["IoCs"], [{"IoCs": "6.6.6.6", "IsMalicious": True, "Source": "local"}])
+        self.assertEqual(enrichment_service.last_batch_stats["resolved_locally"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import os
+import queue
+import shutil
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+from app.enrichment_service import EnrichmentService
+from app.ingestion_service import IngestionService
+from app.main import run_streaming_loop, run_pull_loop, drain_work_queue, run_spooled_pipeline
+from app.report_sink import ReportSink
+from app.spool_queue import SpoolQueue
+from benchmarks.fake_pubsub import FakeSubscriber
+
+
+class TestMain(unittest.TestCase):
+    """
+    Tests of the ingestion and enrichment loops of app.main.
+    """
+
+    @patch("app.ingestion_service.pubsub_v1.SubscriberClient")
+    def test_run_streaming_loop(self, mock_subscriber_client):
+        """
+        Test that streamed alerts are enriched, saved and only then acknowledged.
+        """
+        # Arrange
+        fake_subscriber = FakeSubscriber([b"1.1.1.1", b"2.2.2.2\n3.3.3.3", b"4.4.4.4"])
+        mock_subscriber_client.return_value = fake_subscriber
+        ingestion_service = IngestionService(subscription_name="fake", service_account_path="fake.json")
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock())
+        enrichment_service.query_virustotal = MagicMock(return_value={})
+        stop_event = threading.Event()
+        saved = []
+
+        def save_report(report):
+            saved.append(report)
+            # Nothing of this alert may be acked before its report is saved
+            if len(saved) == 3:
+                stop_event.set()
+
+        enrichment_service.save_report_to_file = MagicMock(side_effect=save_report)
+
+        # Act
+        run_streaming_loop(ingestion_service, enrichment_service, stop_event, batch_size=2)
+
+        # Assert
+        self.assertEqual(len(saved), 3)
+        self.assertEqual(sorted(len(report["IoCs"]) for report in saved), [1, 1, 2])
+        self.assertTrue(all(message.acked for message in fake_subscriber.messages))
+        self.assertIsNone(ingestion_service.streaming_pull_future)
+
+    def test_run_spooled_pipeline_streaming(self):
+        """
+        Test that streamed messages are acknowledged once spooled, and enriched from the spool.
+        """
+        # Arrange
+        directory = "./tests/temporary_spool_pipeline"
+        self.addCleanup(shutil.rmtree, directory, True)
+        spool = SpoolQueue(db_path=os.path.join(directory, "spool.db"), commit_interval=0.01)
+        fake_subscriber = FakeSubscriber([b"1.1.1.1", b"\xff", b"2.2.2.2\n3.3.3.3"])
+        ingestion_service = IngestionService(subscription_name="fake", service_account_path="fake.json",
+                                             subscriber=fake_subscriber, spool=spool)
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock())
+        enrichment_service.query_virustotal = MagicMock(return_value={})
+        stop_event = threading.Event()
+        saved = []
+
+        def save_report(report):
+            saved.append(report)
+            if len(saved) == 2:
+                stop_event.set()
+
+        enrichment_service.save_report_to_file = MagicMock(side_effect=save_report)
+
+        # Act
+        run_spooled_pipeline(ingestion_service, enrichment_service, stop_event, streaming=True, batch_size=2)
+        spool.close()
+
+        # Assert
+        self.assertEqual(sorted(len(report["IoCs"]) for report in saved), [1, 2])
+        self.assertTrue(all(message.acked for message in fake_subscriber.messages))
+        self.assertEqual(spool.stats()["spooled"], 3)
+
+    def test_run_pull_loop_does_not_ack_unsaved_reports(self):
+        """
+        Test that with ack_after_report the message of an alert whose report could not be written is not acknowledged,
+        and is given back to pub/sub.
+        """
+        # Arrange
+        stop_event = threading.Event()
+
+        class FailingSink(ReportSink):
+            def _write_batch(self, batch, durable):
+                stop_event.set()
+                if any(entry["IoCs"] == "2.2.2.2" for report in batch for entry in report["IoCs"]):
+                    raise OSError("disk full")
+
+        fake_subscriber = FakeSubscriber([b"1.1.1.1", b"2.2.2.2"])
+        ingestion_service = IngestionService(subscription_name="fake", service_account_path="fake.json",
+                                             ack_after_report=True, subscriber=fake_subscriber)
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock(), report_sink=FailingSink(flush_every=1))
+        enrichment_service.query_virustotal = MagicMock(return_value={})
+
+        # Act
+        run_pull_loop(ingestion_service, enrichment_service, stop_event)
+        ingestion_service.ack_manager.close()
+
+        # Assert
+        self.assertEqual(fake_subscriber.acked_ids, {"ack-0"})
+        self.assertEqual(fake_subscriber.nacked_ids, {"ack-1"})
+
+    def test_drain_work_queue(self):
+        """
+        Test that draining takes what is waiting, up to max_items, and returns empty on timeout.
+        """
+        # Arrange
+        work_queue = queue.Queue()
+        for item in range(5):
+            work_queue.put(item)
+
+        # Act
+        first = drain_work_queue(work_queue, max_items=3, timeout=0.1)
+        second = drain_work_queue(work_queue, max_items=3, timeout=0.1)
+        third = drain_work_queue(work_queue, max_items=3, timeout=0.1)
+
+        # Assert
+        self.assertEqual(first, [0, 1, 2])
+        self.assertEqual(second, [3, 4])
+        self.assertEqual(third, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
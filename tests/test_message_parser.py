@@ -0,0 +1,74 @@
+import unittest
+from app.message_parser import MessageParser, iter_lines
+from app.metrics import MetricsRegistry
+
+
+class TestMessageParser(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create a parser of messages up to 100 bytes and 3 IoCs.
+        """
+        self.metrics = MetricsRegistry()
+        self.parser = MessageParser(max_bytes=100, max_iocs=3, metrics=self.metrics)
+
+    def test_iter_lines(self):
+        """
+        Test that CRLF and LF line ends, blank lines and the whitespace around the lines are skipped.
+        """
+        # Arrange
+        data = b"\r\n  1.2.3.4 \r\n\r\n\texample.com\n \n5.6.7.8"
+
+        # Act
+        lines = [bytes(line) for line in iter_lines(data)]
+
+        # Assert
+        self.assertEqual(lines, [b"1.2.3.4", b"example.com", b"5.6.7.8"])
+
+    def test_iter_iocs_drops_malformed_and_duplicate_iocs(self):
+        """
+        Test that the malformed IoCs are passed to on_rejected, and an IoC repeated in another form is kept once.
+        """
+        # Arrange
+        rejected = []
+        data = b"example.com\r\nnot an ioc\nEXAMPLE.COM\n1.2.3.4\n"
+
+        # Act
+        iocs = list(self.parser.iter_iocs(data, on_rejected=rejected.append))
+
+        # Assert
+        self.assertEqual(iocs, [("example.com", "domain"), ("1.2.3.4", "ipv4")])
+        self.assertEqual(rejected, ["not an ioc"])
+        self.assertIn("duplicate_iocs_total 1", self.metrics.render())
+
+    def test_iter_iocs_is_incremental(self):
+        """
+        Test that the first IoCs are yielded before the rest of the message is parsed.
+        """
+        # Arrange
+        iocs = self.parser.iter_iocs(b"1.2.3.4\n\xff\n")
+
+        # Act
+        first = next(iocs)
+
+        # Assert
+        self.assertEqual(first, ("1.2.3.4", "ipv4"))
+        with self.assertRaises(UnicodeDecodeError):
+            next(iocs)
+
+    def test_caps(self):
+        """
+        Test that a message bigger than max_bytes is rejected and one with more than max_iocs IoCs is cut.
+        """
+        # Act
+        iocs = list(self.parser.iter_iocs(b"\n".join(f"10.0.0.{i}".encode() for i in range(5))))
+
+        # Assert
+        self.assertEqual([ioc for ioc, _ in iocs], ["10.0.0.0", "10.0.0.1", "10.0.0.2"])
+        self.assertIn("truncated_messages_total 1", self.metrics.render())
+        with self.assertRaises(ValueError):
+            list(self.parser.iter_iocs(b"1.2.3.4\n" * 20))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import shutil
+import unittest
+import urllib.request
+import urllib.error
+from app.metrics import MetricsRegistry, MetricsExporter, DISABLED_METRICS
+from app.ingestion_service import IngestionService
+from benchmarks.fake_pubsub import FakeSubscriber
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create an enabled registry before each test.
+        """
+        # Arrange
+        self.registry = MetricsRegistry()
+        self.directory = "./tests/temporary_metrics"
+
+    def tearDown(self):
+        """
+        Remove the temporary directory after each test.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_render_counter_gauge_and_collector(self):
+        """
+        Test the Prometheus text format of counters (with labels), gauges and collectors.
+        """
+        # Arrange
+        requests = self.registry.counter("requests_total", "Requests", ("status_code",))
+        in_flight = self.registry.gauge("in_flight", "In flight")
+        self.registry.register_collector("hit_ratio", "gauge", "Hit ratio", lambda: 0.5)
+
+        # Act
+        requests.labels(200).inc()
+        requests.labels(200).inc()
+        requests.labels(429).inc()
+        in_flight.set(3)
+        output = self.registry.render()
+
+        # Assert
+        self.assertIn("# TYPE tip_requests_total counter", output)
+        self.assertIn('tip_requests_total{status_code="200"} 2', output)
+        self.assertIn('tip_requests_total{status_code="429"} 1', output)
+        self.assertIn("tip_in_flight 3", output)
+        self.assertIn("tip_hit_ratio 0.5", output)
+
+    def test_histogram_buckets_are_cumulative(self):
+        """
+        Test that histogram buckets count every observation up to their bound, plus sum and count.
+        """
+        # Arrange
+        histogram = self.registry.histogram("pull_size", "Pull size", buckets=(1, 10))
+
+        # Act
+        for value in (0, 1, 5, 50):
+            histogram.observe(value)
+        output = self.registry.render()
+
+        # Assert
+        self.assertIn('tip_pull_size_bucket{le="1"} 2', output)
+        self.assertIn('tip_pull_size_bucket{le="10"} 3', output)
+        self.assertIn('tip_pull_size_bucket{le="+Inf"} 4', output)
+        self.assertIn("tip_pull_size_sum 56", output)
+        self.assertIn("tip_pull_size_count 4", output)
+
+    def test_disabled_registry_does_nothing(self):
+        """
+        Test that a disabled registry hands out metrics that do nothing and renders nothing.
+        """
+        # Act
+        counter = DISABLED_METRICS.counter("requests_total", "Requests")
+        counter.labels("200").inc()
+        with DISABLED_METRICS.histogram("seconds", "Seconds").time():
+            pass
+        DISABLED_METRICS.register_collector("hit_ratio", "gauge", "Hit ratio", lambda: 1 / 0)
+
+        # Assert
+        self.assertIs(counter, DISABLED_METRICS.gauge("other", "Other"))
+        self.assertEqual(DISABLED_METRICS.render(), "")
+
+    def test_exporter_serves_metrics_and_dumps_file(self):
+        """
+        Test that the exporter serves /metrics over HTTP and writes the metrics file on stop.
+        """
+        # Arrange
+        os.makedirs(self.directory, exist_ok=True)
+        file_path = os.path.join(self.directory, "metrics.prom")
+        self.registry.counter("alerts_total", "Alerts").inc(7)
+        exporter = MetricsExporter(self.registry, port=0, file_path=file_path, dump_interval=60).start()
+
+        # Act
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{exporter.port}/metrics", timeout=5) as response:
+                body = response.read().decode()
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"http://127.0.0.1:{exporter.port}/other", timeout=5)
+        finally:
+            exporter.stop()
+
+        # Assert
+        self.assertIn("tip_alerts_total 7", body)
+        with open(file_path) as file:
+            self.assertIn("tip_alerts_total 7", file.read())
+
+    def test_ingestion_records_pull_size(self):
+        """
+        Test that the ingestion service records the size of every pull and the malformed messages.
+        """
+        # Arrange
+        subscriber = FakeSubscriber([b"1.2.3.4", b"\xff", b"5.6.7.8"])
+        ingestion_service = IngestionService(subscription_name="fake", service_account_path="fake.json",
+                                             subscriber=subscriber, metrics=self.registry)
+
+        # Act
+        messages = ingestion_service.pull_messages()
+        ingestion_service.transform_messages_to_alerts(messages)
+        ingestion_service.ack_manager.close()
+        output = self.registry.render()
+
+        # Assert
+        self.assertIn("tip_pull_size_messages_count 1", output)
+        self.assertIn("tip_pull_size_messages_sum 3", output)
+        self.assertIn("tip_malformed_messages_total 1", output)
+        self.assertIn("tip_message_decode_seconds_count 3", output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import unittest
+from unittest.mock import patch
+from app.alert import Alert, IocRecord, SOURCE_REMOTE
+from app.scoring import AlertScore, BinaryPolicy
+from app.priority_scheduler import PriorityScheduler, ORDER_FIFO, ORDER_SIZE, ORDER_PRIORITY
+
+
+def record(ioc: str, is_malicious: bool) -> IocRecord:
+    return IocRecord(ioc, "ipv4", is_malicious, SOURCE_REMOTE, 0.0)
+
+
+def pending(scores: list) -> dict:
+    pending_scores = {}
+    for score in scores:
+        for ioc in score.alert.ioc:
+            if score.records[score.alert.ioc.index(ioc)] is None:
+                pending_scores.setdefault(ioc, []).append(score)
+    return pending_scores
+
+
+class TestPriorityScheduler(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Build a batch of a small alert, a big alert and a small alert with a high priority before each test.
+        """
+        # Arrange
+        small = Alert(["1.1.1.1"])
+        big = Alert(["2.2.2.2", "3.3.3.3", "4.4.4.4"])
+        urgent = Alert(["5.5.5.5"], priority=5)
+        self.scores = [AlertScore(alert, BinaryPolicy()) for alert in (small, big, urgent)]
+
+    def test_order_lookups(self):
+        """
+        Test that the lookups follow the configured alert order.
+        """
+        # Act
+        fifo = PriorityScheduler(order=ORDER_FIFO).order_lookups(self.scores, pending(self.scores))
+        size = PriorityScheduler(order=ORDER_SIZE).order_lookups(self.scores, pending(self.scores))
+        priority = PriorityScheduler(order=ORDER_PRIORITY).order_lookups(self.scores, pending(self.scores))
+
+        # Assert
+        self.assertEqual(fifo, ["1.1.1.1", "2.2.2.2", "3.3.3.3", "4.4.4.4", "5.5.5.5"])
+        self.assertEqual(size, ["2.2.2.2", "3.3.3.3", "4.4.4.4", "1.1.1.1", "5.5.5.5"])
+        self.assertEqual(priority, ["5.5.5.5", "2.2.2.2", "3.3.3.3", "4.4.4.4", "1.1.1.1"])
+
+    def test_order_prefers_alerts_closest_to_done(self):
+        """
+        Test that among alerts of the same size the one with fewer lookups left goes first.
+        """
+        # Arrange
+        first = AlertScore(Alert(["1.1.1.1", "2.2.2.2"]), BinaryPolicy())
+        second = AlertScore(Alert(["3.3.3.3", "4.4.4.4"]), BinaryPolicy())
+        second.add(record("3.3.3.3", False))  # e.g. a cache hit
+
+        # Act
+        order = PriorityScheduler(order=ORDER_SIZE).order_lookups([first, second], pending([first, second]))
+
+        # Assert
+        self.assertEqual(order, ["4.4.4.4", "1.1.1.1", "2.2.2.2"])
+
+    def test_is_decided(self):
+        """
+        Test that an alert is decided once no lookup left can move it across the decision severity.
+        """
+        # Arrange
+        scheduler = PriorityScheduler(decision_severity=50)
+        high = AlertScore(Alert(["1.1.1.1", "2.2.2.2", "3.3.3.3", "4.4.4.4"]), BinaryPolicy())
+        low = AlertScore(Alert(["5.5.5.5", "6.6.6.6", "7.7.7.7", "8.8.8.8"]), BinaryPolicy())
+
+        # Act
+        undecided = scheduler.is_decided(high)
+        high.add(record("1.1.1.1", True))
+        high.add(record("2.2.2.2", True))
+        for ioc in ("5.5.5.5", "6.6.6.6", "7.7.7.7"):
+            low.add(record(ioc, False))
+
+        # Assert
+        self.assertFalse(undecided)
+        self.assertTrue(scheduler.is_decided(high))
+        self.assertTrue(scheduler.is_decided(low))
+        self.assertFalse(PriorityScheduler().is_decided(high))
+
+    def test_from_env(self):
+        """
+        Test that the order and the decision severity are read from the .env file.
+        """
+        # Act
+        with patch.dict(os.environ, {"ALERT_ORDER": "priority", "EARLY_EXIT_SEVERITY": "60"}):
+            scheduler = PriorityScheduler.from_env()
+
+        # Assert
+        self.assertEqual(scheduler.order, ORDER_PRIORITY)
+        self.assertEqual(scheduler.decision_severity, 60)
+        with self.assertRaises(ValueError):
+            PriorityScheduler(order="random")
+
+
+if __name__ == "__main__":
+    unittest.main()
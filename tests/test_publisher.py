@@ -0,0 +1,111 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from app.ioc_classifier import classify_ioc
+from publisher_service.publisher import IocGenerator, TipDemoError, parse_distribution, run_load
+
+
+class FakePublisher:
+    """
+    Publisher that sends the messages on background threads, so the futures complete while more are published.
+    The publish of a message containing "fail" fails.
+    """
+    def __init__(self):
+        self.messages = []
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def publish(self, topic, data):
+        self.messages.append(data)
+        return self.executor.submit(self.send, data)
+
+    def send(self, data):
+        if b"fail" in data:
+            raise RuntimeError("publish failed")
+        return str(len(data))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+class TestPublisher(unittest.TestCase):
+
+    def test_ioc_generator(self):
+        """
+        Test that the messages follow the IoC count and type mix, and that the repeat ratio reuses IoCs.
+        """
+        # Arrange
+        generator = IocGenerator(iocs_per_message="3", ioc_mix="ipv4=1,domain=1,url=1,md5=1,sha256=1",
+                                 repeat_ratio=0.5, hot_set_size=50, seed=7)
+
+        # Act
+        messages = [generator.next_message() for _ in range(200)]
+        iocs = [ioc for message in messages for ioc in message.split("\n")]
+
+        # Assert
+        self.assertEqual(len(iocs), 600)
+        self.assertTrue(all(classify_ioc(ioc) is not None for ioc in iocs))
+        self.assertEqual({classify_ioc(ioc) for ioc in iocs}, {"ipv4", "domain", "url", "md5", "sha256"})
+        self.assertAlmostEqual(generator.repeated / generator.generated, 0.5, delta=0.1)
+        self.assertLessEqual(len(generator.hot_set), 50)
+
+    def test_parse_distribution(self):
+        """
+        Test the fixed, uniform and exponential distributions, and that invalid ones are rejected.
+        """
+        # Arrange
+        generator = IocGenerator(seed=1)
+
+        # Act & Assert
+        self.assertEqual(parse_distribution("4")(generator.rng), 4)
+        self.assertTrue(all(2 <= parse_distribution("2-5")(generator.rng) <= 5 for _ in range(100)))
+        self.assertTrue(all(parse_distribution("exp:3")(generator.rng) >= 1 for _ in range(100)))
+        for spec in ("0", "5-2", "exp:0", "many"):
+            with self.assertRaises(TipDemoError):
+                parse_distribution(spec)
+
+    def test_run_load_count_and_failures(self):
+        """
+        Test that the load run publishes the message count, waits for the publishes in flight,
+        and counts the failed ones.
+        """
+        # Arrange
+        publisher = FakePublisher()
+        messages = iter(["1.1.1.1", "fail", "2.2.2.2"])
+
+        # Act
+        report = run_load(publisher, "topic", lambda: next(messages), count=3)
+
+        # Assert
+        self.assertEqual(len(publisher.messages), 3)
+        self.assertEqual((report.published, report.failed), (2, 1))
+        self.assertEqual(report.bytes, len(b"1.1.1.1") + len(b"2.2.2.2"))
+
+    def test_run_load_rate_and_duration(self):
+        """
+        Test that the load run keeps to the target rate until the duration is over.
+        """
+        # Arrange
+        publisher = FakePublisher()
+        clock = FakeClock()
+
+        # Act
+        report = run_load(publisher, "topic", lambda: "1.1.1.1", rate=10, duration=2.0, clock=clock, sleep=clock.sleep)
+
+        # Assert
+        self.assertEqual(report.published, 20)
+        self.assertAlmostEqual(report.summary()["messages_per_second"], 10, delta=0.6)
+        with self.assertRaises(TipDemoError):
+            run_load(publisher, "topic", lambda: "1.1.1.1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+from app.metrics import MetricsRegistry
+from app.rate_limiter import RateLimiter
+from app.pull_scheduler import PullScheduler
+
+
+class FakeTimer:
+    """
+    A controllable clock for the rate limiter.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPullScheduler(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Initialize a scheduler of 10 to 80 messages per pull and 1 to 8 seconds between pulls before each test.
+        """
+        # Arrange
+        self.metrics = MetricsRegistry()
+        self.scheduler = PullScheduler(min_pull_size=10, max_pull_size=80, min_interval=1, max_interval=8,
+                                       max_backlog=100, metrics=self.metrics)
+
+    def test_full_pulls_grow_the_pull_size(self):
+        """
+        Test that full pulls double the pull size up to the maximum and are followed by a pull right away.
+        """
+        # Act
+        sizes = []
+        intervals = []
+        for _ in range(4):
+            intervals.append(self.scheduler.record_pull(self.scheduler.pull_size))
+            sizes.append(self.scheduler.pull_size)
+
+        # Assert
+        self.assertEqual(sizes, [20, 40, 80, 80])
+        self.assertEqual(intervals, [0, 0, 0, 0])
+
+    def test_partial_pull_keeps_size_and_waits_min_interval(self):
+        """
+        Test that a pull that is not full keeps the pull size and waits the minimum interval.
+        """
+        # Act
+        interval = self.scheduler.record_pull(3)
+
+        # Assert
+        self.assertEqual(self.scheduler.pull_size, 10)
+        self.assertEqual(interval, 1)
+
+    def test_empty_pulls_back_off_exponentially(self):
+        """
+        Test that empty pulls in a row shrink the pull size and double the wait up to the maximum,
+        and that a pull with messages resets the wait.
+        """
+        # Arrange
+        for _ in range(3):
+            self.scheduler.record_pull(self.scheduler.pull_size)
+
+        # Act
+        intervals = [self.scheduler.record_pull(0) for _ in range(6)]
+        size_after_empty = self.scheduler.pull_size
+        interval_after_messages = self.scheduler.record_pull(1)
+
+        # Assert
+        self.assertEqual(intervals, [1, 2, 4, 8, 8, 8])
+        self.assertEqual(size_after_empty, 10)
+        self.assertEqual(interval_after_messages, 1)
+
+    def test_throttle_on_backlog(self):
+        """
+        Test that pulls are held back when the backlog is full, and the pull size never exceeds the room left.
+        """
+        # Act
+        delay_full = self.scheduler.throttle_delay(backlog=100)
+        delay_room = self.scheduler.throttle_delay(backlog=95)
+
+        # Assert
+        self.assertGreater(delay_full, 0)
+        self.assertEqual(delay_room, 0)
+        self.assertEqual(self.scheduler.pull_size_for(backlog=95), 5)
+        self.assertIn('tip_pull_scheduler_throttled_total{reason="backlog"} 1', self.metrics.render())
+
+    def test_pull_capped_by_backlog_counts_as_full(self):
+        """
+        Test that a pull that returns all it asked for is full even when the backlog capped it below the pull size.
+        """
+        # Arrange
+        requested = self.scheduler.pull_size_for(backlog=97)
+
+        # Act
+        interval = self.scheduler.record_pull(requested, requested)
+
+        # Assert
+        self.assertEqual(requested, 3)
+        self.assertEqual(interval, 0)
+        self.assertEqual(self.scheduler.pull_size, 20)
+
+    def test_throttle_on_spent_budget(self):
+        """
+        Test that pulls are held back while the VirusTotal budget is spent, and resume once it refills.
+        """
+        # Arrange
+        timer = FakeTimer()
+        rate_limiter = RateLimiter(requests_per_minute=1, requests_per_day=100, timer=timer)
+        rate_limiter.try_acquire()
+
+        # Act
+        delay_spent = self.scheduler.throttle_delay(rate_limiter=rate_limiter)
+        timer.now += 60
+        delay_refilled = self.scheduler.throttle_delay(rate_limiter=rate_limiter)
+
+        # Assert
+        self.assertGreater(delay_spent, 0)
+        self.assertEqual(delay_refilled, 0)
+        self.assertIn('tip_pull_scheduler_throttled_total{reason="budget"} 1', self.metrics.render())
+
+    def test_metrics_follow_decisions(self):
+        """
+        Test that the pull size, interval and backlog gauges show the last decision.
+        """
+        # Act
+        self.scheduler.record_pull(10)
+        self.scheduler.throttle_delay(backlog=7)
+        rendered = self.metrics.render()
+
+        # Assert
+        self.assertIn("tip_pull_scheduler_pull_size 20", rendered)
+        self.assertIn("tip_pull_scheduler_interval_seconds 0", rendered)
+        self.assertIn("tip_pull_scheduler_backlog 7", rendered)
+
+
+if __name__ == "__main__":
+    unittest.main()
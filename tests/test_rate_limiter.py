@@ -0,0 +1,125 @@
+import threading
+import time
+import unittest
+from app.rate_limiter import RateLimiter, parse_retry_after
+
+
+class FakeTimer:
+    """
+    A controllable clock so quotas can be tested without waiting a minute.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Initialize a limiter of 2 requests a minute and 3 a day with a fake clock before each test.
+        """
+        # Arrange
+        self.timer = FakeTimer()
+        self.rate_limiter = RateLimiter(requests_per_minute=2, requests_per_day=3, timer=self.timer)
+
+    def test_per_minute_quota(self):
+        """
+        Test that the minute quota is enforced and refills over time.
+        """
+        # Act
+        results = [self.rate_limiter.try_acquire() for _ in range(3)]
+        self.timer.now += 30  # half a minute refills one request
+        after_refill = self.rate_limiter.try_acquire()
+
+        # Assert
+        self.assertEqual(results, [True, True, False])
+        self.assertTrue(after_refill)
+
+    def test_per_day_quota(self):
+        """
+        Test that the day quota is enforced even when the minute quota has budget.
+        """
+        # Arrange
+        for _ in range(3):
+            self.rate_limiter.try_acquire()
+            self.timer.now += 60
+
+        # Act
+        result = self.rate_limiter.try_acquire()
+
+        # Assert
+        self.assertFalse(result)
+        self.assertEqual(self.rate_limiter.remaining()["day"], 0)
+
+    def test_back_off(self):
+        """
+        Test that backing off blocks lookups until the Retry-After period ends.
+        """
+        # Arrange
+        self.rate_limiter.back_off(10)
+
+        # Act
+        during_back_off = self.rate_limiter.try_acquire()
+        self.timer.now += 10
+        after_back_off = self.rate_limiter.try_acquire()
+
+        # Assert
+        self.assertFalse(during_back_off)
+        self.assertTrue(after_back_off)
+
+    def test_acquire_waits_for_budget(self):
+        """
+        Test that acquire queues the lookup while the budget is spent and releases it when it refills.
+        """
+        # Arrange
+        self.rate_limiter.try_acquire()
+        self.rate_limiter.try_acquire()
+        done = threading.Event()
+        waiter = threading.Thread(target=lambda: (self.rate_limiter.acquire(), done.set()))
+
+        # Act
+        waiter.start()
+        time.sleep(0.05)
+        queued = self.rate_limiter.remaining()["queued"]
+        blocked = not done.is_set()
+        self.timer.now += 30
+        waiter.join(timeout=2)
+
+        # Assert
+        self.assertTrue(blocked, "acquire should wait while the minute quota is spent")
+        self.assertEqual(queued, 1)
+        self.assertTrue(done.is_set())
+
+    def test_has_spare_budget(self):
+        """
+        Test that there is spare budget only while every quota keeps the reserve and there is no back off.
+        """
+        # Act
+        with_full_budget = self.rate_limiter.has_spare_budget(reserve=1)
+        self.rate_limiter.try_acquire()
+        without_reserve = self.rate_limiter.has_spare_budget(reserve=1)
+        without_any_reserve = self.rate_limiter.has_spare_budget()
+        self.rate_limiter.back_off(10)
+        during_back_off = self.rate_limiter.has_spare_budget()
+
+        # Assert
+        self.assertTrue(with_full_budget)
+        self.assertFalse(without_reserve, "one request left in the minute quota is the reserve")
+        self.assertTrue(without_any_reserve)
+        self.assertFalse(during_back_off)
+
+    def test_parse_retry_after(self):
+        """
+        Test parsing Retry-After as seconds, and falling back to the default when it is missing or invalid.
+        """
+        # Assert
+        self.assertEqual(parse_retry_after("7"), 7)
+        self.assertEqual(parse_retry_after(None, default=60), 60)
+        self.assertEqual(parse_retry_after("not a date", default=60), 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import json
+import shutil
+import sqlite3
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock
+from app.alert import Alert
+from app.enrichment_service import EnrichmentService
+from app.report_sink import JsonFileSink, SQLiteSink
+from app.report_index import ReportIndex, file_time, parse_time
+
+DUMMY_DIR = "./tests/temporary_report_index"
+
+
+def make_report(alert_id: str, severity: int, iocs: list) -> dict:
+    return {"AlertId": alert_id, "Severity": severity, "IoCs": [{"IoCs": ioc, "IsMalicious": False, "Source": "remote"} for ioc in iocs]}
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestReportIndex(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create an index with three reports saved an hour apart.
+        """
+        shutil.rmtree(DUMMY_DIR, ignore_errors=True)
+        self.timer = FakeTimer()
+        self.index = ReportIndex(db_path=os.path.join(DUMMY_DIR, "index.db"), commit_every=2, timer=self.timer)
+        for alert_id, severity, iocs in (("a", 0, ["1.2.3.4", "example.com"]), ("b", 50, ["1.2.3.4", "5.6.7.8"]),
+                                         ("c", 100, ["EXAMPLE.com"])):
+            self.index.add(make_report(alert_id, severity, iocs))
+            self.timer.now += 3600
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(DUMMY_DIR, ignore_errors=True)  # clean up.
+
+    def test_query(self):
+        """
+        Test the lookups by IoC, severity and time range, the latest alerts first.
+        """
+        # Act
+        by_ioc = [alert["AlertId"] for alert in self.index.query(ioc="1.2.3.4")]
+        by_domain = [alert["AlertId"] for alert in self.index.query(ioc="Example.COM")]
+        severe_last_hours = [alert["AlertId"] for alert in self.index.query(min_severity=50, since=self.timer.now - 1.5 * 3600)]
+        older = [alert["AlertId"] for alert in self.index.query(until=self.timer.now - 2 * 3600)]
+
+        # Assert
+        self.assertEqual(by_ioc, ["b", "a"])
+        self.assertEqual(by_domain, ["c", "a"])
+        self.assertEqual(severe_last_hours, ["c"])
+        self.assertEqual(older, ["a"])
+        self.assertEqual(self.index.query(ioc="9.9.9.9"), [])
+
+    def test_report_saved_again_replaces_it(self):
+        """
+        Test that the complete report of an alert replaces its partial report.
+        """
+        # Act
+        self.index.add({**make_report("d", 100, ["6.6.6.6"]), "Partial": True})
+        self.index.add(make_report("d", 50, ["6.6.6.6", "7.7.7.7"]))
+        alerts = self.index.query(ioc="7.7.7.7")
+
+        # Assert
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual((alerts[0]["Severity"], alerts[0]["Partial"]), (50, False))
+        self.assertEqual(self.index.alert_iocs("d"), ["6.6.6.6", "7.7.7.7"])
+
+    def test_rebuild(self):
+        """
+        Test that the index is rebuilt from the report files of an output directory, with the time of their names.
+        """
+        # Arrange
+        output = os.path.join(DUMMY_DIR, "output")
+        os.makedirs(output)
+        with open(os.path.join(output, "report_01012025_120000_000000.json"), "w") as file:
+            json.dump(make_report("x", 80, ["8.8.8.8"]), file)
+        with open(os.path.join(output, "reports_02012025_120000_000000_1.jsonl"), "w") as file:
+            file.write(json.dumps(make_report("y", 10, ["8.8.8.8"])) + "\n" + json.dumps(make_report("z", 0, ["9.9.9.9"])) + "\n")
+
+        # Act
+        indexed = self.index.rebuild(output)
+
+        # Assert
+        self.assertEqual(indexed, 3)
+        self.assertEqual([alert["AlertId"] for alert in self.index.query(ioc="8.8.8.8")], ["y", "x"])
+        self.assertEqual(self.index.query(ioc="1.2.3.4"), [])
+        self.assertEqual(self.index.query(ioc="8.8.8.8")[1]["SavedAt"],
+                         file_time(os.path.join(output, "report_01012025_120000_000000.json")))
+        self.assertLess(abs(parse_time("1h") - (parse_time("2h") + 3600)), 1)
+
+    def test_rebuild_from_sqlite_sink(self):
+        """
+        Test that the reports of the SQLite sink are indexed with the time each was saved, and that another database
+        in the output directory is skipped.
+        """
+        # Arrange
+        output = os.path.join(DUMMY_DIR, "output")
+        sink = SQLiteSink(db_path=os.path.join(output, "reports.db"))
+        sink.write(make_report("x", 80, ["8.8.8.8"]))
+        sink.write(make_report("y", 10, ["8.8.8.8"]))
+        sink.close()
+        with sqlite3.connect(os.path.join(output, "reports.db")) as db:
+            db.execute("UPDATE reports SET saved_at = ? WHERE alert_id = ?", ("01012025_120000_000000", "x"))
+        ReportIndex(db_path=os.path.join(output, "report_index.db")).close()
+
+        # Act
+        indexed = self.index.rebuild(output)
+
+        # Assert
+        self.assertEqual(indexed, 2)
+        alerts = {alert["AlertId"]: alert for alert in self.index.query(ioc="8.8.8.8")}
+        self.assertEqual(alerts["x"]["SavedAt"], datetime(2025, 1, 1, 12).timestamp())
+        self.assertGreater(alerts["y"]["SavedAt"], alerts["x"]["SavedAt"])
+
+    def test_enrichment_service_indexes_saved_reports(self):
+        """
+        Test that the reports saved by the enrichment service are indexed, and committed by flush_reports.
+        """
+        # Arrange
+        enrichment_service = EnrichmentService(virustotal_client=MagicMock(), report_index=self.index,
+                                               report_sink=JsonFileSink(directory=os.path.join(DUMMY_DIR, "output")))
+        enrichment_service.query_virustotal = MagicMock(return_value={})
+        reader = ReportIndex(db_path=self.index.db_path)
+        self.addCleanup(reader.close)
+
+        # Act
+        reports = enrichment_service.analyze_alerts(
+            [Alert(["4.3.2.1"])], on_report=lambda report: enrichment_service.save_report_to_file(report=report))
+        enrichment_service.flush_reports()
+        alerts = reader.query(ioc="4.3.2.1")
+
+        # Assert
+        self.assertEqual([alert["AlertId"] for alert in alerts], [reports[0]["AlertId"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
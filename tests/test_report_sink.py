@@ -0,0 +1,147 @@
+import os
+import gzip
+import json
+import shutil
+import sqlite3
+import unittest
+from app.report_sink import JsonFileSink, JsonLinesSink, SQLiteSink
+
+
+def make_report(index: int) -> dict:
+    return {"AlertId": f"alert-{index}", "Severity": index, "IoCs": [{"IoCs": "1.2.3.4", "IsMalicious": True}]}
+
+
+class FakeTimer:
+    """
+    A controllable clock so the flush and rotation intervals can be tested without sleeping.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestReportSink(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create a dummy output directory before each test.
+        """
+        self.dummy_dir = "./tests/temporary_sink_output"
+        if os.path.exists(self.dummy_dir):
+            shutil.rmtree(self.dummy_dir)
+        self.timer = FakeTimer()
+
+    def tearDown(self):
+        shutil.rmtree(self.dummy_dir, ignore_errors=True)  # clean up.
+
+    def test_json_file_sink_buffers_and_flushes(self):
+        """
+        Test that reports are buffered until flush_every is reached, then saved one json file each.
+        """
+        # Arrange
+        sink = JsonFileSink(directory=self.dummy_dir, flush_every=3, timer=self.timer)
+
+        # Act
+        sink.write(make_report(1))
+        sink.write(make_report(2))
+        files_before_flush = os.listdir(self.dummy_dir)
+        sink.write(make_report(3))
+
+        # Assert
+        self.assertEqual(files_before_flush, [])
+        files = sorted(os.listdir(self.dummy_dir))
+        self.assertEqual(len(files), 3)
+        with open(os.path.join(self.dummy_dir, files[0])) as file:
+            self.assertIn(json.load(file)["AlertId"], {"alert-1", "alert-2", "alert-3"})
+
+    def test_flush_by_time(self):
+        """
+        Test that a buffered report is written once the oldest waited flush_interval.
+        """
+        # Arrange
+        sink = SQLiteSink(db_path=os.path.join(self.dummy_dir, "reports.db"), flush_every=100,
+                          flush_interval=5, timer=self.timer)
+        sink.write(make_report(1))
+
+        # Act
+        self.timer.now += 5
+        sink.write(make_report(2))
+
+        # Assert
+        self.assertEqual(sink.written, 2)
+        self.assertEqual(sink.flushes, 1)
+        sink.close()
+
+    def test_json_lines_sink_rotation_and_gzip(self):
+        """
+        Test that the json lines file is rotated by size and rotated files are gzipped, with no report lost.
+        """
+        # Arrange
+        sink = JsonLinesSink(directory=self.dummy_dir, rotate_bytes=200, compression="gzip",
+                             flush_every=2, timer=self.timer)
+
+        # Act
+        for index in range(6):
+            sink.write(make_report(index))
+        sink.close()
+
+        # Assert
+        self.assertGreater(len(sink.rotated_files), 1)
+        lines = []
+        for path in sink.rotated_files:
+            self.assertTrue(path.endswith(".jsonl.gz"))
+            with gzip.open(path, "rt") as file:
+                lines.extend(json.loads(line) for line in file)
+        self.assertEqual([report["AlertId"] for report in lines], [f"alert-{index}" for index in range(6)])
+
+    def test_json_lines_unknown_compression(self):
+        """
+        Test that an unknown compression is rejected.
+        """
+        with self.assertRaises(ValueError):
+            JsonLinesSink(directory=self.dummy_dir, compression="lz4")
+
+    def test_sqlite_sink_close_flushes(self):
+        """
+        Test that closing the sink saves the buffered reports to the database.
+        """
+        # Arrange
+        db_path = os.path.join(self.dummy_dir, "reports.db")
+        sink = SQLiteSink(db_path=db_path, flush_every=100)
+        sink.write(make_report(1))
+        sink.write(make_report(2))
+
+        # Act
+        sink.close()
+
+        # Assert
+        db = sqlite3.connect(db_path)
+        rows = db.execute("SELECT alert_id, severity FROM reports ORDER BY alert_id").fetchall()
+        db.close()
+        self.assertEqual(rows, [("alert-1", 1), ("alert-2", 2)])
+
+
+    def test_failed_write_is_reported(self):
+        """
+        Test that the AlertIds of a batch that could not be written are handed out once by take_failed.
+        """
+        # Arrange
+        sink = JsonFileSink(directory=self.dummy_dir, flush_every=100, timer=self.timer)
+        sink.write(make_report(1))
+        sink.write(make_report(2))
+        shutil.rmtree(self.dummy_dir)
+
+        # Act
+        sink.flush()
+        failed = sink.take_failed()
+
+        # Assert
+        self.assertEqual(failed, {"alert-1", "alert-2"})
+        self.assertEqual(sink.failed, 2)
+        self.assertEqual(sink.take_failed(), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import threading
+import unittest
+from app.request_coalescer import RequestCoalescer
+
+
+class TestRequestCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Initialize the RequestCoalescer before each test.
+        """
+        # Arrange
+        self.coalescer = RequestCoalescer()
+
+    def test_concurrent_requests_share_one_call(self):
+        """
+        Test that callers of the same key that arrive while it is in flight get the result of a single call.
+        """
+        # Arrange
+        release = threading.Event()
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            release.wait(2)
+            return "malicious"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.coalescer.run("1.2.3.4", slow_call)))
+                   for _ in range(5)]
+
+        # Act
+        for thread in threads:
+            thread.start()
+        while self.coalescer.stats()["coalesced"] < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        # Assert
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["malicious"] * 5)
+        self.assertEqual(self.coalescer.stats(), {"calls": 1, "coalesced": 4})
+
+    def test_sequential_requests_are_not_coalesced(self):
+        """
+        Test that a finished call is not reused, every new request after it sends its own call.
+        """
+        # Act
+        self.coalescer.run("1.2.3.4", lambda: 1)
+        self.coalescer.run("1.2.3.4", lambda: 2)
+
+        # Assert
+        self.assertEqual(self.coalescer.stats(), {"calls": 2, "coalesced": 0})
+
+    def test_exception_is_raised_to_caller(self):
+        """
+        Test that an exception of the call is raised, and the key can be requested again after it.
+        """
+        # Act / Assert
+        with self.assertRaises(ValueError):
+            self.coalescer.run("1.2.3.4", lambda: (_ for _ in ()).throw(ValueError("failed")))
+        self.assertEqual(self.coalescer.run("1.2.3.4", lambda: "ok"), "ok")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from benchmarks.run_pipeline import run_benchmark, compare_results
+
+
+class TestRunPipeline(unittest.TestCase):
+    """
+    Smoke tests of the end-to-end benchmark harness.
+    """
+
+    def test_run_benchmark_pull_mode(self):
+        """
+        Test that a small pull mode run processes every message and reports the measurements.
+        """
+        # Act
+        results = run_benchmark(messages=5, mode="pull", workers=2, latency=0.0, sink="jsonl")["results"]
+
+        # Assert
+        self.assertEqual(results["alerts"], 5)
+        self.assertEqual(results["upstream_requests"], results["iocs"])
+        self.assertGreater(results["alerts_per_second"], 0)
+        self.assertGreaterEqual(results["latency_p99_seconds"], results["latency_p50_seconds"])
+
+    def test_run_benchmark_streaming_mode_with_errors(self):
+        """
+        Test that a streaming run completes even when the stub answers some lookups with errors.
+        """
+        # Act
+        results = run_benchmark(messages=5, mode="streaming", workers=2, latency=0.0, error_rate=0.3, sink="sqlite")["results"]
+
+        # Assert
+        self.assertEqual(results["alerts"], 5)
+        self.assertGreaterEqual(results["upstream_requests"], results["iocs"])
+
+    def test_compare_results(self):
+        """
+        Test that numeric results are compared with the relative change.
+        """
+        # Act
+        lines = compare_results({"results": {"alerts_per_second": 20.0, "cache": None}},
+                                {"results": {"alerts_per_second": 10.0}})
+
+        # Assert
+        self.assertEqual(len(lines), 1)
+        self.assertIn("+100.0%", lines[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
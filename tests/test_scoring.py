@@ -0,0 +1,96 @@
+import os
+import unittest
+from unittest.mock import patch
+from app.alert import Alert, IocRecord, SOURCE_REMOTE, SOURCE_LOCAL
+from app.scoring import (
+    AlertScore, BinaryPolicy, WeightedPolicy, ScoringPolicy, analysis_stats,
+    build_scoring_policy_from_env, register_policy, parse_weights, POLICIES
+)
+
+
+def remote_record(ioc: str, malicious: int, suspicious: int = 0) -> IocRecord:
+    return IocRecord(ioc, "ipv4", malicious > 0, SOURCE_REMOTE, 0.0, (malicious, suspicious, 70, 10))
+
+
+class TestScoring(unittest.TestCase):
+
+    def test_analysis_stats(self):
+        """
+        Test that the engine counts are read from a report, and that a failed lookup has none.
+        """
+        # Arrange
+        response = {"data": {"attributes": {"last_analysis_stats": {"malicious": 3, "suspicious": 1, "harmless": 60}}}}
+
+        # Act & Assert
+        self.assertEqual(analysis_stats(response), (3, 1, 60, 0))
+        self.assertIsNone(analysis_stats({}))
+
+    def test_weighted_policy(self):
+        """
+        Test that the weighted policy scores by engine counts, capped at 1, and falls back to the verdict without counts.
+        """
+        # Arrange
+        policy = WeightedPolicy(weights={"malicious": 1, "suspicious": 0.5}, saturation=4)
+
+        # Act & Assert
+        self.assertEqual(policy.ioc_score(remote_record("1.1.1.1", 1, 2)), 0.5)
+        self.assertEqual(policy.ioc_score(remote_record("1.1.1.1", 9)), 1.0)
+        self.assertEqual(policy.ioc_score(remote_record("1.1.1.1", 0)), 0.0)
+        self.assertEqual(policy.ioc_score(IocRecord("1.1.1.1", "ipv4", True, SOURCE_LOCAL, 0.0)), 1.0)
+        with self.assertRaises(ValueError):
+            WeightedPolicy(weights={"bogus": 1})
+
+    def test_alert_score_is_incremental(self):
+        """
+        Test that the severity grows as verdicts arrive, between its lower and upper bounds,
+        and that a repeated IoC counts at every position.
+        """
+        # Arrange
+        alert = Alert(["1.1.1.1", "2.2.2.2", "1.1.1.1", "3.3.3.3"])
+        score = AlertScore(alert, BinaryPolicy())
+
+        # Act
+        added = score.add(remote_record("1.1.1.1", 2))
+        added_again = score.add(remote_record("1.1.1.1", 2))
+        partial = (score.severity, score.max_severity, score.resolved)
+        score.add(remote_record("2.2.2.2", 0))
+        score.add(remote_record("3.3.3.3", 0))
+
+        # Assert
+        self.assertTrue(added)
+        self.assertFalse(added_again)
+        self.assertEqual(partial, (50, 100, 2))
+        self.assertTrue(score.complete)
+        self.assertEqual((score.severity, score.max_severity), (50, 50))
+        self.assertEqual(len(score.to_partial_report()["IoCs"]), 4)
+
+    def test_build_policy_from_env(self):
+        """
+        Test that the policy is selected from the .env file, and that registered policies can be selected.
+        """
+        # Arrange
+        class AlwaysMalicious(ScoringPolicy):
+            def ioc_score(self, record):
+                return 1.0
+        self.addCleanup(POLICIES.pop, "always", None)
+        register_policy("always", AlwaysMalicious)
+
+        # Act
+        with patch.dict(os.environ, {"SCORING_POLICY": "weighted", "SCORING_WEIGHTS": "malicious=2, harmless=-0.1",
+                                     "SCORING_SATURATION": "10"}):
+            weighted = build_scoring_policy_from_env()
+        with patch.dict(os.environ, {"SCORING_POLICY": "always"}):
+            registered = build_scoring_policy_from_env()
+        with patch.dict(os.environ, {}, clear=True):
+            default = build_scoring_policy_from_env()
+
+        # Assert
+        self.assertEqual(weighted.weights, (2.0, 0.0, -0.1, 0.0))
+        self.assertEqual(weighted.saturation, 10.0)
+        self.assertIsInstance(registered, AlwaysMalicious)
+        self.assertIsInstance(default, BinaryPolicy)
+        self.assertEqual(parse_weights("malicious=1,suspicious=0.5"), {"malicious": 1.0, "suspicious": 0.5})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,218 @@
+import os
+import time
+import shutil
+import threading
+import unittest
+from unittest.mock import MagicMock
+from app.spool_queue import SpoolQueue
+from app.ingestion_service import IngestionService
+from benchmarks.fake_pubsub import FakeSubscriber
+
+
+class FakeTimer:
+    """
+    A controllable clock so leases can be tested without sleeping.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSpoolQueue(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create a spool in a temporary directory before each test.
+        """
+        # Arrange
+        self.directory = "./tests/temporary_spool"
+        self.db_path = os.path.join(self.directory, "spool.db")
+        self.timer = FakeTimer()
+        self.spool = SpoolQueue(db_path=self.db_path, lease_seconds=60, timer=self.timer)
+
+    def tearDown(self):
+        """
+        Close the spool and remove the temporary directory after each test.
+        """
+        try:
+            self.spool.close()
+        except Exception:
+            pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_put_get_and_ack(self):
+        """
+        Test that spooled messages are handed out oldest first, once, and deleted by ack.
+        """
+        # Arrange
+        self.spool.put_many([b"1.1.1.1", b"2.2.2.2", b"3.3.3.3"])
+
+        # Act
+        first = self.spool.get_batch(2)
+        second = self.spool.get_batch(2)
+        self.spool.ack([spool_id for spool_id, _ in first + second])
+
+        # Assert
+        self.assertEqual([data for _, data in first], [b"1.1.1.1", b"2.2.2.2"])
+        self.assertEqual([data for _, data in second], [b"3.3.3.3"])
+        self.assertEqual(self.spool.get_batch(10), [])
+        self.assertEqual(self.spool.stats()["depth"], 0)
+        self.assertEqual(self.spool.stats()["consumed"], 3)
+
+    def test_expired_lease_is_redelivered(self):
+        """
+        Test that a message taken but not acked is handed out again after its lease expires.
+        """
+        # Arrange
+        self.spool.put_many([b"1.1.1.1"])
+        self.spool.get_batch(1)
+
+        # Act
+        before_expiry = self.spool.get_batch(1)
+        self.timer.now += 60
+        after_expiry = self.spool.get_batch(1)
+
+        # Assert
+        self.assertEqual(before_expiry, [])
+        self.assertEqual([data for _, data in after_expiry], [b"1.1.1.1"])
+        self.assertEqual(self.spool.stats()["redelivered"], 1)
+
+    def test_message_is_dead_lettered_after_max_deliveries(self):
+        """
+        Test that a message handed out max_deliveries times without being acked is moved to the dead letters,
+        and the messages behind it are handed out.
+        """
+        # Arrange
+        self.spool.max_deliveries = 2
+        self.spool.put_many([b"poison", b"2.2.2.2"])
+        deliveries = []
+        for _ in range(2):
+            deliveries.append(self.spool.get_batch(1))
+            self.timer.now += 60
+
+        # Act
+        batch = self.spool.get_batch(1)
+
+        # Assert
+        self.assertEqual([[data for _, data in delivery] for delivery in deliveries], [[b"poison"], [b"poison"]])
+        self.assertEqual([data for _, data in batch], [b"2.2.2.2"])
+        self.assertEqual(self.spool.stats()["dead_lettered"], 1)
+        self.assertEqual(self.spool.depth(), 1)
+        dead_letters = self.spool._db.execute("SELECT data, deliveries FROM dead_letters").fetchall()
+        self.assertEqual([(bytes(data), count) for data, count in dead_letters], [(b"poison", 2)])
+
+    def test_replay_after_restart(self):
+        """
+        Test that messages in progress when the process stopped are replayed by the next run.
+        """
+        # Arrange
+        self.spool.put_many([b"1.1.1.1", b"2.2.2.2"])
+        taken = self.spool.get_batch(1)
+        self.spool.ack([spool_id for spool_id, _ in taken])
+        self.spool.get_batch(1)
+        self.spool.close()
+
+        # Act
+        self.spool = SpoolQueue(db_path=self.db_path, lease_seconds=60, timer=self.timer)
+        replayed = self.spool.get_batch(10)
+
+        # Assert
+        self.assertEqual([data for _, data in replayed], [b"2.2.2.2"])
+
+    def test_put_calls_back_after_group_commit(self):
+        """
+        Test that messages given to put are committed together and acknowledged only after the commit.
+        """
+        # Arrange
+        spooled = []
+        all_spooled = threading.Event()
+
+        def on_spooled(index):
+            spooled.append(index)
+            if len(spooled) == 5:
+                all_spooled.set()
+
+        # Act
+        for index in range(5):
+            self.spool.put(f"10.0.0.{index}".encode(), on_spooled=lambda index=index: on_spooled(index))
+        all_spooled.wait(5)
+
+        # Assert
+        self.assertEqual(sorted(spooled), [0, 1, 2, 3, 4])
+        self.assertEqual(self.spool.depth(), 5)
+        self.assertLess(self.spool.stats()["group_commits"], 5)
+
+    def test_wait_for_room(self):
+        """
+        Test that a full spool reports no room until messages are consumed.
+        """
+        # Arrange
+        self.spool.max_entries = 2
+        self.spool.put_many([b"1.1.1.1", b"2.2.2.2"])
+
+        # Act
+        full = self.spool.wait_for_room(timeout=0.01)
+        self.spool.ack([spool_id for spool_id, _ in self.spool.get_batch(1)])
+        room = self.spool.wait_for_room(timeout=0.01)
+
+        # Assert
+        self.assertFalse(full)
+        self.assertTrue(room)
+
+    def test_streaming_callback_nacks_on_stop_when_full(self):
+        """
+        Test that a streaming callback waiting for room in a full spool gives its message back once streaming is stopped.
+        """
+        # Arrange
+        self.spool.max_entries = 1
+        self.spool.put_many([b"1.1.1.1"])
+        subscriber = FakeSubscriber([b"2.2.2.2"])
+        ingestion_service = IngestionService(subscription_name="fake", service_account_path="fake.json",
+                                             subscriber=subscriber, spool=self.spool)
+        ingestion_service.start_streaming(work_queue=None)
+        deadline = time.monotonic() + 2
+        while not subscriber.messages and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # Act
+        started = time.monotonic()
+        ingestion_service.stop_streaming(timeout=5)
+        elapsed = time.monotonic() - started
+
+        # Assert
+        self.assertTrue(subscriber.messages[0].nacked)
+        self.assertFalse(subscriber.messages[0].acked)
+        self.assertLess(elapsed, 2)
+        self.assertEqual(self.spool.depth(), 1)
+
+    def test_ingestion_acks_only_spooled_messages(self):
+        """
+        Test that pulled messages are acknowledged after they are spooled, and not at all when spooling fails.
+        """
+        # Arrange
+        subscriber = FakeSubscriber([b"1.1.1.1", b"\xff"])
+        ingestion_service = IngestionService(subscription_name="fake", service_account_path="fake.json",
+                                             subscriber=subscriber, spool=self.spool)
+        failing_spool = MagicMock()
+        failing_spool.put_many.side_effect = Exception("disk full")
+        failing_ingestion = IngestionService(subscription_name="fake", service_account_path="fake.json",
+                                             subscriber=FakeSubscriber([b"3.3.3.3"]), spool=failing_spool)
+
+        # Act
+        spooled = ingestion_service.spool_messages(ingestion_service.pull_messages())
+        not_spooled = failing_ingestion.spool_messages(failing_ingestion.pull_messages())
+        ingestion_service.ack_manager.close()
+        failing_ingestion.ack_manager.close()
+
+        # Assert
+        self.assertEqual(spooled, 2)
+        self.assertEqual(subscriber.acked_ids, {"ack-0", "ack-1"})
+        self.assertEqual(self.spool.depth(), 2)
+        self.assertEqual(not_spooled, 0)
+        self.assertEqual(failing_ingestion.subscriber.acked_ids, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+# Budget of the cold import of app.main, in milliseconds. It took about 460ms when the Pub/Sub and requests
+# clients were imported at startup, and about 75ms once they are imported on first use. The default leaves room
+# for slow shared machines, STARTUP_IMPORT_BUDGET_MS overrides it and 0 skips the check.
+DEFAULT_IMPORT_BUDGET_MILLISECONDS = 400
+
+# Heavy libraries that must not be imported before the clients that need them are used
+LAZY_MODULES = ("google.cloud.pubsub_v1", "grpc", "requests", "dotenv", "http.server")
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def modules_imported_by(module: str) -> set:
+    """
+    Import the module in a fresh interpreter and return the names of all the modules it left in sys.modules.
+    """
+    code = f"import sys, json, {module}; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", code],
+                            cwd=REPOSITORY_ROOT, capture_output=True, text=True, check=True)
+    return set(json.loads(result.stdout))
+
+
+def import_time(module: str) -> int:
+    """
+    Import the module in a fresh interpreter with -X importtime, and return its cumulative import time in microseconds.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=REPOSITORY_ROOT, capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip() == module:
+            return int(cumulative)
+    raise AssertionError(f"{module} is not in the -X importtime output")
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_heavy_clients_are_imported_lazily(self):
+        """
+        Test that importing app.main does not import the Pub/Sub, HTTP and .env libraries, or any of their submodules.
+        """
+        # Act
+        modules = modules_imported_by("app.main")
+
+        # Assert
+        self.assertIn("app.main", modules)
+        for lazy_module in LAZY_MODULES:
+            imported = [name for name in modules if name == lazy_module or name.startswith(lazy_module + ".")]
+            self.assertEqual(imported, [], f"{lazy_module} is imported at startup")
+
+    def test_import_time_budget(self):
+        """
+        Test that the cold import of app.main stays under the budget, the best of 3 runs to ignore noise.
+        """
+        # Arrange
+        budget = int(os.getenv("STARTUP_IMPORT_BUDGET_MS", DEFAULT_IMPORT_BUDGET_MILLISECONDS))
+        if budget <= 0:
+            self.skipTest("STARTUP_IMPORT_BUDGET_MS is 0")
+
+        # Act
+        best = min(import_time("app.main") for _ in range(3))
+
+        # Assert
+        self.assertLess(best, budget * 1000, f"importing app.main took {best / 1000:.0f}ms, the budget is {budget}ms")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import unittest
+from app.supervisor import Supervisor, worker_stop_event, WORKER_STOPPED_EXIT_CODE
+
+# Marker files of the fake workers, so a restarted worker knows it already crashed once
+DUMMY_DIR = "./tests/temporary_supervisor_output"
+
+
+def draining_worker(worker_index, worker_count, stop_event, stats_queue):
+    """
+    Fake worker that processes alerts until it is asked to stop, then reports its final stats.
+    """
+    while not stop_event.is_set():
+        stop_event.wait(0.01)
+    stats_queue.put({"worker": worker_index, "pid": os.getpid(), "alerts": 1, "drained": 1})
+
+
+def crash_once_worker(worker_index, worker_count, stop_event, stats_queue):
+    """
+    Fake worker that crashes the first time it runs and works normally after it is restarted.
+    """
+    marker = os.path.join(DUMMY_DIR, f"crashed_{worker_index}")
+    if not os.path.exists(marker):
+        open(marker, "w").close()
+        sys.exit(1)
+    draining_worker(worker_index, worker_count, stop_event, stats_queue)
+
+
+def own_stop_worker(worker_index, worker_count, stop_event, stats_queue):
+    """
+    Fake worker that stops like worker_main: on the shared stop_event, or alone on a SIGTERM sent to it.
+    """
+    local_stop_event = worker_stop_event(stop_event)
+    stats_queue.put({"worker": worker_index, "pid": os.getpid(), "alerts": 1, "drained": 0})
+    local_stop_event.wait()
+    stats_queue.put({"worker": worker_index, "pid": os.getpid(), "alerts": 1, "drained": 1})
+    if not stop_event.is_set():
+        sys.exit(WORKER_STOPPED_EXIT_CODE)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        os.makedirs(DUMMY_DIR, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(DUMMY_DIR, ignore_errors=True)  # clean up.
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return condition()
+
+    def test_graceful_stop_drains_workers(self):
+        """
+        Test that stop lets every worker finish and aggregates their final stats.
+        """
+        # Arrange
+        supervisor = Supervisor(worker_count=3, target=draining_worker, shutdown_timeout=5)
+        supervisor.start()
+
+        # Act
+        supervisor.stop()
+        stats = supervisor.aggregated_stats()
+
+        # Assert
+        self.assertEqual(stats["drained"], 3)
+        self.assertEqual(stats["alerts"], 3)
+        self.assertEqual(stats["workers_alive"], 0)
+        self.assertTrue(all(process.exitcode == 0 for process in supervisor.workers.values()))
+
+    def test_crashed_worker_is_restarted(self):
+        """
+        Test that a worker that crashes is started again after the restart delay.
+        """
+        # Arrange
+        supervisor = Supervisor(worker_count=2, target=crash_once_worker, restart_delay=0, shutdown_timeout=5)
+        supervisor.start()
+
+        # Act
+        restarted = self.wait_for(lambda: (supervisor.check_workers(), supervisor.restarts == 2)[1])
+        alive = self.wait_for(lambda: all(process.is_alive() for process in supervisor.workers.values()))
+        supervisor.stop()
+
+        # Assert
+        self.assertTrue(restarted)
+        self.assertTrue(alive)
+        self.assertEqual(supervisor.aggregated_stats()["drained"], 2)
+
+    def test_sigterm_to_a_worker_stops_only_that_worker(self):
+        """
+        Test that a SIGTERM sent to one worker drains and restarts that worker only, and its stats are not lost.
+        """
+        # Arrange
+        supervisor = Supervisor(worker_count=2, target=own_stop_worker, restart_delay=60, shutdown_timeout=5)
+        supervisor.start()
+        started = self.wait_for(lambda: (supervisor.collect_stats(), len(supervisor.latest_stats) == 2)[1])
+        first_pid = supervisor.workers[0].pid
+
+        # Act
+        os.kill(first_pid, signal.SIGTERM)
+        restarted = self.wait_for(lambda: (supervisor.check_workers(), supervisor.restarts == 1)[1])
+        others_alive = supervisor.workers[1].is_alive()
+        shared_stop_set = supervisor.stop_event.is_set()
+        supervisor.stop()
+        stats = supervisor.aggregated_stats()
+
+        # Assert
+        self.assertTrue(started)
+        self.assertTrue(restarted)
+        self.assertNotEqual(supervisor.workers[0].pid, first_pid)
+        self.assertTrue(others_alive)
+        self.assertFalse(shared_stop_set)
+        self.assertEqual(stats["alerts"], 3, "the stats of the stopped process should be kept")
+        self.assertEqual(stats["drained"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
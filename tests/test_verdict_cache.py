@@ -0,0 +1,156 @@
+import os
+import shutil
+import unittest
+from app.verdict_cache import VerdictCache, VERDICT_MALICIOUS, VERDICT_CLEAN, VERDICT_FAILED
+
+
+class FakeTimer:
+    """
+    A controllable clock so TTLs can be tested without sleeping.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestVerdictCache(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Initialize a memory-only cache with a fake clock before each test.
+        """
+        # Arrange
+        self.timer = FakeTimer()
+        self.cache = VerdictCache(max_entries=2, malicious_ttl=100, clean_ttl=50, failed_ttl=10, timer=self.timer)
+
+    def test_get_miss_and_hit(self):
+        """
+        Test a miss before the verdict is cached and a hit after it.
+        """
+        # Act
+        first = self.cache.get("1.2.3.4")
+        self.cache.set("1.2.3.4", VERDICT_MALICIOUS)
+        second = self.cache.get("1.2.3.4")
+
+        # Assert
+        self.assertIsNone(first)
+        self.assertEqual(second, VERDICT_MALICIOUS)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+
+    def test_ttl_per_verdict(self):
+        """
+        Test that every verdict type expires after its own TTL.
+        """
+        # Arrange
+        self.cache.set("1.1.1.1", VERDICT_MALICIOUS)
+        self.cache.set("2.2.2.2", VERDICT_FAILED)
+
+        # Act
+        self.timer.now += 20
+
+        # Assert
+        self.assertEqual(self.cache.get("1.1.1.1"), VERDICT_MALICIOUS)
+        self.assertIsNone(self.cache.get("2.2.2.2"), "failed verdict should expire after its short TTL")
+
+    def test_lru_eviction(self):
+        """
+        Test that the least recently used verdict is evicted when the cache is full.
+        """
+        # Arrange
+        self.cache.set("1.1.1.1", VERDICT_CLEAN)
+        self.cache.set("2.2.2.2", VERDICT_CLEAN)
+        self.cache.get("1.1.1.1")  # 2.2.2.2 is now the least recently used
+
+        # Act
+        self.cache.set("3.3.3.3", VERDICT_CLEAN)
+
+        # Assert
+        self.assertIsNone(self.cache.get("2.2.2.2"))
+        self.assertEqual(self.cache.get("1.1.1.1"), VERDICT_CLEAN)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_peek_and_resolved_at(self):
+        """
+        Test that peek does not count a hit or a miss, and that a verdict resolved earlier expires earlier.
+        """
+        # Arrange
+        self.cache.set("1.1.1.1", VERDICT_CLEAN, resolved_at=self.timer.now - 30)
+        self.cache.set("2.2.2.2", VERDICT_CLEAN, resolved_at=self.timer.now - 60)
+
+        # Act
+        entry = self.cache.peek("1.1.1.1")
+        expired = self.cache.peek("2.2.2.2")
+
+        # Assert
+        self.assertEqual(entry.verdict, VERDICT_CLEAN)
+        self.assertEqual(entry.expires_at, self.timer.now + 20)
+        self.assertIsNone(expired, "a verdict older than its TTL should not be cached")
+        self.assertEqual(self.cache.stats()["hits"] + self.cache.stats()["misses"], 0)
+
+    def test_peek_keeps_lru_order(self):
+        """
+        Test that peeking at the least recently used IoC does not save it from eviction, unlike get.
+        """
+        # Arrange
+        self.cache.set("1.1.1.1", VERDICT_CLEAN)
+        self.cache.set("2.2.2.2", VERDICT_CLEAN)
+
+        # Act
+        self.cache.peek("1.1.1.1")
+        self.cache.set("3.3.3.3", VERDICT_CLEAN)
+
+        # Assert
+        self.assertIsNone(self.cache.peek("1.1.1.1"))
+        self.assertEqual(self.cache.peek("2.2.2.2").verdict, VERDICT_CLEAN)
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_disk_tier_survives_restart(self):
+        """
+        Test that verdicts saved to the SQLite tier are found by a new cache instance.
+        """
+        # Arrange
+        dummy_dir = "./tests/temporary_cache_output"
+        db_path = os.path.join(dummy_dir, "verdicts.db")
+        cache = VerdictCache(db_path=db_path, timer=self.timer)
+        cache.set("1.2.3.4", VERDICT_MALICIOUS)
+        cache.close()
+
+        # Act
+        restarted_cache = VerdictCache(db_path=db_path, timer=self.timer)
+        verdict = restarted_cache.get("1.2.3.4")
+        restarted_cache.close()
+
+        # Assert
+        self.assertEqual(verdict, VERDICT_MALICIOUS)
+
+        shutil.rmtree(dummy_dir)  # clean up.
+
+    def test_disk_tier_is_shared(self):
+        """
+        Test that two caches on the same SQLite file, like the supervisor workers, see each other's verdicts in WAL mode.
+        """
+        # Arrange
+        dummy_dir = "./tests/temporary_cache_output"
+        db_path = os.path.join(dummy_dir, "verdicts.db")
+        first_worker = VerdictCache(db_path=db_path, timer=self.timer)
+        second_worker = VerdictCache(db_path=db_path, timer=self.timer)
+
+        # Act
+        first_worker.set("1.2.3.4", VERDICT_MALICIOUS)
+        verdict = second_worker.get("1.2.3.4")
+        journal_mode = second_worker._db.execute("PRAGMA journal_mode").fetchone()[0]
+        first_worker.close()
+        second_worker.close()
+
+        # Assert
+        self.assertEqual(verdict, VERDICT_MALICIOUS)
+        self.assertEqual(journal_mode, "wal")
+
+        shutil.rmtree(dummy_dir)  # clean up.
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,175 @@
+import unittest
+import requests
+from app.rate_limiter import RateLimiter
+from app.virustotal_client import VirusTotalClient, MAX_RATE_LIMIT_RETRIES
+from benchmarks.stub_virustotal import StubVirusTotalServer
+
+
+class TestVirusTotalClient(unittest.TestCase):
+    """
+    Tests of the VirusTotal client against a local stub HTTP server.
+    """
+
+    def setUp(self):
+        """
+        Start a stub server and a client pointed at it before each test.
+        """
+        # Arrange
+        self.stub = StubVirusTotalServer().start()
+        self.sleeps = []
+        self.client = VirusTotalClient(api_key="fake-key", base_url=self.stub.base_url,
+                                       connect_timeout=1, read_timeout=0.5, max_retries=2,
+                                       sleep=self.sleeps.append)
+
+    def tearDown(self):
+        self.client.close()
+        self.stub.stop()
+
+    def test_get_json_success(self):
+        """
+        Test that a lookup returns the parsed report.
+        """
+        # Arrange
+        self.stub.malicious["1.2.3.4"] = 5
+
+        # Act
+        result = self.client.get_json("ip_addresses/1.2.3.4")
+
+        # Assert
+        self.assertEqual(result["data"]["attributes"]["last_analysis_stats"]["malicious"], 5)
+        self.assertEqual(self.stub.requests, ["/api/v3/ip_addresses/1.2.3.4"])
+
+    def test_keep_alive_reuses_connection(self):
+        """
+        Test that consecutive lookups reuse a single pooled connection.
+        """
+        # Act
+        for i in range(5):
+            self.client.get_json(f"ip_addresses/10.0.0.{i}")
+
+        # Assert
+        self.assertEqual(len(self.stub.requests), 5)
+        self.assertEqual(len(self.stub.connections), 1, "all requests should share one keep-alive connection")
+
+    def test_retry_on_server_error(self):
+        """
+        Test that 5xx responses are retried with a jittered backoff that stays under its ceiling.
+        """
+        # Arrange
+        self.stub.queue_response(503, count=2)
+
+        # Act
+        result = self.client.get_json("ip_addresses/1.2.3.4")
+
+        # Assert
+        self.assertIn("data", result)
+        self.assertEqual(len(self.stub.requests), 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertLessEqual(self.sleeps[0], 0.5)
+        self.assertLessEqual(self.sleeps[1], 1.0)
+        self.assertEqual(self.client.latency.summary()["retries"], 2)
+
+    def test_gives_up_after_max_retries(self):
+        """
+        Test that the error is raised once the retries are used up.
+        """
+        # Arrange
+        self.stub.queue_response(500, count=3)
+
+        # Act / Assert
+        with self.assertRaises(requests.HTTPError):
+            self.client.get_json("ip_addresses/1.2.3.4")
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_client_error_is_not_retried(self):
+        """
+        Test that a 4xx response fails immediately.
+        """
+        # Arrange
+        self.stub.queue_response(404)
+
+        # Act / Assert
+        with self.assertRaises(requests.HTTPError):
+            self.client.get_json("ip_addresses/1.2.3.4")
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_read_timeout_is_retried(self):
+        """
+        Test that a response slower than the read timeout is treated as a connection error and retried.
+        """
+        # Arrange
+        self.stub.delay = 0.3
+        self.client.timeout = (1, 0.1)
+
+        # Act / Assert
+        with self.assertRaises(requests.Timeout):
+            self.client.get_json("ip_addresses/1.2.3.4")
+        self.assertEqual(self.client.latency.summary()["connection_errors"], 3)
+
+    def test_rate_limited_response_backs_off(self):
+        """
+        Test that a 429 response backs off for Retry-After and retries instead of dropping the verdict.
+        """
+        # Arrange
+        rate_limiter = RateLimiter(requests_per_minute=10, requests_per_day=10)
+        self.client.rate_limiter = rate_limiter
+        self.stub.queue_response(429, headers={"Retry-After": "0"})
+
+        # Act
+        result = self.client.get_json("ip_addresses/1.2.3.4")
+
+        # Assert
+        self.assertIn("data", result)
+        self.assertEqual(rate_limiter.rate_limited_responses, 1)
+        self.assertEqual(rate_limiter.remaining()["minute"], 8)
+
+    def test_rate_limited_response_without_limiter(self):
+        """
+        Test that without a rate limiter a 429 sleeps for Retry-After and retries, and gives up after MAX_RATE_LIMIT_RETRIES.
+        """
+        # Arrange
+        self.stub.queue_response(429, headers={"Retry-After": "2"})
+
+        # Act
+        result = self.client.get_json("ip_addresses/1.2.3.4")
+        self.stub.queue_response(429, headers={"Retry-After": "1"}, count=MAX_RATE_LIMIT_RETRIES + 1)
+
+        # Assert
+        self.assertIn("data", result)
+        self.assertEqual(self.sleeps, [2.0])
+        with self.assertRaises(requests.HTTPError):
+            self.client.get_json("ip_addresses/1.2.3.4")
+        self.assertEqual(self.sleeps, [2.0] + [1.0] * MAX_RATE_LIMIT_RETRIES)
+
+    def test_background_request_is_sent_once(self):
+        """
+        Test that a background request does not take budget again, and backs off on 429 without retrying.
+        """
+        # Arrange
+        rate_limiter = RateLimiter(requests_per_minute=10, requests_per_day=10)
+        self.client.rate_limiter = rate_limiter
+        self.stub.queue_response(429, headers={"Retry-After": "30"})
+
+        # Act / Assert
+        with self.assertRaises(requests.HTTPError):
+            self.client.get_json("ip_addresses/1.2.3.4", background=True)
+        self.assertEqual(len(self.stub.requests), 1)
+        self.assertEqual(rate_limiter.remaining()["minute"], 10)
+        self.assertGreater(rate_limiter.seconds_until_available(), 0, "live lookups should back off too")
+
+    def test_latency_summary(self):
+        """
+        Test that every request is recorded in the latency metrics.
+        """
+        # Act
+        self.client.get_json("ip_addresses/1.2.3.4")
+        summary = self.client.latency.summary()
+
+        # Assert
+        self.assertEqual(summary["requests"], 1)
+        self.assertEqual(summary["status_codes"], {200: 1})
+        self.assertGreater(summary["p50"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()